@@ -2,4 +2,4 @@
 set -e
 . /venv/bin/activate
 flask --app tamagotchi init-db
-flask --app tamagotchi run --host 0.0.0.0 --port 8000
+exec flask --app tamagotchi serve --bind 0.0.0.0:8000
@@ -1,10 +1,299 @@
 import click
+import json
+from typing import Callable
+from shinkansen import jws
 from .app import app, db
 from .views import *
+from .views import filtered_query
+from .models import (
+    PersistedSingleTransactionPayoutMessage,
+    PersistedSingleTransactionPayinMessage,
+    ShinkansenTransactionOwner,
+    backfill_columns,
+    backfill_transaction_owners,
+)
+from .schema import upgrade_schema
+from .utils import required_env
+from .keyring import shinkansen_keyring
+from .settings import credentials
+from .standin import (
+    StandinConfig,
+    certificate_pem,
+    create_standin_app,
+    self_signed_certificate,
+)
+from . import benchmarks, inbox, rollups
+from .export import FORMATS as EXPORT_FORMATS, export
+from .bulk import FORMATS, ingest, drain, jobs_with_queued_rows
+from .tester import (
+    TestSuite,
+    backfill_test_responses,
+    benchmark_tester_writes,
+    suite_report,
+)
+
+
+def require(check: Callable, *args):
+    """Checks something a command needs (e.g: credentials), failing the command
+    with a message instead of a traceback if it's missing"""
+    try:
+        check(*args)
+    except Exception as e:
+        raise click.ClickException(str(e))
 
 
 @app.cli.add_command
 @click.command("init-db")
 def init_db():
-    db.create_all()
+    upgrade_schema()
     click.echo(f'Initialized the database: {app.config["SQLALCHEMY_DATABASE_URI"]}')
+
+
+@app.cli.add_command
+@click.command("serve")
+@click.option("--bind", default="0.0.0.0:8000", show_default=True)
+@click.option(
+    "--workers", envvar="WEB_CONCURRENCY", default=2, show_default=True, type=int
+)
+@click.option("--threads", type=int, help="Per worker [default: from max connections]")
+@click.option(
+    "--max-connections",
+    envvar="TAMAGOTCHI_MAX_CONNECTIONS",
+    default=25,
+    show_default=True,
+    help="Requests served at once by all workers (fly.toml's hard_limit)",
+)
+@click.option(
+    "--graceful-timeout",
+    default=4.0,
+    show_default=True,
+    help="Seconds to finish requests when stopping (below fly.toml's kill_timeout)",
+)
+@click.option("--timeout", default=60.0, show_default=True, help="Per request")
+def serve(bind, workers, threads, max_connections, graceful_timeout, timeout):
+    """Serves the app with gunicorn (for production)"""
+    require(required_env, "FLASK_SECRET_KEY")
+    require(credentials.require)
+    require(shinkansen_keyring.require)
+    from . import server  # gunicorn doesn't even import on some platforms
+
+    threads = threads or server.threads_for(max_connections, workers)
+    click.echo(f"Serving on {bind} with {workers} workers of {threads} threads")
+    server.serve(bind, workers, threads, graceful_timeout, timeout)
+
+
+@app.cli.add_command
+@click.command("backfill-db")
+@click.option("--batch-size", default=500, show_default=True)
+def backfill_db(batch_size):
+    """Fills the columns added to existing tables from the stored JSON"""
+    upgrade_schema()
+    for model, owner_type in (
+        (PersistedSingleTransactionPayoutMessage, ShinkansenTransactionOwner.PAYOUT),
+        (PersistedSingleTransactionPayinMessage, ShinkansenTransactionOwner.PAYIN),
+    ):
+        n = backfill_columns(model, batch_size)
+        click.echo(f"Backfilled {n} rows of {model.__tablename__}")
+        n = backfill_transaction_owners(model, owner_type)
+        click.echo(f"Registered {n} transaction owners from {model.__tablename__}")
+    n = backfill_test_responses(batch_size)
+    click.echo(f"Backfilled {n} rows of test_response")
+    n = rollups.rebuild()
+    click.echo(f"Rebuilt {n} rows of rollup_total")
+
+
+@app.cli.add_command
+@click.command("bulk-payouts")
+@click.argument("file", type=click.File("rb"))
+@click.option("--format", type=click.Choice(FORMATS), help="Guessed from the name")
+@click.option("--concurrency", type=int, help="Payouts in flight at once")
+def bulk_payouts(file, format, concurrency):
+    """Sends the payouts in a CSV or NDJSON file (one payout form per row)"""
+    require(credentials.require)
+    job = ingest(file, file.name, format)
+    click.echo(
+        f"Job {job.id}: {job.n_rows} rows, {job.n_invalid} invalid. {job.error or ''}"
+    )
+    if job.status != "failed":
+        drain(job.id, concurrency)
+        click.echo(f"Job {job.id}: {job.n_sent} sent, {job.n_failed} failed")
+
+
+@app.cli.add_command
+@click.command("drain-bulk-payouts")
+@click.argument("job_id", type=int, required=False)
+@click.option("--concurrency", type=int, help="Payouts in flight at once")
+def drain_bulk_payouts(job_id, concurrency):
+    """Sends the rows still queued in bulk payout jobs (e.g: after a restart)"""
+    require(credentials.require)
+    for id in jobs_with_queued_rows(job_id):
+        click.echo(f"Draining job {id}")
+        drain(id, concurrency)
+
+
+@app.cli.add_command
+@click.command("export")
+@click.argument("kind", type=click.Choice(["payouts", "payins"]))
+@click.option("--format", type=click.Choice(EXPORT_FORMATS), default="csv")
+@click.option("--output", type=click.File("w"), default="-", show_default=True)
+@click.option("--status")
+@click.option("--currency")
+@click.option("--creditor-id", help="Payouts only")
+@click.option("--from", "date_from", type=click.DateTime(["%Y-%m-%d"]))
+@click.option("--to", "date_to", type=click.DateTime(["%Y-%m-%d"]), help="Inclusive")
+def export_rows(
+    kind, format, output, status, currency, creditor_id, date_from, date_to
+):
+    """Exports payouts or payins (optionally filtered) as CSV or NDJSON"""
+    model = {
+        "payouts": PersistedSingleTransactionPayoutMessage,
+        "payins": PersistedSingleTransactionPayinMessage,
+    }[kind]
+    args = {
+        "status": status,
+        "currency": currency,
+        "creditor_id": creditor_id,
+        "from": date_from and f"{date_from:%Y-%m-%d}",
+        "to": date_to and f"{date_to:%Y-%m-%d}",
+    }
+    for chunk in export(filtered_query(model, args), model, format):
+        output.write(chunk)
+
+
+@app.cli.add_command
+@click.command("drain-inbox")
+def drain_inbox():
+    """Verifies and applies the pending callbacks of the inbox"""
+    require(shinkansen_keyring.require)
+    n = inbox.drain()
+    click.echo(f"Processed {n} inbox messages")
+    click.echo(inbox.stats())
+
+
+@app.cli.add_command
+@click.command("bench-tester-writes")
+@click.option("--rows", default=2000, show_default=True)
+@click.option("--threads", default=8, show_default=True)
+def bench_tester_writes(rows, threads):
+    """Compares per-row commits vs. write-behind batching of tester messages"""
+    for name, rows_per_second in benchmark_tester_writes(rows, threads).items():
+        click.echo(f"{name}: {rows_per_second:,.0f} rows/s")
+
+
+@app.cli.add_command
+@click.command("tester-report")
+@click.argument("suite_ids", nargs=-1, type=int)
+def tester_report(suite_ids):
+    """Prints latency percentiles (ms) and throughput of test suites (the last
+    one if none is given)"""
+    if not suite_ids:
+        last = TestSuite.query.order_by(TestSuite.id.desc()).first()
+        suite_ids = [last.id] if last else []
+    for suite_id in suite_ids:
+        report = suite_report(suite_id)
+        click.echo(f"Suite {suite_id}: {report['events']}")
+        for name, summary in report["latencies"].items():
+            values = " ".join(
+                f"{k}={v:.1f}" if isinstance(v, float) else f"{k}={v}"
+                for k, v in summary.items()
+            )
+            click.echo(f"  {name}: {values}")
+
+
+@app.cli.add_command
+@click.command("shinkansen-standin")
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=5001, show_default=True)
+@click.option("--latency", default=100.0, show_default=True, help="Mean, in ms")
+@click.option("--jitter", default=50.0, show_default=True, help="In ms")
+@click.option("--error-rate", default=0.0, show_default=True)
+@click.option("--rejection-rate", default=0.0, show_default=True)
+@click.option(
+    "--callback-url",
+    default="http://127.0.0.1:5000/shinkansen/messages/",
+    show_default=True,
+    help="Empty to not send callbacks",
+)
+@click.option("--callback-delay", default=1.0, show_default=True, help="In seconds")
+@click.option("--callback-workers", default=4, show_default=True)
+@click.option(
+    "--certificate",
+    envvar="SHINKANSEN_STANDIN_CERTIFICATE",
+    type=click.Path(exists=True),
+    help="PEM file. A throwaway one is generated if not given",
+)
+@click.option(
+    "--private-key",
+    envvar="SHINKANSEN_STANDIN_PRIVATE_KEY",
+    type=click.Path(exists=True),
+)
+def shinkansen_standin(host, port, certificate, private_key, **options):
+    """Runs a local stand-in for the Shinkansen API"""
+    require(credentials.require, "certificate")
+    if certificate and private_key:
+        certificate = jws.certificate_from_pem_file(certificate)
+        private_key = jws.private_key_from_pem_file(private_key)
+    else:
+        certificate, private_key = self_signed_certificate()
+        click.echo(
+            "Callbacks are signed with this throwaway certificate, which "
+            "tamagotchi must trust (as SHINKANSEN_CERTIFICATE_1 or _2):\n"
+        )
+        click.echo(certificate_pem(certificate))
+    config = StandinConfig(
+        certificate=certificate,
+        private_key=private_key,
+        sender_certificates=[credentials.certificate],
+        **options,
+    )
+    click.echo(f"Set SHINKANSEN_BASE_URL=http://{host}:{port}/v1 to use it")
+    create_standin_app(config).run(host=host, port=port, threaded=True)
+
+
+def sizes_option(value: str) -> tuple[int]:
+    return tuple(int(size) for size in value.split(","))
+
+
+@app.cli.add_command
+@click.command("benchmark")
+@click.option(
+    "--only",
+    multiple=True,
+    type=click.Choice(benchmarks.BENCHMARKS),
+    help="Run only these benchmarks (all by default)",
+)
+@click.option("--repeat", default=5, show_default=True)
+@click.option(
+    "--callback-sizes",
+    default=",".join(map(str, benchmarks.CALLBACK_SIZES)),
+    show_default=True,
+)
+@click.option(
+    "--listing-sizes",
+    default=",".join(map(str, benchmarks.LISTING_SIZES)),
+    show_default=True,
+)
+@click.option("--output", default="benchmark.json", show_default=True)
+@click.option("--compare", type=click.File(), help="A previous output to compare to")
+def benchmark(only, repeat, callback_sizes, listing_sizes, output, compare):
+    """Benchmarks signing, callback ingestion, listings, storage and startup
+    (mostly on a scratch database), writing the results as JSON"""
+    if "signing" in (only or benchmarks.BENCHMARKS):
+        require(credentials.require)
+    results = benchmarks.run(
+        benchmarks=only or benchmarks.BENCHMARKS,
+        repeat=repeat,
+        callback_sizes=sizes_option(callback_sizes),
+        listing_sizes=sizes_option(listing_sizes),
+        progress=lambda r: click.echo(
+            f"{benchmarks.result_key(r)}: p50={r['p50_ms']:.1f}ms "
+            f"mean={r['mean_ms']:.1f}ms max={r['max_ms']:.1f}ms"
+        ),
+    )
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    click.echo(f"Results written to {output}")
+    if compare:
+        for key, before, after in benchmarks.compare(json.load(compare), results):
+            change = (after - before) / before * 100
+            click.echo(f"{key}: {before:.1f}ms -> {after:.1f}ms ({change:+.0f}%)")
@@ -1,9 +1,14 @@
+import os
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from .utils import required_env
+from .settings import TAMAGOTCHI_DATABASE_URL
+from .storage import Database
 
 app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{app.instance_path}/db.sqlite"
+app.config["SQLALCHEMY_DATABASE_URI"] = (
+    TAMAGOTCHI_DATABASE_URL or f"sqlite:///{app.instance_path}/db.sqlite"
+)
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SECRET_KEY"] = required_env("FLASK_SECRET_KEY")
-db = SQLAlchemy(app)
+# Only needed by requests using the session (e.g: to flash messages). See the
+# serve command for a check upfront:
+app.config["SECRET_KEY"] = os.getenv("FLASK_SECRET_KEY")
+db = Database(app)
@@ -0,0 +1,114 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Hashable
+
+
+class MicroBatcher:
+    """Groups items submitted around the same time, so they can be sent
+    together.
+
+    Items with the same key(item) are batched until max_size of them are
+    pending or max_delay seconds after the first one arrived, whichever comes
+    first. Then send(items) is called with the batch, and must return a dict
+    with the result for each item (by item_id(item)) plus a result shared by
+    the whole batch.
+
+    submit() returns a future of (item result, shared result). A full batch is
+    sent by the thread submitting its last item; batches that time out are
+    sent from background threads.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[list], tuple[dict, object]],
+        key: Callable[[object], Hashable],
+        item_id: Callable[[object], Hashable],
+        max_size: int,
+        max_delay: float,
+    ) -> None:
+        self.send = send
+        self.key = key
+        self.item_id = item_id
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.n_items = 0
+        self.n_batches = 0
+        self._batches = {}
+        self._first_pending_at = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def submit(self, item) -> Future:
+        future = Future()
+        key = self.key(item)
+        with self._condition:
+            batch = self._batches.setdefault(key, [])
+            if not batch:
+                self._first_pending_at[key] = time.monotonic()
+            batch.append((item, future))
+            full = len(batch) >= self.max_size
+            if full:
+                del self._batches[key]
+                del self._first_pending_at[key]
+            else:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name="micro-batcher", daemon=True
+                    )
+                    self._thread.start()
+                self._condition.notify()
+        if full:
+            self._send(batch)
+        return future
+
+    def _run(self):
+        while True:
+            with self._condition:
+                due = self._due_batches()
+                while not due:
+                    timeout = (
+                        min(self._first_pending_at.values())
+                        + self.max_delay
+                        - time.monotonic()
+                        if self._first_pending_at
+                        else None
+                    )
+                    self._condition.wait(timeout)
+                    due = self._due_batches()
+            for batch in due:
+                threading.Thread(
+                    target=self._send, args=(batch,), name="micro-batch", daemon=True
+                ).start()
+
+    def _due_batches(self) -> list[list]:
+        now = time.monotonic()
+        due_keys = [
+            key
+            for key, first_pending_at in self._first_pending_at.items()
+            if first_pending_at + self.max_delay <= now
+        ]
+        for key in due_keys:
+            del self._first_pending_at[key]
+        return [self._batches.pop(key) for key in due_keys]
+
+    def _send(self, batch: list):
+        try:
+            results, shared_result = self.send([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.n_items += len(batch)
+        self.n_batches += 1
+        for item, future in batch:
+            future.set_result((results.get(self.item_id(item)), shared_result))
+
+    def stats(self) -> dict:
+        return {
+            "items": self.n_items,
+            "batches": self.n_batches,
+            "mean_batch_size": self.n_items / self.n_batches
+            if self.n_batches
+            else None,
+        }
@@ -0,0 +1,439 @@
+"""Benchmarks of the hot paths, run on a scratch database:
+
+- signing: Signing a payout message, and sending it to a local stand-in of
+  the Shinkansen API (with no latency of its own)
+- callbacks: POSTs to /shinkansen/messages/ with 1 to 500 responses
+- listings: Rendering /payouts/, /payins/ and /tester/ as rows are added
+- storage: Concurrent writers (each committing its own rows, and reading them
+  back) on SQLite files in each of storage.SQLITE_MODES
+- startup: Importing the app, and running the CLI (its --help), in a new
+  Python process
+
+Results are written as JSON, so runs of different versions can be compared
+with compare().
+"""
+
+import contextlib
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, Iterator, Optional
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from werkzeug.serving import make_server
+from shinkansen import jws
+from shinkansen.common import SHINKANSEN, MessageHeader, PersonId, FinancialInstitution
+from shinkansen.payins import PayinMessage, PayinTransaction, INTERACTIVE_PAYMENT
+from shinkansen.payouts import PayoutCreditor
+from shinkansen.responses import PayoutResponse, ResponseMessage
+from .app import app, db
+from .keyring import shinkansen_keyring
+from .models import (
+    PersistedSingleTransactionPayoutMessage,
+    PersistedSingleTransactionPayinMessage,
+    ShinkansenTransactionOwner,
+)
+from .parsing import parse_cache
+from .schema import upgrade_schema
+from .sender import new_header
+from .settings import (
+    TAMAGOTCHI,
+    TAMAGOTCHI_ACCOUNTS,
+    credentials,
+)
+from .standin import StandinConfig, create_standin_app, self_signed_certificate
+from .storage import SQLITE_MODES, create_engine
+from .tester import TestMessage, TestResponse, TestSuite, single_payout
+from .transport import send
+
+BENCHMARKS = ("signing", "callbacks", "listings", "storage", "startup")
+CALLBACK_SIZES = (1, 10, 100, 500)
+LISTING_SIZES = (1000, 10000, 100000)
+STORAGE_THREADS = (1, 8, 25)
+STORAGE_WRITES_PER_THREAD = 50
+STARTUP_COMMANDS = {
+    "import": [sys.executable, "-c", "import tamagotchi"],
+    "cli": [sys.executable, "-m", "flask", "--app", "tamagotchi", "--help"],
+}
+
+CREDITOR = PayoutCreditor(
+    name="Benchmark",
+    identification=PersonId("CLID", "11111111-1"),
+    financial_institution=FinancialInstitution("SIMULATED_BANK"),
+    account="1",
+    account_type="current_account",
+    email="benchmark@example.org",
+)
+
+
+def result(name: str, params: dict, samples: list[float], **extra) -> dict:
+    """A benchmark result, from samples in seconds"""
+    samples_ms = [s * 1000 for s in samples]
+    return {
+        "benchmark": name,
+        "params": params,
+        "n": len(samples_ms),
+        "mean_ms": statistics.mean(samples_ms),
+        "p50_ms": statistics.median(samples_ms),
+        "min_ms": min(samples_ms),
+        "max_ms": max(samples_ms),
+        **extra,
+    }
+
+
+def timed(f: Callable, repeat: int) -> list[float]:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+@contextlib.contextmanager
+def scratch_database() -> Iterator[None]:
+    """Points the app to an empty SQLite file while benchmarking"""
+    uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    with tempfile.TemporaryDirectory() as directory:
+        db.session.remove()
+        app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{directory}/bench.sqlite"
+        try:
+            upgrade_schema()
+            yield
+        finally:
+            db.session.remove()
+            db.engine.dispose()
+            app.config["SQLALCHEMY_DATABASE_URI"] = uri
+            parse_cache.clear()
+
+
+@contextlib.contextmanager
+def local_standin(config: StandinConfig) -> Iterator[str]:
+    """Serves a Shinkansen stand-in in a background thread, yielding its URL"""
+    server = make_server("127.0.0.1", 0, create_standin_app(config), threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    request_logger = logging.getLogger("werkzeug")
+    level = request_logger.level
+    request_logger.setLevel(logging.WARNING)
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/v1"
+    finally:
+        request_logger.setLevel(level)
+        server.shutdown()
+        thread.join()
+
+
+def bench_signing(repeat: int) -> list[dict]:
+    messages = [single_payout(CREDITOR) for _ in range(repeat)]
+    signatures = []
+
+    def sign():
+        message = messages[len(signatures)]
+        signatures.append(
+            message.signature(credentials.private_key, credentials.certificate)
+        )
+
+    results = [result("signing.sign", {}, timed(sign, repeat))]
+    certificate, key = self_signed_certificate()
+    config = StandinConfig(certificate, key, latency=0, jitter=0)
+    with local_standin(config) as base_url:
+        sent = []
+
+        def send_one():
+            i = len(sent)
+            sent.append(send(messages[i], signatures[i], base_url))
+
+        results.append(result("signing.send", {}, timed(send_one, repeat)))
+    return results
+
+
+def persist_payouts(n: int) -> list[PersistedSingleTransactionPayoutMessage]:
+    payouts = []
+    for _ in range(n):
+        payout = PersistedSingleTransactionPayoutMessage(
+            single_payout(CREDITOR), "signature", str(uuid.uuid4())
+        )
+        payouts.append(payout)
+        db.session.add(payout)
+        db.session.add(
+            ShinkansenTransactionOwner(
+                shinkansen_transaction_id=payout.shinkansen_transaction_id,
+                owner_type=ShinkansenTransactionOwner.PAYOUT,
+                owner_id=payout.id,
+            )
+        )
+    db.session.commit()
+    return payouts
+
+
+def persist_payins(n: int):
+    for _ in range(n):
+        transaction = PayinTransaction(
+            payin_type=INTERACTIVE_PAYMENT,
+            currency="CLP",
+            amount="1000",
+            description="Benchmark",
+            creditor=TAMAGOTCHI_ACCOUNTS["CLP"],
+        )
+        message = PayinMessage(header=new_header(), transactions=[transaction])
+        db.session.add(
+            PersistedSingleTransactionPayinMessage(
+                message, "signature", str(uuid.uuid4())
+            )
+        )
+    db.session.commit()
+
+
+def persist_tester_rows(suite_id: int, n: int):
+    """n messages of a single transaction each, half of them with a response"""
+    for i in range(n):
+        message = single_payout(CREDITOR)
+        transaction = message.transactions[0]
+        db.session.add(
+            TestMessage(
+                suite_id=suite_id, content=message.as_json(), description=str(i)
+            )
+        )
+        if i % 2:
+            response = PayoutResponse(
+                transaction_id=transaction.transaction_id,
+                shinkansen_transaction_id=str(uuid.uuid4()),
+                shinkansen_transaction_status="completed",
+                shinkansen_transaction_message="",
+                response_status="ok",
+                response_message="",
+            )
+            db.session.add(
+                TestResponse(
+                    suite_id=suite_id,
+                    transaction_id=transaction.transaction_id,
+                    content=json.dumps(response, default=lambda o: o.__dict__),
+                )
+            )
+    db.session.commit()
+
+
+def bench_callbacks(repeat: int, sizes: tuple[int] = CALLBACK_SIZES) -> list[dict]:
+    certificate, key = self_signed_certificate()
+    # Plain ids, as each request ends by removing the session:
+    transaction_ids = [
+        (payout.transaction_id, payout.shinkansen_transaction_id)
+        for payout in persist_payouts(max(sizes))
+    ]
+    client = app.test_client()
+    results = []
+    key_id = shinkansen_keyring.add(certificate)
+    try:
+        for size in sizes:
+            bodies = []
+            for _ in range(repeat):
+                body = ResponseMessage(
+                    header=MessageHeader(sender=SHINKANSEN, receiver=TAMAGOTCHI),
+                    responses=[
+                        PayoutResponse(
+                            transaction_id=transaction_id,
+                            shinkansen_transaction_id=shinkansen_transaction_id,
+                            shinkansen_transaction_status="completed",
+                            shinkansen_transaction_message="",
+                            response_status="ok",
+                            response_message="",
+                        )
+                        for transaction_id, shinkansen_transaction_id in (
+                            transaction_ids[:size]
+                        )
+                    ],
+                ).as_json()
+                bodies.append((body, jws.sign(body, key, certificate)))
+
+            def post():
+                body, signature = bodies.pop()
+                response = client.post(
+                    "/shinkansen/messages/",
+                    data=body,
+                    headers={
+                        "Content-Type": "application/json",
+                        "Shinkansen-JWS-Signature": signature,
+                    },
+                )
+                assert response.status_code == 200, response.status_code
+
+            samples = timed(post, repeat)
+            results.append(
+                result(
+                    "callbacks",
+                    {"responses": size},
+                    samples,
+                    responses_per_second=size * repeat / sum(samples),
+                )
+            )
+    finally:
+        shinkansen_keyring.remove(key_id)
+    return results
+
+
+def bench_storage(repeat: int, threads: tuple[int] = STORAGE_THREADS) -> list[dict]:
+    results = []
+    for mode in SQLITE_MODES:
+        for n_threads in threads:
+            with tempfile.TemporaryDirectory() as directory:
+                url = f"sqlite:///{directory}/{mode}.sqlite"
+                engine = create_engine(url, mode=mode)
+                db.metadata.create_all(
+                    engine, tables=[ShinkansenTransactionOwner.__table__]
+                )
+                errors = []
+
+                def write(_):
+                    for _ in range(STORAGE_WRITES_PER_THREAD):
+                        id = str(uuid.uuid4())
+                        try:
+                            with Session(engine) as session:
+                                session.add(
+                                    ShinkansenTransactionOwner(
+                                        shinkansen_transaction_id=id,
+                                        owner_type=ShinkansenTransactionOwner.PAYOUT,
+                                        owner_id=id,
+                                    )
+                                )
+                                session.commit()
+                                session.get(ShinkansenTransactionOwner, id)
+                        except OperationalError as e:
+                            errors.append(e)
+
+                def run_writers():
+                    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                        list(executor.map(write, range(n_threads)))
+
+                samples = timed(run_writers, repeat)
+                engine.dispose()
+            n_writes = n_threads * STORAGE_WRITES_PER_THREAD * repeat
+            results.append(
+                result(
+                    "storage",
+                    {"mode": mode, "threads": n_threads},
+                    samples,
+                    writes_per_second=n_writes / sum(samples),
+                    errors=len(errors),
+                )
+            )
+    return results
+
+
+def bench_startup(repeat: int) -> list[dict]:
+    results = []
+    for name, command in STARTUP_COMMANDS.items():
+
+        def run_command():
+            subprocess.run(
+                command,
+                cwd=os.path.dirname(os.path.dirname(__file__)),
+                capture_output=True,
+                check=True,
+            )
+
+        results.append(result("startup", {"command": name}, timed(run_command, repeat)))
+    return results
+
+
+def bench_listings(repeat: int, sizes: tuple[int] = LISTING_SIZES) -> list[dict]:
+    client = app.test_client()
+    suite = TestSuite(status="running")
+    db.session.add(suite)
+    db.session.commit()
+    suite_id = suite.id
+    results = []
+    stored = 0
+    for size in sizes:
+        # Added in chunks, so we don't hold every new row in the session
+        for chunk in range(stored, size, 5000):
+            n = min(5000, size - chunk)
+            persist_payouts(n)
+            persist_payins(n)
+            persist_tester_rows(suite_id, n)
+            db.session.expunge_all()
+        stored = size
+        for path in ("/payouts/", "/payins/", "/tester/"):
+
+            def get():
+                response = client.get(path)
+                assert response.status_code == 200, response.status_code
+
+            results.append(
+                result("listings", {"path": path, "rows": size}, timed(get, repeat))
+            )
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(__file__),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(
+    benchmarks: tuple[str] = BENCHMARKS,
+    repeat: int = 5,
+    callback_sizes: tuple[int] = CALLBACK_SIZES,
+    listing_sizes: tuple[int] = LISTING_SIZES,
+    progress: Callable[[dict], None] = lambda _: None,
+) -> dict:
+    """Runs the given benchmarks, each on its own scratch database"""
+    results = []
+    for name in benchmarks:
+        with scratch_database():
+            if name == "signing":
+                new_results = bench_signing(repeat)
+            elif name == "callbacks":
+                new_results = bench_callbacks(repeat, callback_sizes)
+            elif name == "listings":
+                new_results = bench_listings(repeat, listing_sizes)
+            elif name == "storage":
+                new_results = bench_storage(repeat)
+            elif name == "startup":
+                new_results = bench_startup(repeat)
+            else:
+                raise ValueError(f"Unknown benchmark: {name}")
+        for r in new_results:
+            progress(r)
+        results += new_results
+    return {
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def result_key(r: dict) -> str:
+    params = ",".join(f"{k}={v}" for k, v in sorted(r["params"].items()))
+    return f"{r['benchmark']}[{params}]" if params else r["benchmark"]
+
+
+def compare(baseline: dict, current: dict) -> list[tuple[str, float, float]]:
+    """(benchmark, baseline p50, current p50) for benchmarks in both runs"""
+    baseline_p50s = {result_key(r): r["p50_ms"] for r in baseline["results"]}
+    return [
+        (result_key(r), baseline_p50s[result_key(r)], r["p50_ms"])
+        for r in current["results"]
+        if result_key(r) in baseline_p50s
+    ]
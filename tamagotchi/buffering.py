@@ -0,0 +1,126 @@
+import threading
+import time
+from typing import Callable, Optional
+from sqlalchemy import exc
+from sqlalchemy.orm import Session
+from .app import app, db
+
+
+class WriteBehindBuffer:
+    """Collects new rows and inserts them in batches from a background thread.
+
+    A batch is written when max_size rows are pending or max_delay seconds
+    after the first pending row arrived, whichever comes first. flush() writes
+    everything pending right away (and close() also stops the thread).
+
+    Rows must be new (transient) model instances, not added to any session.
+    They are written with a new session on db.engine, unless a session_factory
+    is given.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        max_delay: float,
+        session_factory: Optional[Callable[[], Session]] = None,
+    ) -> None:
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.session_factory = session_factory
+        self.n_written = 0
+        self.n_batches = 0
+        self._rows = []
+        self._first_pending_at = None
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def add(self, *rows):
+        with self._condition:
+            if not self._rows:
+                self._first_pending_at = time.monotonic()
+            self._rows.extend(rows)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="write-behind", daemon=True
+                )
+                self._thread.start()
+            if len(self._rows) >= self.max_size:
+                self._condition.notify()
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._rows)
+
+    def flush(self):
+        self._write(self._take(None))
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _take(self, n: Optional[int]) -> list:
+        with self._condition:
+            n = len(self._rows) if n is None else n
+            rows, self._rows = self._rows[:n], self._rows[n:]
+            self._first_pending_at = time.monotonic() if self._rows else None
+            return rows
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and len(self._rows) < self.max_size:
+                    if self._rows:
+                        timeout = self._first_pending_at + self.max_delay
+                        timeout -= time.monotonic()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._condition.wait(timeout)
+                if self._closed:
+                    return
+            if not self._write(self._take(self.max_size)):
+                time.sleep(self.max_delay)  # Back off before retrying
+
+    def _write(self, rows: list) -> bool:
+        """Writes rows, returning False if they were put back to retry later"""
+        if not rows:
+            return True
+        with self._write_lock:
+            try:
+                self._commit(rows)
+            except exc.IntegrityError:
+                # Don't let a single bad row hold back the whole batch:
+                for row in rows:
+                    try:
+                        self._commit([row])
+                    except exc.IntegrityError:
+                        app.logger.exception(f"Dropping row {row!r}")
+            except Exception:
+                app.logger.exception(f"Error writing {len(rows)} rows, will retry")
+                with self._condition:
+                    self._rows[:0] = rows
+                    self._first_pending_at = time.monotonic()
+                return False
+        return True
+
+    def _commit(self, rows: list):
+        # A session of our own, so we never commit (or remove) the session of
+        # the request or thread that happens to call flush()
+        session = self.session_factory() if self.session_factory else Session(db.engine)
+        try:
+            session.add_all(rows)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        self.n_written += len(rows)
+        self.n_batches += 1
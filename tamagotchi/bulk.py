@@ -0,0 +1,330 @@
+import codecs
+import csv
+import functools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Iterator, Optional, Union
+from sqlalchemy import func, update
+from sqlalchemy.orm import relationship
+from .app import app, db
+from .forms import payout_transaction_from_form_input
+from .sender import send_payout
+from .settings import TAMAGOTCHI_BULK_CONCURRENCY
+
+# Job statuses:
+INGESTING = "ingesting"
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+# Row statuses (plus QUEUED and FAILED):
+INVALID = "invalid"
+SENDING = "sending"
+SENT = "sent"
+
+FORMATS = ("csv", "ndjson")
+
+
+class BulkPayoutJob(db.Model):
+    __tablename__ = "bulk_payout_job"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    filename = db.Column(db.Text())
+    status = db.Column(db.String(16), index=True)
+    error = db.Column(db.Text())
+    n_rows = db.Column(db.Integer, default=0)
+    n_invalid = db.Column(db.Integer, default=0)
+    n_sent = db.Column(db.Integer, default=0)
+    n_failed = db.Column(db.Integer, default=0)
+    rows = relationship("BulkPayoutRow", back_populates="job", lazy="dynamic")
+
+    @property
+    def n_pending(self) -> int:
+        return self.n_rows - self.n_invalid - self.n_sent - self.n_failed
+
+    def errors(self, after_row: int = 0, limit: int = 100) -> list["BulkPayoutRow"]:
+        """Invalid and failed rows, in file order"""
+        return (
+            self.rows.filter(
+                BulkPayoutRow.status.in_((INVALID, FAILED)),
+                BulkPayoutRow.row_number > after_row,
+            )
+            .order_by(BulkPayoutRow.row_number)
+            .limit(limit)
+            .all()
+        )
+
+    def as_json_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "filename": self.filename,
+            "status": self.status,
+            "error": self.error,
+            "n_rows": self.n_rows,
+            "n_invalid": self.n_invalid,
+            "n_sent": self.n_sent,
+            "n_failed": self.n_failed,
+            "n_pending": self.n_pending,
+        }
+
+
+class BulkPayoutRow(db.Model):
+    __tablename__ = "bulk_payout_row"
+    __table_args__ = (
+        db.Index("ix_bulk_payout_row_job_status", "job_id", "status", "row_number"),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    job_id = db.Column(db.Integer, db.ForeignKey("bulk_payout_job.id"))
+    job = relationship("BulkPayoutJob", back_populates="rows")
+    row_number = db.Column(db.Integer)
+    form = db.Column(db.Text())
+    status = db.Column(db.String(16))
+    error = db.Column(db.Text())
+    payout_id = db.Column(db.String(36))
+
+    def as_json_dict(self) -> dict:
+        return {
+            "row_number": self.row_number,
+            "status": self.status,
+            "error": self.error,
+            "payout_id": self.payout_id,
+        }
+
+
+def format_from_filename(filename: str) -> str:
+    if filename.lower().endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    return "csv"
+
+
+def records_from_stream(stream: IO[bytes], format: str) -> Iterator[Union[dict, str]]:
+    """Yields CSV rows as dicts and NDJSON rows as (still unparsed) lines, one at
+    a time, so we never hold the whole file in memory"""
+    # Not a TextIOWrapper: uploads may be spooled files without readable() or
+    # seekable() (on Python < 3.11), which it needs
+    text = codecs.getreader("utf-8-sig")(stream)
+    if format == "csv":
+        yield from csv.DictReader(text)
+    else:
+        for line in text:
+            if line.strip():
+                yield line
+
+
+def validated_form(record: Union[dict, str]) -> dict:
+    """Returns the record as a payout form, raising if it isn't a valid one.
+
+    Validation is the same used by the new payout form.
+    """
+    form = json.loads(record) if isinstance(record, str) else record
+    if not isinstance(form, dict):
+        raise ValueError("Expected a JSON object")
+    form = {k: str(v) for k, v in form.items() if k is not None and v is not None}
+    payout_transaction_from_form_input(form)
+    return form
+
+
+def describe_error(e: Exception) -> str:
+    if isinstance(e, KeyError):
+        return f"Missing or invalid field: {e}"
+    return f"{type(e).__name__}: {e}"
+
+
+def ingest(
+    stream: IO[bytes], filename: str, format: str = None, batch_size: int = 500
+) -> BulkPayoutJob:
+    """Creates a job with a row for each payout in stream.
+
+    Invalid rows are recorded with their error and won't be sent. Rows are
+    committed in batches of batch_size.
+    """
+    job = BulkPayoutJob(
+        filename=filename, status=INGESTING, n_rows=0, n_invalid=0, n_sent=0, n_failed=0
+    )
+    db.session.add(job)
+    db.session.commit()
+    batch = []
+    try:
+        records = records_from_stream(stream, format or format_from_filename(filename))
+        for row_number, record in enumerate(records, start=1):
+            try:
+                form = validated_form(record)
+                batch.append(
+                    BulkPayoutRow(
+                        job_id=job.id,
+                        row_number=row_number,
+                        form=json.dumps(form),
+                        status=QUEUED,
+                    )
+                )
+            except Exception as e:
+                batch.append(
+                    BulkPayoutRow(
+                        job_id=job.id,
+                        row_number=row_number,
+                        form=record if isinstance(record, str) else json.dumps(record),
+                        status=INVALID,
+                        error=describe_error(e),
+                    )
+                )
+                job.n_invalid += 1
+            job.n_rows = row_number
+            if len(batch) >= batch_size:
+                db.session.add_all(batch)
+                db.session.commit()
+                batch = []
+    except Exception as e:
+        # Whatever the error, the job mustn't be left ingesting forever
+        db.session.rollback()
+        job.status = FAILED
+        job.error = describe_error(e)
+        db.session.commit()
+        return job
+    db.session.add_all(batch)
+    job.status = QUEUED
+    db.session.commit()
+    return job
+
+
+def send_row(row_id: int):
+    """Claims a queued row and sends its payout. Runs in a worker thread, so
+    any error is logged here"""
+    with app.app_context():
+        try:
+            claimed = db.session.execute(
+                update(BulkPayoutRow)
+                .where(BulkPayoutRow.id == row_id, BulkPayoutRow.status == QUEUED)
+                .values(status=SENDING)
+            ).rowcount
+            db.session.commit()
+            if not claimed:
+                return  # Somebody else got it
+            row = BulkPayoutRow.query.get(row_id)
+            try:
+                transaction = payout_transaction_from_form_input(json.loads(row.form))
+                persisted_payout, response = send_payout(transaction)
+                error = (
+                    None
+                    if persisted_payout
+                    else f"HTTP Status: {response.http_status_code}. "
+                    f"Errors: {response.errors}."
+                )
+            except Exception as e:
+                db.session.rollback()
+                persisted_payout, error = None, describe_error(e)
+            if persisted_payout:
+                payout_id = persisted_payout.id
+                shinkansen_transaction_id = persisted_payout.shinkansen_transaction_id
+                try:
+                    # Shinkansen has it, so record it before anything else:
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.exception(
+                        f"Payout {payout_id} of bulk row {row_id} was accepted by "
+                        f"Shinkansen ({shinkansen_transaction_id}) but not recorded"
+                    )
+                    persisted_payout = None
+                    error = f"Sent, but not recorded: {describe_error(e)}"
+            if persisted_payout:
+                row.status = SENT
+                row.payout_id = payout_id
+                counter = {"n_sent": BulkPayoutJob.n_sent + 1}
+            else:
+                row.status = FAILED
+                row.error = error
+                counter = {"n_failed": BulkPayoutJob.n_failed + 1}
+            db.session.execute(
+                update(BulkPayoutJob)
+                .where(BulkPayoutJob.id == row.job_id)
+                .values(**counter)
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception(f"Error sending bulk payout row {row_id}")
+
+
+def drain(job_id: int, concurrency: int = None):
+    """Sends the queued rows of a job, with at most `concurrency` in flight.
+
+    Rows are claimed before being sent, so several processes can drain the same
+    job without sending a payout twice. A row left as "sending" by a crash is
+    never retried automatically, as we can't know if Shinkansen got it.
+    """
+    concurrency = concurrency or TAMAGOTCHI_BULK_CONCURRENCY
+    job = BulkPayoutJob.query.get(job_id)
+    job.status = RUNNING
+    db.session.commit()
+    in_flight = threading.BoundedSemaphore(concurrency)
+    last_row_id = 0
+
+    def row_done(row_id: int, future):
+        in_flight.release()
+        if future.exception() is not None:  # Not even logged by send_row()
+            app.logger.error(
+                f"Error sending bulk payout row {row_id}: "
+                f"{describe_error(future.exception())}"
+            )
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            row_ids = [
+                id
+                for (id,) in db.session.query(BulkPayoutRow.id)
+                .filter(
+                    BulkPayoutRow.job_id == job_id,
+                    BulkPayoutRow.status == QUEUED,
+                    BulkPayoutRow.id > last_row_id,
+                )
+                .order_by(BulkPayoutRow.id)
+                .limit(concurrency * 10)
+            ]
+            db.session.commit()  # Don't hold a read transaction while we wait
+            if not row_ids:
+                break
+            for row_id in row_ids:
+                in_flight.acquire()
+                executor.submit(send_row, row_id).add_done_callback(
+                    functools.partial(row_done, row_id)
+                )
+            last_row_id = row_ids[-1]
+    job = BulkPayoutJob.query.get(job_id)
+    job.status = FINISHED
+    db.session.commit()
+
+
+_draining = set()
+_draining_lock = threading.Lock()
+
+
+def start_draining(job_id: int) -> bool:
+    """Drains a job in a background thread of this process, unless it is already
+    being drained here"""
+    with _draining_lock:
+        if job_id in _draining:
+            return False
+        _draining.add(job_id)
+
+    def run():
+        try:
+            with app.app_context():
+                drain(job_id)
+        except Exception:
+            app.logger.exception(f"Error draining bulk payout job {job_id}")
+        finally:
+            with _draining_lock:
+                _draining.discard(job_id)
+
+    threading.Thread(target=run, name=f"bulk-payouts-{job_id}", daemon=True).start()
+    return True
+
+
+def jobs_with_queued_rows(job_id: Optional[int] = None) -> list[int]:
+    query = db.session.query(BulkPayoutRow.job_id).filter(
+        BulkPayoutRow.status == QUEUED
+    )
+    if job_id:
+        query = query.filter(BulkPayoutRow.job_id == job_id)
+    return [id for (id,) in query.distinct()]
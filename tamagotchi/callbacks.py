@@ -0,0 +1,130 @@
+from datetime import datetime
+from typing import Optional, Union
+from sqlalchemy import and_, cast, Integer
+from shinkansen.responses import ResponseMessage
+from .app import app, db
+from .models import (
+    PersistedSingleTransactionPayoutMessage,
+    PersistedSingleTransactionPayinMessage,
+    ShinkansenTransactionOwner,
+)
+from .forwarder import forwarder
+from .instrumentation import count
+from .keyring import shinkansen_keyring
+from .tester import TestSuite
+
+
+def verified_response_message(content: str, signature: str) -> ResponseMessage:
+    """Parses a response message, raising if it (or its signature) is invalid"""
+    message = ResponseMessage.from_json(content)
+    shinkansen_keyring.verify_response_message(message, signature)
+    return message
+
+
+def owners_for_shinkansen_transaction_ids(
+    shinkansen_transaction_ids: list[str],
+) -> dict[
+    str,
+    tuple[
+        Union[
+            PersistedSingleTransactionPayoutMessage,
+            PersistedSingleTransactionPayinMessage,
+            TestSuite,
+        ],
+        Optional[datetime],
+    ],
+]:
+    """Finds the payout, payin or test suite owning each transaction id (and
+    when it was sent), all in a single query"""
+    Owner = ShinkansenTransactionOwner
+    Payout = PersistedSingleTransactionPayoutMessage
+    Payin = PersistedSingleTransactionPayinMessage
+    rows = (
+        db.session.query(Owner, Payout, Payin, TestSuite)
+        .outerjoin(
+            Payout, and_(Owner.owner_type == Owner.PAYOUT, Payout.id == Owner.owner_id)
+        )
+        .outerjoin(
+            Payin, and_(Owner.owner_type == Owner.PAYIN, Payin.id == Owner.owner_id)
+        )
+        .outerjoin(
+            TestSuite,
+            and_(
+                Owner.owner_type == Owner.TEST_SUITE,
+                TestSuite.id == cast(Owner.owner_id, Integer),
+            ),
+        )
+        .filter(Owner.shinkansen_transaction_id.in_(shinkansen_transaction_ids))
+    )
+    return {
+        owner.shinkansen_transaction_id: (payout or payin or suite, owner.sent_at)
+        for owner, payout, payin, suite in rows
+        if payout or payin or suite
+    }
+
+
+class RoutedMessage:
+    """A message whose responses were routed (see apply_response_message()).
+
+    It's only counted, and forwarded if some of its transactions are unknown,
+    by after_commit(). So a message whose changes are rolled back (e.g: a copy
+    applied concurrently) isn't forwarded, nor counted, more than once.
+    """
+
+    def __init__(
+        self, n_responses: int, unknown: list[str], content: str, signature: str
+    ) -> None:
+        self.n_responses = n_responses
+        self.unknown = unknown
+        self.content = content
+        self.signature = signature
+
+    def after_commit(self):
+        count("callback_responses_matched", self.n_responses - len(self.unknown))
+        if not self.unknown:
+            return
+        count("callback_responses_unknown", len(self.unknown))
+        if forwarder:
+            # The whole message, once, as its signature covers all of it:
+            app.logger.info(f"Forwarding message to {forwarder.url}: {self.unknown}")
+            forwarder.submit(self.content, self.signature)
+            count("callbacks_forwarded")
+        else:
+            app.logger.error(
+                "Received responses for unknown transactions: %s", self.unknown
+            )
+
+
+def apply_response_message(
+    message: ResponseMessage, content: str, signature: str
+) -> RoutedMessage:
+    """Routes each response of a (verified) message to the payout, payin or
+    test suite that sent its transaction, leaving the changes in the session
+    (but not committed). Call after_commit() on the result once committed"""
+    owners = owners_for_shinkansen_transaction_ids(
+        [response.shinkansen_transaction_id for response in message.responses]
+    )
+    current_suite = None
+    unknown = []
+    for response in message.responses:
+        owner, sent_at = owners.get(response.shinkansen_transaction_id, (None, None))
+        if isinstance(owner, TestSuite):
+            if owner.status == "running":
+                owner.add_tester_response(response, sent_at)
+            else:
+                app.logger.warning(
+                    "Received response for finished test suite %s: %s",
+                    owner.id,
+                    response.shinkansen_transaction_id,
+                )
+        elif owner:
+            owner.apply_response(response, message.original_json, signature)
+        else:
+            # Transactions sent before the owner registry existed (or by some
+            # other instance) end up here:
+            current_suite = current_suite or TestSuite.current()
+            if current_suite:
+                current_suite.add_tester_response(response)
+            else:
+                unknown.append(response.shinkansen_transaction_id)
+    return RoutedMessage(len(message.responses), unknown, content, signature)
@@ -0,0 +1,129 @@
+"""Change versions, so pages can be answered with 304 Not Modified.
+
+Each scope (e.g: "payouts") has a version in the change_version table, bumped
+in the same transaction that inserts, updates or deletes any of the models it
+tracks (from any session on the app's database: views, callbacks, the inbox
+worker, bulk uploads, write-behind buffers...). Views decorated with
+conditional() read the versions of their scopes (a primary key lookup) and
+answer a matching If-None-Match with 304, without querying the rows or
+rendering the template.
+"""
+
+import functools
+import uuid
+from hashlib import blake2b
+from itertools import chain
+from flask import make_response, request, session
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from werkzeug.http import is_resource_modified
+from .app import app, db
+from .models import (
+    PersistedSingleTransactionPayoutMessage,
+    PersistedSingleTransactionPayinMessage,
+    utcnow,
+)
+from .tester import TestMessage, TestResponse, TestSuite
+
+# Part of every ETag, so pages rendered by a previous deploy (maybe with other
+# templates) aren't taken as current. The app is imported once per server
+# (see server.py), so all workers share it:
+BOOT_ID = uuid.uuid4().hex[:8]
+
+
+class ChangeVersion(db.Model):
+    __tablename__ = "change_version"
+    scope = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    changed_at = db.Column(db.DateTime())
+
+
+SCOPES = {}
+
+
+def track(scope: str, *models):
+    """Bumps the version of scope whenever rows of models change"""
+    for model in models:
+        SCOPES[model] = scope
+
+
+track("payouts", PersistedSingleTransactionPayoutMessage)
+track("payins", PersistedSingleTransactionPayinMessage)
+track("tester", TestSuite, TestMessage, TestResponse)
+
+
+def bump(connection, scope: str):
+    table = ChangeVersion.__table__
+    now = utcnow()
+    updated = connection.execute(
+        table.update()
+        .where(table.c.scope == scope)
+        .values(version=table.c.version + 1, changed_at=now)
+    )
+    if not updated.rowcount:
+        connection.execute(
+            table.insert().values(scope=scope, version=1, changed_at=now)
+        )
+
+
+@event.listens_for(Session, "before_flush")
+def bump_versions(session, flush_context, instances):
+    if session.bind is not None and session.bind is not db.engine:
+        return  # Another database (e.g: a benchmark's), without change_version
+    changed = chain(
+        session.new,
+        (obj for obj in session.dirty if session.is_modified(obj)),
+        session.deleted,
+    )
+    scopes = {SCOPES[type(obj)] for obj in changed if type(obj) in SCOPES}
+    for scope in sorted(scopes):  # Always in the same order, to avoid deadlocks
+        bump(session.connection(), scope)
+
+
+def versions(*scopes: str) -> dict[str, ChangeVersion]:
+    rows = ChangeVersion.query.filter(ChangeVersion.scope.in_(scopes))
+    return {row.scope: row for row in rows}
+
+
+def validators(*scopes: str) -> tuple:
+    """The ETag (for the current request URL) and Last-Modified of a page
+    showing scopes"""
+    current = versions(*scopes)
+    numbers = ".".join(
+        str(current[scope].version if scope in current else 0) for scope in scopes
+    )
+    url = blake2b(request.full_path.encode("UTF-8"), digest_size=8).hexdigest()
+    changed_at = [row.changed_at for row in current.values() if row.changed_at]
+    return f"{BOOT_ID}-{numbers}-{url}", max(changed_at, default=None)
+
+
+def conditional(*scopes: str):
+    """Answers with 304 Not Modified (without calling the view) if nothing in
+    scopes changed since the client got its copy of the page"""
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if session.get("_flashes"):
+                # The page must be rendered to show (and consume) them:
+                return view(*args, **kwargs)
+            # Read before the view runs, so a change committed meanwhile makes
+            # the next request render the page again (never the opposite):
+            etag, last_modified = validators(*scopes)
+            if is_resource_modified(
+                request.environ, etag=etag, last_modified=last_modified
+            ):
+                response = make_response(view(*args, **kwargs))
+            else:
+                response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            # Browsers may keep the page, but must check it's current:
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+
+        return wrapper
+
+    return decorator
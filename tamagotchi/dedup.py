@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+from hashlib import blake2b
+from .app import db
+from .models import utcnow
+from .settings import TAMAGOTCHI_CALLBACK_DEDUP_SIZE
+
+
+class ProcessedCallback(db.Model):
+    """A callback message already verified and applied, by a digest of its
+    body (which includes the message id)"""
+
+    __tablename__ = "processed_callback"
+    digest = db.Column(db.String(32), primary_key=True)
+    processed_at = db.Column(db.DateTime())
+
+
+def callback_digest(content: str) -> str:
+    return blake2b(content.encode("UTF-8"), digest_size=16).hexdigest()
+
+
+class CallbackDeduplicator:
+    """Recognizes callbacks Shinkansen delivers more than once, so they can be
+    acknowledged without verifying and applying them again.
+
+    Only verified messages are recorded (in the processed_callback table), so a
+    copy with a bad signature can't stop the real message from being applied.
+    The digests of the last maxsize messages seen are also kept in memory, so
+    most duplicates are recognized without a query.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.n_unique = 0
+        self.n_duplicates = 0
+        self._digests = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, digest: str, count: bool = True) -> bool:
+        """Whether the message was already processed. Counted towards the
+        duplicate rate unless count is False (e.g: checking it again later)"""
+        with self._lock:
+            duplicate = digest in self._digests
+            if duplicate:
+                self._digests.move_to_end(digest)
+        if not duplicate and ProcessedCallback.query.get(digest) is not None:
+            duplicate = True
+            self.remember(digest)
+        if count:
+            with self._lock:
+                if duplicate:
+                    self.n_duplicates += 1
+                else:
+                    self.n_unique += 1
+        return duplicate
+
+    def record(self, digest: str):
+        """Adds the message to the session (but doesn't commit it). Call
+        remember() once committed"""
+        db.session.add(ProcessedCallback(digest=digest, processed_at=utcnow()))
+
+    def remember(self, digest: str):
+        with self._lock:
+            self._digests[digest] = True
+            self._digests.move_to_end(digest)
+            while len(self._digests) > self.maxsize:
+                self._digests.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.n_unique + self.n_duplicates
+            return {
+                "size": len(self._digests),
+                "maxsize": self.maxsize,
+                "unique": self.n_unique,
+                "duplicates": self.n_duplicates,
+                "duplicate_rate": self.n_duplicates / total if total else None,
+            }
+
+
+callback_dedup = CallbackDeduplicator(TAMAGOTCHI_CALLBACK_DEDUP_SIZE)
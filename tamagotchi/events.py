@@ -0,0 +1,252 @@
+"""Live status changes of payouts and payins, as server-sent events.
+
+Every change of status (or response status) is recorded as a StatusEvent row,
+in the same transaction that changes it (see record_status_changes()), no
+matter which process applied the callback. Each process then has a single
+thread reading the new rows every TAMAGOTCHI_EVENTS_POLL_INTERVAL seconds and
+handing them to its connected clients, so the database is polled once per
+process instead of once per client.
+
+Each stream holds a server thread, so there can be at most
+TAMAGOTCHI_EVENTS_MAX_CLIENTS of them per process, and they end after
+TAMAGOTCHI_EVENTS_STREAM_DURATION seconds. Browsers then reconnect with the
+id of the last event they got (Last-Event-ID), and get what they missed.
+"""
+
+import json
+import queue
+import threading
+import time
+from datetime import timedelta
+from typing import Optional
+from flask import Response, abort
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+from .app import app, db
+from .models import (
+    PersistedSingleTransactionPayoutMessage,
+    PersistedSingleTransactionPayinMessage,
+    utcnow,
+)
+from .settings import (
+    TAMAGOTCHI_EVENTS_POLL_INTERVAL,
+    TAMAGOTCHI_EVENTS_MAX_CLIENTS,
+    TAMAGOTCHI_EVENTS_STREAM_DURATION,
+)
+
+KINDS = {
+    PersistedSingleTransactionPayoutMessage: "payout",
+    PersistedSingleTransactionPayinMessage: "payin",
+}
+HEARTBEAT_INTERVAL = 15  # Keeps proxies from closing idle streams
+RETENTION = timedelta(hours=1)  # More than enough for clients to reconnect
+PRUNE_INTERVAL = 60
+MAX_QUEUED = 1000  # Per client. Slower clients are disconnected
+
+
+class StatusEvent(db.Model):
+    __tablename__ = "status_event"
+    # Ids of pruned events are never reused (as SQLite does by default), so
+    # clients can't take new events for ones they already got:
+    __table_args__ = {"sqlite_autoincrement": True}
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime(), index=True)
+    kind = db.Column(db.String(16))
+    object_id = db.Column(db.String(36))
+    status = db.Column(db.String(32))
+    response_status = db.Column(db.String(32))
+
+    def as_json_dict(self) -> dict:
+        return {
+            "id": self.object_id,
+            "status": self.status,
+            "response_status": self.response_status,
+        }
+
+
+@event.listens_for(Session, "before_flush")
+def record_status_changes(session, flush_context, instances):
+    now = utcnow()
+    rows = [
+        {
+            "created_at": now,
+            "kind": KINDS[type(obj)],
+            "object_id": obj.id,
+            "status": obj.status,
+            "response_status": obj.response_status,
+        }
+        for obj in session.dirty
+        if type(obj) in KINDS
+        and any(
+            inspect(obj).attrs[name].history.has_changes()
+            for name in ("status", "response_status")
+        )
+    ]
+    if rows:
+        session.connection().execute(StatusEvent.__table__.insert(), rows)
+
+
+class Subscription:
+    def __init__(self, kind: str) -> None:
+        self.kind = kind
+        self.queue = queue.Queue(MAX_QUEUED)
+
+
+class Broadcaster:
+    """Hands the status events recorded by any process to the subscriptions of
+    this one, reading them from a background thread started on the first
+    subscription"""
+
+    def __init__(self, poll_interval: float, max_clients: int) -> None:
+        self.poll_interval = poll_interval
+        self.max_clients = max_clients
+        self.n_published = 0
+        self.n_dropped = 0
+        self._subscriptions = set()
+        self._last_id = 0
+        self._pruned_at = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, kind: str) -> Optional[Subscription]:
+        """Returns a new subscription, or None if there are already too many"""
+        with self._lock:
+            if len(self._subscriptions) >= self.max_clients:
+                return None
+            if not self._subscriptions:
+                # Nobody got events while idle, so don't replay them:
+                self._last_id = latest_event_id()
+            subscription = Subscription(kind)
+            self._subscriptions.add(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="status-events", daemon=True
+                )
+                self._thread.start()
+            return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                with app.app_context():
+                    self._poll()
+                    if time.monotonic() - self._pruned_at > PRUNE_INTERVAL:
+                        self._pruned_at = time.monotonic()
+                        prune()
+            except Exception:
+                app.logger.exception("Error reading status events")
+
+    def _poll(self):
+        with self._lock:
+            if not self._subscriptions:
+                return
+            last_id = self._last_id
+        events = events_after(last_id)
+        with self._lock:
+            for status_event in events:
+                for subscription in list(self._subscriptions):
+                    if subscription.kind != status_event.kind:
+                        continue
+                    try:
+                        subscription.queue.put_nowait(status_event)
+                    except queue.Full:
+                        # The stream ends, and the client reconnects to catch up
+                        self._subscriptions.discard(subscription)
+                        subscription.queue = None
+                        self.n_dropped += 1
+                self.n_published += 1
+            if events:
+                self._last_id = max(self._last_id, events[-1].id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "clients": len(self._subscriptions),
+                "max_clients": self.max_clients,
+                "published": self.n_published,
+                "dropped_clients": self.n_dropped,
+            }
+
+
+def latest_event_id() -> int:
+    return db.session.query(func.max(StatusEvent.id)).scalar() or 0
+
+
+def events_after(event_id: int, kind: str = None, limit: int = 500) -> list:
+    query = StatusEvent.query.filter(StatusEvent.id > event_id)
+    if kind:
+        query = query.filter(StatusEvent.kind == kind)
+    events = query.order_by(StatusEvent.id).limit(limit).all()
+    # They outlive the session (e.g: handed to the threads streaming them):
+    for status_event in events:
+        db.session.expunge(status_event)
+    return events
+
+
+def prune():
+    StatusEvent.query.filter(StatusEvent.created_at < utcnow() - RETENTION).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+
+
+broadcaster = Broadcaster(
+    TAMAGOTCHI_EVENTS_POLL_INTERVAL, TAMAGOTCHI_EVENTS_MAX_CLIENTS
+)
+
+
+def format_event(status_event: StatusEvent) -> str:
+    data = json.dumps(status_event.as_json_dict())
+    return f"id: {status_event.id}\nevent: status\ndata: {data}\n\n"
+
+
+def stream(kind: str, last_event_id: str = None) -> Response:
+    """A response streaming the status changes of kind ("payout" or "payin")
+    from now on, or since last_event_id"""
+    subscription = broadcaster.subscribe(kind)
+    if subscription is None:
+        abort(503, "Too many event streams")
+    try:
+        # Read now, as the stream itself must not hold a database connection:
+        missed = (
+            events_after(int(last_event_id), kind)
+            if last_event_id and last_event_id.isdigit()
+            else []
+        )
+    except Exception:
+        broadcaster.unsubscribe(subscription)
+        raise
+
+    def generate():
+        yield "retry: 2000\n\n"
+        sent_id = 0
+        for status_event in missed:
+            yield format_event(status_event)
+            sent_id = status_event.id
+        deadline = time.monotonic() + TAMAGOTCHI_EVENTS_STREAM_DURATION
+        while time.monotonic() < deadline:
+            events = subscription.queue
+            if events is None:
+                return  # Dropped, see Broadcaster._poll()
+            try:
+                status_event = events.get(timeout=HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            if status_event.id > sent_id:  # Not sent already as missed
+                yield format_event(status_event)
+                sent_id = status_event.id
+
+    response = Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # Also when the client goes away mid-stream:
+    response.call_on_close(lambda: broadcaster.unsubscribe(subscription))
+    return response
@@ -0,0 +1,92 @@
+"""Exports of payouts and payins (e.g: for reconciliation), as CSV or NDJSON.
+
+Only the listing columns are read (the JSON messages are neither loaded nor
+parsed), in batches of BATCH_SIZE rows through a server-side cursor, and each
+chunk of output is handed out as soon as it's written. So memory use stays
+flat, however many rows are exported.
+"""
+
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Iterator
+from .models import (
+    PersistedSingleTransactionPayoutMessage,
+    PersistedSingleTransactionPayinMessage,
+)
+
+FORMATS = ("csv", "ndjson")
+MIMETYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+BATCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024  # Characters of output handed out at once
+
+COLUMNS = {
+    PersistedSingleTransactionPayoutMessage: (
+        "id",
+        "transaction_id",
+        "shinkansen_transaction_id",
+        "created_at",
+        "amount",
+        "currency",
+        "description",
+        "creditor_name",
+        "creditor_id_schema",
+        "creditor_id",
+        "creditor_email",
+        "creditor_bank",
+        "creditor_account",
+        "creditor_account_type",
+        "status",
+        "response_status",
+    ),
+    PersistedSingleTransactionPayinMessage: (
+        "id",
+        "transaction_id",
+        "shinkansen_transaction_id",
+        "created_at",
+        "amount",
+        "currency",
+        "description",
+        "status",
+        "response_status",
+    ),
+}
+
+
+def records(query, model) -> Iterator[dict]:
+    """The rows of a query over model, oldest first, as dicts of COLUMNS"""
+    names = COLUMNS[model]
+    rows = (
+        query.with_entities(*(getattr(model, name) for name in names))
+        .order_by(model.created_at, model.id)
+        .yield_per(BATCH_SIZE)
+    )
+    for row in rows:
+        yield {
+            name: value.isoformat() if isinstance(value, datetime) else value
+            for name, value in zip(names, row)
+        }
+
+
+def export(query, model, format: str) -> Iterator[str]:
+    """Yields the rows of a query over model as CSV or NDJSON, in chunks of
+    about CHUNK_SIZE characters"""
+    buffer = io.StringIO()
+    if format == "csv":
+        writer = csv.DictWriter(buffer, COLUMNS[model])
+        writer.writeheader()
+        write = writer.writerow
+    else:
+
+        def write(record: dict):
+            buffer.write(json.dumps(record, ensure_ascii=False))
+            buffer.write("\n")
+
+    for record in records(query, model):
+        write(record)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
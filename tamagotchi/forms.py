@@ -0,0 +1,83 @@
+import re
+from flask import request
+from shinkansen.common import FinancialInstitution, PersonId
+from shinkansen.payouts import PayoutTransaction, PayoutCreditor
+from shinkansen.payins import PayinTransaction, INTERACTIVE_PAYMENT
+from .constants import MX_BANKS_CODES
+from .settings import TAMAGOTCHI_ACCOUNTS, TAMAGOTCHI_MAX_AMOUNT
+
+
+def force_rut_format(raw_rut: str) -> str:
+    rut = re.sub(r"[^\dkK]+", "", raw_rut)
+    return rut[:-1] + "-" + rut[-1]
+
+
+def creditor_from_form_input(form: dict) -> PayoutCreditor:
+    name = form["name"]
+    id_schema = form["id_schema"]
+    if id_schema == "CLID":
+        id = force_rut_format(form["rut"])
+    else:
+        id = form["id"]
+    email = form["email"]
+    bank_id = form.get("bank_id")
+    financial_institution = FinancialInstitution(bank_id) if bank_id else None
+    account_number = form["account_number"]
+    account_type = form["account_type"]
+
+    if account_type == "clabe":
+        bank_code = account_number[:3]
+        fin_id = MX_BANKS_CODES.get(bank_code, None)
+        financial_institution = FinancialInstitution(fin_id) if fin_id else None
+
+    return PayoutCreditor(
+        name=name,
+        identification=PersonId(id_schema, id),
+        financial_institution=financial_institution,
+        account=account_number,
+        account_type=account_type,
+        email=email,
+    )
+
+
+def payout_transaction_from_form_input(form: dict) -> PayoutTransaction:
+    amount = re.sub(r"[^\d.]+", "", form["amount"])
+    description = form["description"]
+    currency = form["currency"] or "CLP"
+    if TAMAGOTCHI_MAX_AMOUNT and int(amount) > int(TAMAGOTCHI_MAX_AMOUNT):
+        amount = TAMAGOTCHI_MAX_AMOUNT
+    return PayoutTransaction(
+        currency=currency,
+        amount=amount,
+        description=description,
+        debtor=TAMAGOTCHI_ACCOUNTS[currency],
+        creditor=creditor_from_form_input(form),
+    )
+
+
+def payin_transaction_from_form_input(form: dict) -> PayinTransaction:
+    amount = re.sub(r"[^\d]+", "", form["amount"])
+    description = form["description"]
+    currency = form["currency"] or "CLP"
+    payin_transaction = PayinTransaction(
+        payin_type=INTERACTIVE_PAYMENT,
+        currency=currency,
+        amount=amount,
+        description=description,
+        creditor=TAMAGOTCHI_ACCOUNTS[currency],
+    )
+    add_interactive_payment_urls_to_transaction(payin_transaction)
+    return payin_transaction
+
+
+def add_interactive_payment_urls_to_transaction(payin_transaction: PayinTransaction):
+    payin_transaction.interactive_payment_success_redirect_url = (
+        request.root_url
+        + "payins/interactive-success?transaction_id="
+        + payin_transaction.transaction_id
+    )
+    payin_transaction.interactive_payment_failure_redirect_url = (
+        request.root_url
+        + "payins/interactive-failure?transaction_id="
+        + payin_transaction.transaction_id
+    )
@@ -0,0 +1,152 @@
+import heapq
+import itertools
+import threading
+import time
+import requests
+from .app import app
+from .histograms import Histogram
+from .settings import (
+    SHINKANSEN_FORWARD_URL,
+    TAMAGOTCHI_FORWARD_CONCURRENCY,
+    TAMAGOTCHI_FORWARD_TIMEOUT,
+    TAMAGOTCHI_FORWARD_MAX_ATTEMPTS,
+    TAMAGOTCHI_FORWARD_BACKOFF,
+)
+from .transport import transport
+
+
+class Forwarder:
+    """Forwards callback messages to another URL from a few background
+    threads, through the shared transport.
+
+    Each message is POSTed as received (same body and signature), with a
+    timeout. Connection errors, timeouts, 429s and 5xx are retried up to
+    max_attempts times, waiting backoff * 2 ** (attempt - 1) seconds in
+    between. The queue lives in memory: messages not forwarded yet when the
+    process stops are lost.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        concurrency: int,
+        timeout: float,
+        max_attempts: int,
+        backoff: float,
+    ) -> None:
+        self.url = url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.n_forwarded = 0
+        self.n_retries = 0
+        self.n_failed = 0
+        self.n_in_flight = 0
+        self.latencies = Histogram()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def submit(self, content: str, signature: str):
+        self._schedule(time.monotonic(), (content, signature, 1, time.monotonic()))
+
+    def _schedule(self, due: float, item: tuple):
+        with self._condition:
+            heapq.heappush(self._queue, (due, next(self._sequence), item))
+            if not self._threads:
+                self._threads = [
+                    threading.Thread(
+                        target=self._run, name=f"forwarder-{i}", daemon=True
+                    )
+                    for i in range(self.concurrency)
+                ]
+                for thread in self._threads:
+                    thread.start()
+            self._condition.notify()
+
+    def _next(self) -> tuple:
+        with self._condition:
+            while True:
+                if self._queue:
+                    timeout = self._queue[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        self.n_in_flight += 1
+                        return heapq.heappop(self._queue)[2]
+                else:
+                    timeout = None
+                self._condition.wait(timeout)
+
+    def _run(self):
+        while True:
+            item = self._next()
+            try:
+                self._forward(*item)
+            except Exception:
+                app.logger.exception(f"Error forwarding to {self.url}")
+            finally:
+                with self._condition:
+                    self.n_in_flight -= 1
+
+    def _forward(self, content: str, signature: str, attempt: int, submitted_at):
+        start = time.monotonic()
+        try:
+            response = transport.post(
+                self.url,
+                data=content.encode("UTF-8"),
+                headers={
+                    "Content-Type": "application/json",
+                    "Shinkansen-JWS-Signature": signature,
+                },
+                timeout=self.timeout,
+            )
+            error = None if response.ok else f"HTTP Status: {response.status_code}"
+            retryable = response.status_code == 429 or response.status_code >= 500
+        except requests.RequestException as e:
+            error, retryable = repr(e), True
+        if error is None:
+            with self._condition:
+                self.n_forwarded += 1
+                # From submission, so time spent queued and retrying counts:
+                self.latencies.record((time.monotonic() - submitted_at) * 1000)
+            return
+        if retryable and attempt < self.max_attempts:
+            with self._condition:
+                self.n_retries += 1
+            app.logger.warning(
+                f"Error forwarding to {self.url} (attempt {attempt}): {error}"
+            )
+            due = start + self.backoff * 2 ** (attempt - 1)
+            self._schedule(due, (content, signature, attempt + 1, submitted_at))
+        else:
+            with self._condition:
+                self.n_failed += 1
+            app.logger.error(
+                f"Gave up forwarding to {self.url} after {attempt} attempts: {error}"
+            )
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "url": self.url,
+                "backlog": len(self._queue),
+                "in_flight": self.n_in_flight,
+                "forwarded": self.n_forwarded,
+                "retries": self.n_retries,
+                "failed": self.n_failed,
+                "latency_ms": self.latencies.summary(),
+            }
+
+
+forwarder = (
+    Forwarder(
+        url=SHINKANSEN_FORWARD_URL,
+        concurrency=TAMAGOTCHI_FORWARD_CONCURRENCY,
+        timeout=TAMAGOTCHI_FORWARD_TIMEOUT,
+        max_attempts=TAMAGOTCHI_FORWARD_MAX_ATTEMPTS,
+        backoff=TAMAGOTCHI_FORWARD_BACKOFF,
+    )
+    if SHINKANSEN_FORWARD_URL
+    else None
+)
@@ -0,0 +1,116 @@
+import json
+import math
+import time
+from typing import Optional
+
+
+class Histogram:
+    """A log-linear histogram of latencies in milliseconds, in the spirit of
+    HdrHistogram.
+
+    Values are counted in buckets whose width is a fixed fraction of their
+    value (SUB_BUCKETS per power of two), so percentiles have a bounded relative
+    error (~4%) and the size stays bounded (a few hundred buckets at most) no
+    matter how many values are recorded.
+    """
+
+    SUB_BUCKETS = 16
+    LOWEST = 0.01  # ms. Anything at or below this goes to the first bucket
+
+    def __init__(
+        self,
+        counts: dict[int, int] = None,
+        total: float = 0.0,
+        max: Optional[float] = None,
+    ) -> None:
+        self.counts = counts or {}
+        self.total = total
+        self.max = max
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts.values())
+
+    @classmethod
+    def bucket(cls, value: float) -> int:
+        if value <= cls.LOWEST:
+            return 0
+        return math.floor(math.log2(value / cls.LOWEST) * cls.SUB_BUCKETS) + 1
+
+    @classmethod
+    def upper_bound(cls, bucket: int) -> float:
+        return cls.LOWEST * 2 ** (bucket / cls.SUB_BUCKETS)
+
+    def record(self, value: float):
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other: "Histogram"):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.total += other.total
+        if other.max is not None:
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        count = self.count
+        if not count:
+            return None
+        target = max(1, math.ceil(count * percentile / 100))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= target:
+                return min(self.upper_bound(bucket), self.max)
+
+    def summary(self) -> dict:
+        count = self.count
+        return {
+            "count": count,
+            "mean": self.total / count if count else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+    def as_json(self) -> str:
+        return json.dumps({"counts": self.counts, "total": self.total, "max": self.max})
+
+    @classmethod
+    def from_json(cls, json_string: str) -> "Histogram":
+        json_dict = json.loads(json_string)
+        return cls(
+            counts={int(k): v for k, v in json_dict["counts"].items()},
+            total=json_dict["total"],
+            max=json_dict["max"],
+        )
+
+
+class Timeline:
+    """Counts of events per (unix) second"""
+
+    def __init__(self, counts: dict[int, int] = None) -> None:
+        self.counts = counts or {}
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts.values())
+
+    def record(self, at: float = None):
+        second = int(at if at is not None else time.time())
+        self.counts[second] = self.counts.get(second, 0) + 1
+
+    def merge(self, other: "Timeline"):
+        for second, count in other.counts.items():
+            self.counts[second] = self.counts.get(second, 0) + count
+
+    def as_json(self) -> str:
+        return json.dumps({"counts": self.counts})
+
+    @classmethod
+    def from_json(cls, json_string: str) -> "Timeline":
+        counts = json.loads(json_string)["counts"]
+        return cls(counts={int(k): v for k, v in counts.items()})
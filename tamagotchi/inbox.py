@@ -0,0 +1,288 @@
+"""A durable inbox for Shinkansen callbacks.
+
+With TAMAGOTCHI_CALLBACK_INBOX set, /shinkansen/messages/ only stores the raw
+body and signature of each message and acknowledges it. A background worker
+then verifies, routes and applies the stored messages in batches.
+
+Delivery is at-least-once: a message is claimed for TAMAGOTCHI_INBOX_LEASE
+seconds, and claimed again if it wasn't processed by then (e.g: the process
+died), up to TAMAGOTCHI_INBOX_MAX_ATTEMPTS times. Applying a response twice
+leaves payouts and payins as applying it once, but a test suite may record it
+twice.
+"""
+
+import threading
+import uuid
+from datetime import timedelta
+from typing import Optional
+from sqlalchemy import func, or_, and_, update
+from .app import app, db
+from .callbacks import (
+    RoutedMessage,
+    apply_response_message,
+    verified_response_message,
+)
+from .dedup import callback_dedup, callback_digest
+from .models import utcnow
+from .settings import (
+    TAMAGOTCHI_CALLBACK_INBOX,
+    TAMAGOTCHI_INBOX_BATCH_SIZE,
+    TAMAGOTCHI_INBOX_LEASE,
+    TAMAGOTCHI_INBOX_MAX_ATTEMPTS,
+    TAMAGOTCHI_INBOX_POLL_INTERVAL,
+)
+
+# Statuses:
+QUEUED = "queued"
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+
+
+class InboxMessage(db.Model):
+    __tablename__ = "inbox_message"
+    __table_args__ = (db.Index("ix_inbox_message_status_id", "status", "id"),)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    received_at = db.Column(db.DateTime())
+    content = db.Column(db.Text())
+    signature = db.Column(db.Text())
+    status = db.Column(db.String(16))
+    claim = db.Column(db.String(36))
+    claimed_at = db.Column(db.DateTime())
+    attempts = db.Column(db.Integer, default=0)
+    processed_at = db.Column(db.DateTime())
+    error = db.Column(db.Text())
+
+
+def append(content: str, signature: str) -> int:
+    """Stores a message (committing it) and wakes up the worker"""
+    message = InboxMessage(
+        received_at=utcnow(),
+        content=content,
+        signature=signature,
+        status=QUEUED,
+        attempts=0,
+    )
+    db.session.add(message)
+    db.session.commit()
+    worker.wake_up()
+    return message.id
+
+
+def claimable(now):
+    stale = now - timedelta(seconds=TAMAGOTCHI_INBOX_LEASE)
+    return or_(
+        InboxMessage.status == QUEUED,
+        and_(InboxMessage.status == PROCESSING, InboxMessage.claimed_at < stale),
+    )
+
+
+def claim_batch(limit: int) -> list[InboxMessage]:
+    """Claims (and commits the claim of) up to limit messages, oldest first"""
+    now = utcnow()
+    db.session.execute(
+        update(InboxMessage)
+        .where(claimable(now), InboxMessage.attempts >= TAMAGOTCHI_INBOX_MAX_ATTEMPTS)
+        .values(
+            status=FAILED,
+            error=f"Not processed after {TAMAGOTCHI_INBOX_MAX_ATTEMPTS} attempts",
+        )
+        .execution_options(synchronize_session=False)
+    )
+    ids = [
+        id
+        for (id,) in db.session.query(InboxMessage.id)
+        .filter(claimable(now))
+        .order_by(InboxMessage.id)
+        .limit(limit)
+    ]
+    claim = str(uuid.uuid4())
+    if ids:
+        # Claimed with a conditional update, so messages claimed by some other
+        # process in the meantime are left alone:
+        db.session.execute(
+            update(InboxMessage)
+            .where(InboxMessage.id.in_(ids), claimable(now))
+            .values(
+                status=PROCESSING,
+                claim=claim,
+                claimed_at=now,
+                attempts=InboxMessage.attempts + 1,
+            )
+            .execution_options(synchronize_session=False)
+        )
+    db.session.commit()
+    if not ids:
+        return []
+    return (
+        InboxMessage.query.filter(InboxMessage.claim == claim)
+        .order_by(InboxMessage.id)
+        .all()
+    )
+
+
+def apply(message: InboxMessage) -> tuple[str, Optional[RoutedMessage]]:
+    """Verifies and applies a message, marking it as done (or as failed if it
+    is invalid) without committing. Returns its digest and, if it was applied,
+    what to call after_commit() on (see committed())"""
+    digest = callback_digest(message.content)
+    if callback_dedup.seen(digest, count=False):
+        # Queued again before the first copy was processed:
+        message.status = DONE
+        message.processed_at = utcnow()
+        return digest, None
+    try:
+        response_message = verified_response_message(message.content, message.signature)
+    except Exception as e:
+        app.logger.error(f"Invalid inbox message {message.id}: {e}")
+        message.status = FAILED
+        message.error = f"{type(e).__name__}: {e}"
+        return digest, None
+    routed = apply_response_message(
+        response_message, message.content, message.signature
+    )
+    callback_dedup.record(digest)
+    message.status = DONE
+    message.processed_at = utcnow()
+    return digest, routed
+
+
+def committed(applied: list[tuple[str, Optional[RoutedMessage]]]):
+    """Remembers the digests of messages applied (and committed), and forwards
+    those with unknown transactions. Never before their commit, as a message
+    applied again after a rollback would be forwarded twice"""
+    for digest, routed in applied:
+        callback_dedup.remember(digest)
+        if routed:
+            routed.after_commit()
+
+
+def process_batch(limit: int = None) -> int:
+    """Claims and applies a batch of messages with a single commit, returning
+    how many were claimed.
+
+    If applying the batch fails, it's rolled back (so nothing of it was
+    forwarded or counted yet) and its messages are applied again one at a time,
+    so a bad one doesn't hold back the rest.
+    """
+    messages = claim_batch(limit or TAMAGOTCHI_INBOX_BATCH_SIZE)
+    if not messages:
+        return 0
+    ids = [message.id for message in messages]
+    try:
+        applied = [apply(message) for message in messages]
+        db.session.commit()
+    except Exception:
+        app.logger.exception("Error applying inbox batch, retrying one by one")
+        db.session.rollback()
+        for id in ids:
+            message = InboxMessage.query.get(id)
+            try:
+                applied = [apply(message)]
+                db.session.commit()
+            except Exception as e:
+                app.logger.exception(f"Error applying inbox message {id}")
+                db.session.rollback()
+                # Left as processing, so it's retried once its lease expires:
+                message = InboxMessage.query.get(id)
+                message.error = f"{type(e).__name__}: {e}"
+                db.session.commit()
+                continue
+            committed(applied)
+    else:
+        committed(applied)
+    worker.record_processed(len(ids))
+    return len(ids)
+
+
+def drain() -> int:
+    """Processes every claimable message, returning how many there were"""
+    total = 0
+    while n := process_batch():
+        total += n
+    return total
+
+
+class InboxWorker:
+    """Processes inbox messages from a background thread, started when the
+    process boots (see server.py) or on its first request or append(), so
+    messages left pending by a restart don't wait for a new one.
+
+    It wakes up when messages are appended, and otherwise polls every
+    TAMAGOTCHI_INBOX_POLL_INTERVAL seconds (to pick up messages appended by
+    other processes or whose lease expired).
+    """
+
+    def __init__(self) -> None:
+        self.n_processed = 0
+        self.n_batches = 0
+        self._thread = None
+        self._wake_up = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="inbox-worker", daemon=True
+                )
+                self._thread.start()
+
+    def wake_up(self):
+        self.start()
+        self._wake_up.set()
+
+    def record_processed(self, n: int):
+        with self._lock:
+            self.n_processed += n
+            self.n_batches += 1
+
+    def _run(self):
+        while True:
+            self._wake_up.wait(TAMAGOTCHI_INBOX_POLL_INTERVAL)
+            self._wake_up.clear()
+            try:
+                with app.app_context():
+                    drain()
+            except Exception:
+                app.logger.exception("Error processing the inbox")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "worker_running": self._thread is not None,
+                "processed": self.n_processed,
+                "batches": self.n_batches,
+            }
+
+
+worker = InboxWorker()
+
+
+@app.before_request
+def start_worker():
+    if TAMAGOTCHI_CALLBACK_INBOX:
+        worker.start()
+
+
+def stats() -> dict:
+    counts = dict(
+        db.session.query(InboxMessage.status, func.count()).group_by(
+            InboxMessage.status
+        )
+    )
+    oldest_pending = (
+        db.session.query(func.min(InboxMessage.received_at))
+        .filter(InboxMessage.status.in_((QUEUED, PROCESSING)))
+        .scalar()
+    )
+    return {
+        "depth": counts.get(QUEUED, 0) + counts.get(PROCESSING, 0),
+        "oldest_pending_seconds": (utcnow() - oldest_pending).total_seconds()
+        if oldest_pending
+        else None,
+        "by_status": counts,
+        **worker.stats(),
+    }
@@ -0,0 +1,170 @@
+"""Where requests spend their time, and what happens to callbacks.
+
+Phases (building messages, signing, HTTP calls to Shinkansen, commits and
+template rendering, plus each request as a whole) are timed into a Histogram
+per endpoint and phase, and events (e.g: callbacks received) are counted.
+/metrics serves both in the Prometheus text format.
+
+Each thread records into histograms and counters of its own, so the request
+path never waits for a lock (a thread takes one only to register itself, the
+first time it records something). Scrapes merge copies of all of them.
+Metrics are per process: with several workers, each one reports its own
+(labeled with its pid).
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+import flask
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from .app import app
+from .histograms import Histogram
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self._local = threading.local()
+        self._stores = []
+        self._lock = threading.Lock()
+
+    def _store(self) -> tuple[dict, dict]:
+        store = getattr(self._local, "store", None)
+        if store is None:
+            store = self._local.store = ({}, {})  # Histograms and counters
+            with self._lock:
+                self._stores.append(store)
+        return store
+
+    def record(self, endpoint: str, phase: str, ms: float):
+        histograms = self._store()[0]
+        histogram = histograms.get((endpoint, phase))
+        if histogram is None:
+            histogram = histograms[(endpoint, phase)] = Histogram()
+        histogram.record(ms)
+
+    def count(self, name: str, n: int = 1):
+        counters = self._store()[1]
+        counters[name] = counters.get(name, 0) + n
+
+    def snapshot(self) -> tuple[dict, dict]:
+        """Merged copies of every thread's histograms and counters"""
+        with self._lock:
+            stores = list(self._stores)
+        histograms, counters = {}, {}
+        for thread_histograms, thread_counters in stores:
+            # Copied at once (under the GIL), as their threads keep recording:
+            for key, histogram in list(thread_histograms.items()):
+                copy = Histogram(dict(histogram.counts), histogram.total, histogram.max)
+                histograms.setdefault(key, Histogram()).merge(copy)
+            for name, value in list(thread_counters.items()):
+                counters[name] = counters.get(name, 0) + value
+        return histograms, counters
+
+
+recorder = Recorder()
+_local = threading.local()
+
+
+def current_endpoint() -> str:
+    if has_request_context():
+        return request.endpoint or "unknown"
+    return getattr(_local, "endpoint", None) or "background"
+
+
+@contextmanager
+def endpoint(name: str):
+    """Records the phases of what runs inside (outside of requests) as those
+    of endpoint name"""
+    previous = getattr(_local, "endpoint", None)
+    _local.endpoint = name
+    try:
+        yield
+    finally:
+        _local.endpoint = previous
+
+
+@contextmanager
+def phase(name: str, endpoint: Optional[str] = None):
+    """Times what runs inside as a phase of endpoint (the current request's,
+    by default)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        recorder.record(endpoint or current_endpoint(), name, elapsed)
+
+
+def count(name: str, n: int = 1):
+    recorder.count(name, n)
+
+
+def render_template(template_name: str, **context) -> str:
+    with phase("render"):
+        return flask.render_template(template_name, **context)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.perf_counter()
+
+
+@app.teardown_request
+def record_request_time(exception=None):
+    started_at = g.pop("request_started_at", None)
+    if started_at is not None:
+        elapsed = (time.perf_counter() - started_at) * 1000
+        recorder.record(current_endpoint(), "request", elapsed)
+
+
+# Commits are timed from any session (including the final flush):
+@event.listens_for(Session, "before_commit")
+def start_commit_timer(session):
+    session.info["commit_started_at"] = time.perf_counter()
+
+
+@event.listens_for(Session, "after_commit")
+def record_commit_time(session):
+    started_at = session.info.pop("commit_started_at", None)
+    if started_at is not None:
+        elapsed = (time.perf_counter() - started_at) * 1000
+        recorder.record(current_endpoint(), "commit", elapsed)
+
+
+def prometheus_text() -> str:
+    histograms, counters = recorder.snapshot()
+    pid = os.getpid()
+    lines = [
+        "# HELP tamagotchi_phase_seconds Time spent in each phase, by endpoint",
+        "# TYPE tamagotchi_phase_seconds histogram",
+    ]
+    for (endpoint_name, phase_name), histogram in sorted(histograms.items()):
+        labels = f'pid="{pid}",endpoint="{endpoint_name}",phase="{phase_name}"'
+        for le in BUCKETS:
+            # Within the histogram's precision (see Histogram):
+            below = sum(
+                n
+                for bucket, n in histogram.counts.items()
+                if Histogram.upper_bound(bucket) <= le * 1000
+            )
+            lines.append(
+                f'tamagotchi_phase_seconds_bucket{{{labels},le="{le}"}} {below}'
+            )
+        n = histogram.count
+        lines += [
+            f'tamagotchi_phase_seconds_bucket{{{labels},le="+Inf"}} {n}',
+            f"tamagotchi_phase_seconds_sum{{{labels}}} {histogram.total / 1000}",
+            f"tamagotchi_phase_seconds_count{{{labels}}} {n}",
+        ]
+    for name, value in sorted(counters.items()):
+        lines += [
+            f"# TYPE tamagotchi_{name}_total counter",
+            f'tamagotchi_{name}_total{{pid="{pid}"}} {value}',
+        ]
+    return "\n".join(lines) + "\n"
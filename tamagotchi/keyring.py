@@ -0,0 +1,190 @@
+import os
+import threading
+import time
+from base64 import b64decode
+from hashlib import sha256
+from typing import Optional
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+from jwcrypto.jwk import JWK
+from jwcrypto.jws import JWS, InvalidJWSSignature
+from shinkansen.common import SHINKANSEN
+from shinkansen.jws import CertificateNotWhitelisted, InvalidJWS, InvalidSignature
+from shinkansen.responses import ResponseMessage, UnexpectedSender, UnexpectedReceiver
+from .settings import (
+    TAMAGOTCHI,
+    SHINKANSEN_CERTIFICATES_FILE,
+    SHINKANSEN_CERTIFICATES_RELOAD_INTERVAL,
+)
+from .utils import required_env
+
+CERTIFICATE_ENV_VARS = ("SHINKANSEN_CERTIFICATE_1", "SHINKANSEN_CERTIFICATE_2")
+
+
+def thumbprint(der: bytes) -> str:
+    """The SHA-256 thumbprint of a DER certificate, as in a x5t#S256 header"""
+    return sha256(der).hexdigest()
+
+
+def certificates_from_pem_bytes(pem_bytes: bytes) -> list[x509.Certificate]:
+    """Loads every certificate in a PEM bundle"""
+    return x509.load_pem_x509_certificates(pem_bytes)
+
+
+class KeyRing:
+    """The certificates Shinkansen may sign its messages with, indexed by
+    thumbprint.
+
+    Verifying a signature looks up the certificate of its x5c header directly
+    (rejecting unknown ones before checking the signature) and uses a public
+    key imported once per certificate. Certificates come from the
+    SHINKANSEN_CERTIFICATE_1 and _2 environment variables and the PEM bundle at
+    SHINKANSEN_CERTIFICATES_FILE, loaded on first use. Both are checked for
+    changes (at most every reload_interval seconds) when verifying, so
+    certificates can be rotated without restarting.
+    """
+
+    def __init__(self, path: Optional[str], reload_interval: float) -> None:
+        self.path = path
+        self.reload_interval = reload_interval
+        self.n_reloads = 0
+        self.n_verified = 0
+        self.n_rejected = 0
+        self._sources = None
+        self._checked_at = 0
+        self._added = {}
+        # Replaced (not mutated) on reload, so verify() doesn't need the lock:
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def _read_sources(self) -> tuple:
+        pems = tuple(os.getenv(name) for name in CERTIFICATE_ENV_VARS)
+        mtime = os.stat(self.path).st_mtime_ns if self.path else None
+        return pems, mtime
+
+    def reload(self, force: bool = True) -> bool:
+        """Loads the certificates again if they changed (or if forced).
+        Returns whether they were loaded"""
+        with self._lock:
+            self._checked_at = time.monotonic()
+            sources = self._read_sources()
+            if sources == self._sources and not force:
+                return False
+            pems, _ = sources
+            certificates = [
+                certificate
+                for pem in pems
+                if pem
+                for certificate in certificates_from_pem_bytes(pem.encode("UTF-8"))
+            ]
+            if self.path:
+                with open(self.path, "rb") as f:
+                    certificates += certificates_from_pem_bytes(f.read())
+            keys = {
+                **{
+                    thumbprint(der): (certificate, jwk)
+                    for certificate, der, jwk in map(self._entry, certificates)
+                },
+                **self._added,
+            }
+            if not keys:
+                required_env(CERTIFICATE_ENV_VARS[0])
+            self._keys = keys
+            self._sources = sources
+            self.n_reloads += 1
+            return True
+
+    def _entry(self, certificate: x509.Certificate) -> tuple:
+        der = certificate.public_bytes(serialization.Encoding.DER)
+        jwk = JWK()
+        jwk.import_from_pyca(certificate.public_key())
+        return certificate, der, jwk
+
+    def add(self, certificate: x509.Certificate) -> str:
+        """Trusts a certificate until removed, returning its thumbprint"""
+        certificate, der, jwk = self._entry(certificate)
+        key_id = thumbprint(der)
+        with self._lock:
+            self._added[key_id] = (certificate, jwk)
+            self._keys = {**self._keys, key_id: (certificate, jwk)}
+        return key_id
+
+    def remove(self, key_id: str):
+        with self._lock:
+            self._added.pop(key_id, None)
+            self._keys = {k: v for k, v in self._keys.items() if k != key_id}
+
+    def require(self):
+        """Loads the certificates, unless already loaded (raising if they are
+        missing or invalid)"""
+        if self._sources is None:
+            self.reload()
+
+    def _reload_if_due(self):
+        if self._sources is None:
+            self.reload()
+            return
+        if time.monotonic() - self._checked_at < self.reload_interval:
+            return
+        try:
+            self.reload(force=False)
+        except Exception:
+            # Keep verifying with the certificates we have:
+            pass
+
+    def verify(self, payload: str, detached_jws: str):
+        """Verifies a detached JWS of the payload, raising the same exceptions
+        as shinkansen.jws.verify_detached()"""
+        self._reload_if_due()
+        jws = JWS()
+        try:
+            jws.deserialize(detached_jws)
+            x5c = jws.jose_header.get("x5c")
+            der = b64decode(x5c[0]) if x5c else None
+        except Exception as e:
+            raise InvalidJWS(f"Invalid JWS: {e}") from e
+        if not der:
+            raise InvalidJWS("x5c not found in JWS header")
+        key = self._keys.get(thumbprint(der))
+        if key is None:
+            self.n_rejected += 1
+            raise CertificateNotWhitelisted("Certificate not in the key ring")
+        try:
+            jws.verify(key[1], alg="PS256", detached_payload=payload)
+        except InvalidJWSSignature as e:
+            self.n_rejected += 1
+            raise InvalidSignature("Invalid JWS signature") from e
+        self.n_verified += 1
+
+    def verify_response_message(self, message: ResponseMessage, signature: str):
+        """Does what message.verify() does, using the key ring"""
+        self.verify(message.original_json, signature)
+        if message.header.sender != SHINKANSEN:
+            raise UnexpectedSender(
+                "Expected sender %s, got %s" % (SHINKANSEN, message.header.sender)
+            )
+        if message.header.receiver != TAMAGOTCHI:
+            raise UnexpectedReceiver(
+                "Expected receiver %s, got %s" % (TAMAGOTCHI, message.header.receiver)
+            )
+
+    def stats(self) -> dict:
+        return {
+            "certificates": [
+                {
+                    "thumbprint": key_id,
+                    "subject": certificate.subject.rfc4514_string(),
+                    "not_valid_after": certificate.not_valid_after.isoformat(),
+                }
+                for key_id, (certificate, _) in self._keys.items()
+            ],
+            "file": self.path,
+            "reloads": self.n_reloads,
+            "verified": self.n_verified,
+            "rejected": self.n_rejected,
+        }
+
+
+shinkansen_keyring = KeyRing(
+    SHINKANSEN_CERTIFICATES_FILE, SHINKANSEN_CERTIFICATES_RELOAD_INTERVAL
+)
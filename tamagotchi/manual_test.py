@@ -1,12 +1,9 @@
 from .settings import (
     TAMAGOTCHI_ACCOUNTS,
     TAMAGOTCHI,
-    SHINKANSEN_BASE_URL,
-    TAMAGOTCHI_CERTIFICATE_PRIVATE_KEY,
-    TAMAGOTCHI_CERTIFICATE,
-    TAMAGOTCHI_API_KEY,
     TAMAGOTCHI_MANUAL_TEST_TARGETS,
 )
+from .transport import sign_and_send
 from shinkansen.payouts import PayoutMessage, PayoutTransaction, PayoutCreditor
 from shinkansen.common import (
     CLP,
@@ -49,12 +46,7 @@ def messages(repetitions=1):
 
 
 def send(message):
-    return message.sign_and_send(
-        TAMAGOTCHI_CERTIFICATE_PRIVATE_KEY,
-        TAMAGOTCHI_CERTIFICATE,
-        TAMAGOTCHI_API_KEY,
-        base_url=SHINKANSEN_BASE_URL,
-    )
+    return sign_and_send(message)
 
 
 def send_in_sequence(messages):
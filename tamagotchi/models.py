@@ -1,118 +1,223 @@
+from datetime import datetime, timezone
+from typing import Optional
+from sqlalchemy.orm import relationship
 from .app import db
 from shinkansen.payouts import PayoutMessage, PayoutTransaction
 from shinkansen.payins import PayinMessage, PayinTransaction
-from shinkansen.responses import ResponseMessage, PayoutResponse, PayinResponse
+from shinkansen.responses import PayoutResponse, PayinResponse
+from .parsing import (
+    memoized,
+    parsed_payout_message,
+    parsed_payin_message,
+    responses_by_shinkansen_transaction_id,
+)
+
+
+def utc_datetime_from_isoformat(isoformat: str) -> datetime:
+    """Parses an ISO8601 string as a naive UTC datetime, which is what we store"""
+    parsed = datetime.fromisoformat(isoformat.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        return parsed
+    return parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def utcnow() -> datetime:
+    """The current time as a naive UTC datetime"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def isoformat_from_utc_datetime(utc_datetime: datetime) -> str:
+    return utc_datetime.replace(tzinfo=timezone.utc).isoformat(sep=" ")
+
+
+class PersistedPayoutMessage(db.Model):
+    """A payout message with several transactions (see batching.py), stored
+    once. Each of its transactions is persisted and tracked as its own
+    PersistedSingleTransactionPayoutMessage row pointing to it"""
+
+    __tablename__ = "persisted_payout_message"
+    id = db.Column(db.String(36), primary_key=True)
+    created_at = db.Column(db.DateTime())
+    content = db.Column(db.Text())
+    signature = db.Column(db.Text())
+    payouts = relationship(
+        "PersistedSingleTransactionPayoutMessage", back_populates="batch"
+    )
+
+    def __init__(self, message: PayoutMessage, signature: str) -> None:
+        super().__init__()
+        self.id = message.id
+        self.created_at = utc_datetime_from_isoformat(message.header.creation_date)
+        self.content = message.as_json()
+        self.signature = signature
 
 
 class PersistedSingleTransactionPayoutMessage(db.Model):
+    # Listings are sorted by (created_at, id) and usually filtered by one of
+    # status, currency or creditor. See pagination.keyset_page()
+    __table_args__ = (
+        db.Index("ix_payout_created_at_id", "created_at", "id"),
+        db.Index("ix_payout_status_created_at", "status", "created_at", "id"),
+        db.Index("ix_payout_currency_created_at", "currency", "created_at", "id"),
+        db.Index("ix_payout_creditor_id_created_at", "creditor_id", "created_at", "id"),
+    )
     id = db.Column(db.String(36), primary_key=True)
-    shinkansen_transaction_id = db.Column(db.String(36))
+    shinkansen_transaction_id = db.Column(db.String(36), index=True)
+    # A payout sent in its own message stores it in content and signature. One
+    # sent along with others (see batching.py) has the transaction id as its
+    # id, and its message in batch:
     content = db.Column(db.Text())
     signature = db.Column(db.Text())
+    batch_id = db.Column(
+        db.String(36), db.ForeignKey("persisted_payout_message.id"), index=True
+    )
+    batch = relationship("PersistedPayoutMessage", back_populates="payouts")
     response_content = db.Column(db.Text())
     response_signature = db.Column(db.Text())
 
+    # Denormalized from content and response_content, so we can list and
+    # filter payouts without parsing JSON. See fill_columns()
+    transaction_id = db.Column(db.String(36), index=True)
+    amount = db.Column(db.String(32))
+    currency = db.Column(db.String(3), index=True)
+    created_at = db.Column(db.DateTime(), index=True)
+    description = db.Column(db.Text())
+    creditor_name = db.Column(db.Text())
+    creditor_id_schema = db.Column(db.String(16))
+    creditor_id = db.Column(db.String(64), index=True)
+    creditor_email = db.Column(db.Text())
+    creditor_bank = db.Column(db.String(64), index=True)
+    creditor_account = db.Column(db.String(64))
+    creditor_account_type = db.Column(db.String(32))
+    status = db.Column(db.String(32), index=True, default="pending")
+    response_status = db.Column(db.String(32), index=True)
+
     def __repr__(self) -> str:
-        return "<Payout %r>" % self.content
+        return "<Payout %r>" % self.message_content
 
     def __init__(
-        self, message: PayoutMessage, signature: str, shinkansen_transaction_id: str
+        self,
+        message: PayoutMessage,
+        signature: str,
+        shinkansen_transaction_id: str,
+        batch: Optional[PersistedPayoutMessage] = None,
+        transaction: Optional[PayoutTransaction] = None,
     ) -> None:
+        """Persists the only transaction of message or, if message was
+        persisted as a batch, the given transaction of it"""
         super().__init__()
-        self.id = message.id
-        self.content = message.as_json()
-        self.signature = signature
+        if batch is None:
+            self.id = message.id
+            self.content = message.as_json()
+            self.signature = signature
+        else:
+            self.id = transaction.transaction_id
+            self.batch = batch
         self.shinkansen_transaction_id = shinkansen_transaction_id
-
-    @property
-    def message(self) -> PayoutMessage:
-        return PayoutMessage.from_json(self.content)
-
-    @property
-    def status(self) -> str:
-        return (
-            self.response.shinkansen_transaction_status if self.response else "pending"
+        self.fill_columns(message, transaction)
+
+    def fill_columns(
+        self,
+        message: PayoutMessage = None,
+        transaction: Optional[PayoutTransaction] = None,
+    ):
+        """Copies the fields we list and filter by into their own columns"""
+        message = message or self.message
+        transaction = transaction or message.transactions[0]
+        creditor = transaction.creditor
+        self.transaction_id = transaction.transaction_id
+        self.amount = transaction.amount
+        self.currency = transaction.currency
+        self.created_at = utc_datetime_from_isoformat(message.header.creation_date)
+        self.description = transaction.description
+        self.creditor_name = creditor.name
+        self.creditor_id_schema = creditor.identification.id_schema
+        self.creditor_id = creditor.identification.id
+        self.creditor_email = creditor.email
+        self.creditor_bank = (
+            creditor.financial_institution.fin_id
+            if creditor.financial_institution
+            else None
         )
+        self.creditor_account = creditor.account
+        self.creditor_account_type = creditor.account_type
+        response = self.response
+        self.status = response.shinkansen_transaction_status if response else "pending"
+        self.response_status = response.response_status if response else None
+
+    def apply_response(
+        self, response: PayoutResponse, response_content: str, response_signature: str
+    ):
+        self.response_content = response_content
+        self.response_signature = response_signature
+        self.status = response.shinkansen_transaction_status
+        self.response_status = response.response_status
 
     @property
-    def response_status(self) -> str:
-        return self.response.response_status if self.response else None
+    def message_content(self) -> str:
+        return self.batch.content if self.batch_id else self.content
 
     @property
-    def transaction(self) -> PayoutTransaction:
-        return self.message.transactions[0]
+    def message_signature(self) -> str:
+        return self.batch.signature if self.batch_id else self.signature
 
     @property
-    def transaction_id(self) -> str:
-        return self.transaction.transaction_id
+    def message(self) -> PayoutMessage:
+        return memoized(self, self.message_content, parsed_payout_message)
 
     @property
-    def amount(self):
-        return f"{float(self.transaction.amount):,}"
+    def transaction(self) -> PayoutTransaction:
+        transactions = self.message.transactions
+        return next(
+            (tx for tx in transactions if tx.transaction_id == self.transaction_id),
+            transactions[0],
+        )
 
     @property
-    def currency(self):
-        return self.transaction.currency
+    def formatted_amount(self):
+        return f"{float(self.amount):,}"
 
     @property
     def creation_date(self):
-        return self.message.header.creation_date.replace("T", " ")
-
-    @property
-    def destination_name(self):
-        return self.transaction.creditor.name
-
-    @property
-    def destination_rut(self):
-        return self.transaction.creditor.identification.id
-
-    @property
-    def destination_id_schema(self):
-        return self.transaction.creditor.identification.id_schema
-
-    @property
-    def destination_email(self):
-        return self.transaction.creditor.email
-
-    @property
-    def destination_bank(self):
-        return self.transaction.creditor.financial_institution.fin_id
-
-    @property
-    def destination_account(self):
-        return self.transaction.creditor.account
-
-    @property
-    def destination_account_type(self):
-        return self.transaction.creditor.account_type
-
-    @property
-    def description(self):
-        return self.transaction.description
+        return isoformat_from_utc_datetime(self.created_at)
 
     @property
     def response(self) -> PayoutResponse:
         if self.response_content is None:
             return None
-        response_message = ResponseMessage.from_json(self.response_content)
         # We have a full response message which might contain responses for
         # multiple transactions. We only care about the response for the
         # transaction id we sent.
-        return next(
-            r
-            for r in response_message.responses
-            if r.shinkansen_transaction_id == self.shinkansen_transaction_id
-        )
+        return memoized(
+            self, self.response_content, responses_by_shinkansen_transaction_id
+        ).get(self.shinkansen_transaction_id)
 
 
 class PersistedSingleTransactionPayinMessage(db.Model):
+    # Listings are sorted by (created_at, id) and usually filtered by status or
+    # currency. See pagination.keyset_page()
+    __table_args__ = (
+        db.Index("ix_payin_created_at_id", "created_at", "id"),
+        db.Index("ix_payin_status_created_at", "status", "created_at", "id"),
+        db.Index("ix_payin_currency_created_at", "currency", "created_at", "id"),
+    )
     id = db.Column(db.String(36), primary_key=True)
-    shinkansen_transaction_id = db.Column(db.String(36))
+    shinkansen_transaction_id = db.Column(db.String(36), index=True)
     content = db.Column(db.Text())
     signature = db.Column(db.Text())
     response_content = db.Column(db.Text())
     response_signature = db.Column(db.Text())
 
+    # Denormalized from content and response_content, so we can list and
+    # filter payins without parsing JSON. See fill_columns()
+    transaction_id = db.Column(db.String(36), index=True)
+    amount = db.Column(db.String(32))
+    currency = db.Column(db.String(3), index=True)
+    created_at = db.Column(db.DateTime(), index=True)
+    description = db.Column(db.Text())
+    status = db.Column(db.String(32), index=True, default="pending")
+    response_status = db.Column(db.String(32), index=True)
+
     def __repr__(self) -> str:
         return "<Payin %r>" % self.content
 
@@ -124,55 +229,116 @@ class PersistedSingleTransactionPayinMessage(db.Model):
         self.content = message.as_json()
         self.signature = signature
         self.shinkansen_transaction_id = shinkansen_transaction_id
+        self.fill_columns(message)
+
+    def fill_columns(self, message: PayinMessage = None):
+        """Copies the fields we list and filter by into their own columns"""
+        message = message or self.message
+        transaction = message.transactions[0]
+        self.transaction_id = transaction.transaction_id
+        self.amount = transaction.amount
+        self.currency = transaction.currency
+        self.created_at = utc_datetime_from_isoformat(message.header.creation_date)
+        self.description = transaction.description
+        response = self.response
+        self.status = response.shinkansen_transaction_status if response else "pending"
+        self.response_status = response.response_status if response else None
+
+    def apply_response(
+        self, response: PayinResponse, response_content: str, response_signature: str
+    ):
+        self.response_content = response_content
+        self.response_signature = response_signature
+        self.status = response.shinkansen_transaction_status
+        self.response_status = response.response_status
 
     @property
     def message(self) -> PayinMessage:
-        return PayinMessage.from_json(self.content)
-
-    @property
-    def status(self) -> str:
-        return (
-            self.response.shinkansen_transaction_status if self.response else "pending"
-        )
-
-    @property
-    def response_status(self) -> str:
-        return self.response.response_status if self.response else None
+        return memoized(self, self.content, parsed_payin_message)
 
     @property
     def transaction(self) -> PayinTransaction:
         return self.message.transactions[0]
 
     @property
-    def transaction_id(self) -> str:
-        return self.transaction.transaction_id
-
-    @property
-    def amount(self):
-        return f"{int(self.transaction.amount):,}".replace(",", ".")
-
-    @property
-    def currency(self):
-        return self.transaction.currency
+    def formatted_amount(self):
+        return f"{int(self.amount):,}".replace(",", ".")
 
     @property
     def creation_date(self):
-        return self.message.header.creation_date.replace("T", " ")
-
-    @property
-    def description(self):
-        return self.transaction.description
+        return isoformat_from_utc_datetime(self.created_at)
 
     @property
     def response(self) -> PayinResponse:
         if self.response_content is None:
             return None
-        response_message = ResponseMessage.from_json(self.response_content)
         # We have a full response message which might contain responses for
         # multiple transactions. We only care about the response for the
         # transaction id we sent.
-        return next(
-            r
-            for r in response_message.responses
-            if r.shinkansen_transaction_id == self.shinkansen_transaction_id
+        return memoized(
+            self, self.response_content, responses_by_shinkansen_transaction_id
+        ).get(self.shinkansen_transaction_id)
+
+
+def backfill_columns(model, batch_size: int = 500) -> int:
+    """Fills the denormalized columns of rows persisted before they existed"""
+    n = 0
+    while True:
+        rows = (
+            model.query.filter(model.transaction_id.is_(None)).limit(batch_size).all()
+        )
+        if not rows:
+            return n
+        for row in rows:
+            row.fill_columns()
+        db.session.commit()
+        n += len(rows)
+
+
+class ShinkansenTransactionOwner(db.Model):
+    """Who sent each transaction known by Shinkansen, so callbacks can be routed
+    with a single indexed lookup"""
+
+    PAYOUT = "payout"
+    PAYIN = "payin"
+    TEST_SUITE = "test_suite"
+
+    __tablename__ = "shinkansen_transaction_owner"
+    shinkansen_transaction_id = db.Column(db.String(36), primary_key=True)
+    owner_type = db.Column(db.String(16), nullable=False)
+    owner_id = db.Column(db.String(36), nullable=False)
+    sent_at = db.Column(db.DateTime())
+
+    def __repr__(self) -> str:
+        return "<ShinkansenTransactionOwner %r: %s %s>" % (
+            self.shinkansen_transaction_id,
+            self.owner_type,
+            self.owner_id,
+        )
+
+
+def backfill_transaction_owners(model, owner_type: str) -> int:
+    """Registers the owner of rows persisted before the registry existed"""
+    unregistered = (
+        db.session.query(model.id, model.shinkansen_transaction_id)
+        .outerjoin(
+            ShinkansenTransactionOwner,
+            ShinkansenTransactionOwner.shinkansen_transaction_id
+            == model.shinkansen_transaction_id,
+        )
+        .filter(
+            model.shinkansen_transaction_id.isnot(None),
+            ShinkansenTransactionOwner.shinkansen_transaction_id.is_(None),
+        )
+        .all()
+    )
+    for id, shinkansen_transaction_id in unregistered:
+        db.session.add(
+            ShinkansenTransactionOwner(
+                shinkansen_transaction_id=shinkansen_transaction_id,
+                owner_type=owner_type,
+                owner_id=id,
+            )
         )
+    db.session.commit()
+    return len(unregistered)
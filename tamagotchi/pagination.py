@@ -0,0 +1,59 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import and_, or_
+
+
+class Page:
+    """A page of rows, newest first, with:
+
+    - items: The rows in this page
+    - next_cursor: Opaque cursor pointing right after the last row, or None if
+      this is the last page
+    """
+
+    def __init__(self, items: list, next_cursor: Optional[str]) -> None:
+        self.items = items
+        self.next_cursor = next_cursor
+
+
+def encode_cursor(created_at: datetime, id: str) -> str:
+    raw = f"{created_at.isoformat()}|{id}".encode("UTF-8")
+    return urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, str]:
+    """Raises ValueError if the cursor is malformed"""
+    try:
+        created_at, id = urlsafe_b64decode(cursor.encode("ascii")).decode().split("|")
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    return datetime.fromisoformat(created_at), id
+
+
+def keyset_page(query, model, cursor: Optional[str], per_page: int) -> Page:
+    """Returns the page of query (over model) after cursor.
+
+    Rows are sorted by (created_at, id) descending, so each page is an index
+    range scan no matter how deep we are.
+    """
+    if cursor:
+        created_at, id = decode_cursor(cursor)
+        query = query.filter(
+            or_(
+                model.created_at < created_at,
+                and_(model.created_at == created_at, model.id < id),
+            )
+        )
+    rows = (
+        query.order_by(model.created_at.desc(), model.id.desc())
+        .limit(per_page + 1)
+        .all()
+    )
+    items = rows[:per_page]
+    next_cursor = (
+        encode_cursor(items[-1].created_at, items[-1].id)
+        if len(rows) > per_page
+        else None
+    )
+    return Page(items, next_cursor)
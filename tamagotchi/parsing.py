@@ -0,0 +1,101 @@
+import json
+import threading
+from collections import OrderedDict
+from hashlib import blake2b
+from typing import Callable
+from shinkansen.payouts import PayoutMessage
+from shinkansen.payins import PayinMessage
+from shinkansen.responses import ResponseMessage, Response
+from .settings import TAMAGOTCHI_PARSE_CACHE_SIZE
+
+
+class ParseCache:
+    """A process-wide, size-bounded LRU of parsed JSON content.
+
+    Entries are keyed by the kind of parsing and a hash of the content, so rows
+    sharing an identical JSON blob (e.g: the same multi-transaction response
+    message) share a single parsed object. Parsed objects must be treated as
+    read-only.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, kind: str, content: str, parse: Callable[[str], object]):
+        key = (kind, blake2b(content.encode("UTF-8"), digest_size=16).digest())
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+        parsed = parse(content)
+        with self._lock:
+            self._entries[key] = parsed
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return parsed
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+parse_cache = ParseCache(TAMAGOTCHI_PARSE_CACHE_SIZE)
+
+
+def parsed_payout_message(content: str) -> PayoutMessage:
+    return parse_cache.get("payout", content, PayoutMessage.from_json)
+
+
+def parsed_payin_message(content: str) -> PayinMessage:
+    return parse_cache.get("payin", content, PayinMessage.from_json)
+
+
+def parsed_response_message(content: str) -> ResponseMessage:
+    return parse_cache.get("response_message", content, ResponseMessage.from_json)
+
+
+def parsed_response(content: str) -> Response:
+    """Parses a single response, as stored by the tester"""
+    return parse_cache.get(
+        "response", content, lambda c: Response.from_json_dict(json.loads(c))
+    )
+
+
+def _index_responses(content: str) -> dict[str, Response]:
+    return {
+        r.shinkansen_transaction_id: r
+        for r in parsed_response_message(content).responses
+    }
+
+
+def responses_by_shinkansen_transaction_id(content: str) -> dict[str, Response]:
+    """Indexes the responses of a full response message by transaction"""
+    return parse_cache.get("response_index", content, _index_responses)
+
+
+def memoized(instance, content: str, parse: Callable[[str], object]):
+    """Parses content once per instance, re-parsing only if it changes"""
+    memo = instance.__dict__.setdefault("_parsed_content", {})
+    if parse in memo and memo[parse][0] == content:
+        return memo[parse][1]
+    parsed = parse(content)
+    memo[parse] = (content, parsed)
+    return parsed
@@ -0,0 +1,205 @@
+"""Running totals of payouts and payins, so summaries don't read every row.
+
+The rollup_total table counts (and adds the amounts of) payouts and payins by
+kind, currency, bank (payouts only), status and response status, both per day
+(of creation, as in the listings) and for all time (day "*"). It's kept up to
+date by a before_flush listener, in the same transaction that inserts a row or
+changes its status (see track_changes()), whichever session does it. A summary
+then reads a number of totals that depends on how many currencies, banks and
+statuses there are, but not on how many payouts and payins.
+
+Amounts are added up as integers (in 1/SCALE units of their currency), so
+they're exact on any database (SQLite would store decimals as floats).
+
+Rows stored before the table existed are counted by rebuild() (which
+backfill-db runs).
+"""
+
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal, InvalidOperation
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from .app import db
+from .models import (
+    PersistedSingleTransactionPayoutMessage,
+    PersistedSingleTransactionPayinMessage,
+    utcnow,
+)
+
+KINDS = {
+    PersistedSingleTransactionPayoutMessage: "payout",
+    PersistedSingleTransactionPayinMessage: "payin",
+}
+ALL_TIME = "*"
+REJECTED = "rejected"  # The response_status of rejected transactions
+SCALE = 10000  # Amounts are stored in ten-thousandths
+
+
+class RollupTotal(db.Model):
+    __tablename__ = "rollup_total"
+    kind = db.Column(db.String(16), primary_key=True)
+    day = db.Column(db.String(10), primary_key=True)  # YYYY-MM-DD, or ALL_TIME
+    currency = db.Column(db.String(3), primary_key=True)
+    bank = db.Column(db.String(64), primary_key=True)
+    status = db.Column(db.String(32), primary_key=True)
+    response_status = db.Column(db.String(32), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    amount = db.Column(db.BigInteger, nullable=False, default=0)  # See SCALE
+
+
+def amount_of(row) -> int:
+    """The amount of a row, in 1/SCALE units"""
+    try:
+        amount = Decimal(row.amount or 0)
+    except InvalidOperation:
+        return 0
+    return int(amount * SCALE) if amount.is_finite() else 0
+
+
+def keys(kind: str, row, status: str, response_status: str) -> list[tuple]:
+    """The totals a row in the given status counts towards"""
+    dimensions = (
+        row.currency or "",
+        getattr(row, "creditor_bank", None) or "",
+        status or "",
+        response_status or "",
+    )
+    day = f"{row.created_at:%Y-%m-%d}" if row.created_at else ""
+    return [(kind, day, *dimensions), (kind, ALL_TIME, *dimensions)]
+
+
+def old_value(row, name: str):
+    history = inspect(row).attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    return history.unchanged[0] if history.unchanged else None
+
+
+@event.listens_for(Session, "before_flush")
+def track_changes(session, flush_context, instances):
+    deltas = defaultdict(lambda: [0, 0])
+
+    def add(kind, row, status, response_status, sign):
+        for key in keys(kind, row, status, response_status):
+            deltas[key][0] += sign
+            deltas[key][1] += sign * amount_of(row)
+
+    for row in session.new:
+        if type(row) in KINDS:
+            add(KINDS[type(row)], row, row.status or "pending", row.response_status, 1)
+    for row in session.dirty:
+        if type(row) not in KINDS:
+            continue
+        state = inspect(row)
+        if not any(
+            state.attrs[name].history.has_changes()
+            for name in ("status", "response_status")
+        ):
+            continue
+        kind = KINDS[type(row)]
+        old_status = old_value(row, "status")
+        if old_status is not None:  # Otherwise it wasn't counted (see rebuild())
+            add(kind, row, old_status, old_value(row, "response_status"), -1)
+        add(kind, row, row.status, row.response_status, 1)
+    for row in session.deleted:
+        if type(row) in KINDS:
+            add(KINDS[type(row)], row, row.status, row.response_status, -1)
+    # Always in the same order, to avoid deadlocks:
+    for key, (count, amount) in sorted(deltas.items()):
+        if count or amount:
+            apply_delta(session.connection(), key, count, amount)
+
+
+def apply_delta(connection, key: tuple, count: int, amount: int):
+    table = RollupTotal.__table__
+    kind, day, currency, bank, status, response_status = key
+    updated = connection.execute(
+        table.update()
+        .where(
+            table.c.kind == kind,
+            table.c.day == day,
+            table.c.currency == currency,
+            table.c.bank == bank,
+            table.c.status == status,
+            table.c.response_status == response_status,
+        )
+        .values(count=table.c.count + count, amount=table.c.amount + amount)
+    )
+    if not updated.rowcount:
+        connection.execute(
+            table.insert().values(
+                kind=kind,
+                day=day,
+                currency=currency,
+                bank=bank,
+                status=status,
+                response_status=response_status,
+                count=count,
+                amount=amount,
+            )
+        )
+
+
+def rebuild(batch_size: int = 1000) -> int:
+    """Counts every stored payout and payin from scratch (reading only the
+    columns it needs), returning how many totals there are. Changes committed
+    meanwhile by other sessions may be missed, so it's best run when idle"""
+    db.session.query(RollupTotal).delete(synchronize_session=False)
+    deltas = defaultdict(lambda: [0, 0])
+    for model, kind in KINDS.items():
+        columns = ["created_at", "currency", "amount", "status", "response_status"]
+        if hasattr(model, "creditor_bank"):
+            columns.append("creditor_bank")
+        rows = model.query.with_entities(
+            *(getattr(model, name) for name in columns)
+        ).yield_per(batch_size)
+        for row in rows:
+            for key in keys(kind, row, row.status or "pending", row.response_status):
+                deltas[key][0] += 1
+                deltas[key][1] += amount_of(row)
+    connection = db.session.connection()
+    for key, (count, amount) in sorted(deltas.items()):
+        apply_delta(connection, key, count, amount)
+    db.session.commit()
+    return len(deltas)
+
+
+def summary(day: date = None) -> dict:
+    """Counts and amounts by currency and status (plus those rejected), for
+    all time and for a day (today by default), and the rejection rate of
+    payouts per bank"""
+    day = f"{day or utcnow().date():%Y-%m-%d}"
+    result = {
+        kind: {period: {} for period in ("all_time", day)} for kind in KINDS.values()
+    }
+    banks = {}
+    totals = RollupTotal.query.filter(
+        RollupTotal.day.in_((ALL_TIME, day)), RollupTotal.count != 0
+    )
+    for total in totals:
+        period = "all_time" if total.day == ALL_TIME else day
+        currency = result[total.kind][period].setdefault(
+            total.currency, {"by_status": {}, REJECTED: empty_total()}
+        )
+        counted = [currency["by_status"].setdefault(total.status, empty_total())]
+        if total.response_status == REJECTED:
+            counted.append(currency[REJECTED])
+        for counts in counted:
+            counts["count"] += total.count
+            counts["amount"] += Decimal(total.amount) / SCALE
+        if total.kind == "payout" and total.day == ALL_TIME:
+            bank = banks.setdefault(total.bank, {"count": 0, REJECTED: 0})
+            bank["count"] += total.count
+            if total.response_status == REJECTED:
+                bank[REJECTED] += total.count
+    for bank in banks.values():
+        bank["rejection_rate"] = (
+            bank[REJECTED] / bank["count"] if bank["count"] else None
+        )
+    result["payout"]["banks"] = banks
+    return {"day": day, **result}
+
+
+def empty_total() -> dict:
+    return {"count": 0, "amount": Decimal(0)}
@@ -0,0 +1,26 @@
+from sqlalchemy import inspect, text
+from .app import db
+
+
+def upgrade_schema():
+    """Creates missing tables, columns and indexes.
+
+    We don't have real migrations, so this only knows how to add things.
+    Columns added to existing tables start as NULL for the existing rows.
+    """
+    db.create_all()
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing_columns = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                db.session.execute(
+                    text(
+                        f"ALTER TABLE {table.name} "
+                        f"ADD COLUMN {column.name} {column_type}"
+                    )
+                )
+        db.session.commit()
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
@@ -0,0 +1,172 @@
+from typing import Optional, Tuple
+from sqlalchemy.orm import Session
+from shinkansen.common import SHINKANSEN, MessageHeader
+from shinkansen.payouts import PayoutMessage, PayoutTransaction, PayoutHttpResponse
+from shinkansen.payins import PayinMessage, PayinTransaction, PayinHttpResponse
+from .app import app, db
+from .batching import MicroBatcher
+from .models import (
+    PersistedPayoutMessage,
+    PersistedSingleTransactionPayoutMessage,
+    PersistedSingleTransactionPayinMessage,
+    ShinkansenTransactionOwner,
+    utcnow,
+)
+from .settings import (
+    TAMAGOTCHI,
+    TAMAGOTCHI_PAYOUT_BATCH_SIZE,
+    TAMAGOTCHI_PAYOUT_BATCH_WINDOW,
+)
+from .transport import sign_and_send
+
+
+def new_header() -> MessageHeader:
+    return MessageHeader(sender=TAMAGOTCHI, receiver=SHINKANSEN)
+
+
+def send_single_payout(
+    transaction: PayoutTransaction,
+) -> Tuple[Optional[PersistedSingleTransactionPayoutMessage], PayoutHttpResponse]:
+    """Signs and sends a payout message with a single transaction.
+
+    If Shinkansen accepts it, the payout is added to the session (but not
+    committed) and returned along with the HTTP response.
+    """
+    single_payout_message = PayoutMessage(
+        header=new_header(), transactions=[transaction]
+    )
+    sent_at = utcnow()
+    signature, response = sign_and_send(single_payout_message)
+    if response.http_status_code not in (200, 409):
+        return None, response
+    shinkansen_transaction_id = response.transaction_ids[transaction.transaction_id]
+    persisted_payout = PersistedSingleTransactionPayoutMessage(
+        message=single_payout_message,
+        signature=signature,
+        shinkansen_transaction_id=shinkansen_transaction_id,
+    )
+    db.session.add(persisted_payout)
+    db.session.add(
+        ShinkansenTransactionOwner(
+            shinkansen_transaction_id=shinkansen_transaction_id,
+            owner_type=ShinkansenTransactionOwner.PAYOUT,
+            owner_id=persisted_payout.id,
+            sent_at=sent_at,
+        )
+    )
+    return persisted_payout, response
+
+
+def send_payout_batch(
+    transactions: list[PayoutTransaction],
+) -> Tuple[dict[str, str], PayoutHttpResponse]:
+    """Signs and sends a single payout message with all the transactions.
+
+    If Shinkansen accepts it, the message and each of its transactions are
+    persisted and committed right away, with a session of our own (as the
+    payouts come from different requests and threads). Returns the ids of the
+    persisted payouts by transaction id, along with the HTTP response.
+    """
+    message = PayoutMessage(header=new_header(), transactions=transactions)
+    sent_at = utcnow()
+    signature, response = sign_and_send(message)
+    if response.http_status_code not in (200, 409):
+        return {}, response
+    batch = PersistedPayoutMessage(message, signature)
+    rows = [batch]
+    payout_ids = {}
+    for transaction in transactions:
+        shinkansen_transaction_id = response.transaction_ids.get(
+            transaction.transaction_id
+        )
+        if shinkansen_transaction_id is None:
+            continue
+        persisted_payout = PersistedSingleTransactionPayoutMessage(
+            message=message,
+            signature=signature,
+            shinkansen_transaction_id=shinkansen_transaction_id,
+            batch=batch,
+            transaction=transaction,
+        )
+        rows += [
+            persisted_payout,
+            ShinkansenTransactionOwner(
+                shinkansen_transaction_id=shinkansen_transaction_id,
+                owner_type=ShinkansenTransactionOwner.PAYOUT,
+                owner_id=persisted_payout.id,
+                sent_at=sent_at,
+            ),
+        ]
+        payout_ids[transaction.transaction_id] = persisted_payout.id
+    with Session(db.engine) as session:
+        session.add_all(rows)
+        session.commit()
+    return payout_ids, response
+
+
+# Payouts are sent in messages of their own unless TAMAGOTCHI_PAYOUT_BATCH_SIZE
+# is set, in which case those sent around the same time from the same account
+# share a message (and its signature and HTTP request):
+payout_batcher = (
+    MicroBatcher(
+        send=send_payout_batch,
+        key=lambda tx: (
+            tx.currency,
+            tx.debtor.identification.id,
+            tx.debtor.account,
+        ),
+        item_id=lambda tx: tx.transaction_id,
+        max_size=TAMAGOTCHI_PAYOUT_BATCH_SIZE,
+        max_delay=TAMAGOTCHI_PAYOUT_BATCH_WINDOW,
+    )
+    if TAMAGOTCHI_PAYOUT_BATCH_SIZE > 1
+    else None
+)
+
+
+def send_payout(
+    transaction: PayoutTransaction,
+) -> Tuple[Optional[PersistedSingleTransactionPayoutMessage], PayoutHttpResponse]:
+    """Sends a payout, on its own or batched with others (see payout_batcher).
+
+    Either way, returns the persisted payout (in the session, which the caller
+    should commit) if Shinkansen accepted it, along with the HTTP response.
+    """
+    if payout_batcher is None:
+        return send_single_payout(transaction)
+    payout_id, response = payout_batcher.submit(transaction).result()
+    if payout_id is None:
+        return None, response
+    return PersistedSingleTransactionPayoutMessage.query.get(payout_id), response
+
+
+def send_single_payin(
+    transaction: PayinTransaction,
+) -> Tuple[Optional[PersistedSingleTransactionPayinMessage], PayinHttpResponse]:
+    """Signs and sends a payin message with a single transaction.
+
+    If Shinkansen accepts it, the payin is added to the session (but not
+    committed) and returned along with the HTTP response.
+    """
+    single_payin_message = PayinMessage(header=new_header(), transactions=[transaction])
+    app.logger.info(f"Sending payin message: {single_payin_message.as_json()}")
+    sent_at = utcnow()
+    signature, response = sign_and_send(single_payin_message)
+    if response.http_status_code not in (200, 409):
+        return None, response
+    shinkansen_transaction_id = response.transaction_ids[transaction.transaction_id]
+    persisted_payin = PersistedSingleTransactionPayinMessage(
+        message=single_payin_message,
+        signature=signature,
+        shinkansen_transaction_id=shinkansen_transaction_id,
+    )
+    db.session.add(persisted_payin)
+    db.session.add(
+        ShinkansenTransactionOwner(
+            shinkansen_transaction_id=shinkansen_transaction_id,
+            owner_type=ShinkansenTransactionOwner.PAYIN,
+            owner_id=persisted_payin.id,
+            sent_at=sent_at,
+        )
+    )
+    return persisted_payin, response
@@ -0,0 +1,77 @@
+"""Serves tamagotchi with gunicorn, for production.
+
+The app is imported once in the master process (so settings, certificates and
+the rest of the import-time work are shared copy-on-write by the workers) and
+then forked into `workers` processes, each serving `threads` requests at once.
+
+fly.io stops machines with SIGINT (see kill_signal in fly.toml), which gunicorn
+takes as "quit right away". Here SIGINT means the same as SIGTERM: stop
+accepting connections and let the requests in progress finish (for up to
+graceful_timeout seconds).
+"""
+
+import math
+import signal
+from gunicorn.app.base import BaseApplication
+from .app import app, db
+from .settings import TAMAGOTCHI_CALLBACK_INBOX
+from . import inbox
+
+
+def threads_for(max_connections: int, workers: int) -> int:
+    """Threads per worker so that all of them can serve max_connections"""
+    return max(1, math.ceil(max_connections / workers))
+
+
+def on_starting(arbiter):
+    arbiter.handle_int = arbiter.handle_term
+
+
+def post_fork(arbiter, worker):
+    # Connections opened by the master (if any) mustn't be shared by workers:
+    with app.app_context():
+        db.engine.dispose()
+    if TAMAGOTCHI_CALLBACK_INBOX:
+        # Threads don't survive the fork, so each worker starts its own:
+        inbox.worker.start()
+
+
+def post_worker_init(worker):
+    signal.signal(signal.SIGINT, worker.handle_exit)
+
+
+class Server(BaseApplication):
+    def __init__(self, options: dict) -> None:
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set("on_starting", on_starting)
+        self.cfg.set("post_fork", post_fork)
+        self.cfg.set("post_worker_init", post_worker_init)
+
+    def load(self):
+        return app
+
+
+def serve(
+    bind: str,
+    workers: int,
+    threads: int,
+    graceful_timeout: float,
+    timeout: float,
+):
+    Server(
+        {
+            "bind": bind,
+            "workers": workers,
+            "threads": threads,
+            "worker_class": "gthread",
+            "preload_app": True,
+            "graceful_timeout": graceful_timeout,
+            "timeout": timeout,
+            "accesslog": "-",
+        }
+    ).run()
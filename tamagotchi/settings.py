@@ -1,4 +1,7 @@
 import os
+from functools import cached_property
+from cryptography import x509
+from cryptography.hazmat.primitives.asymmetric import rsa
 from .utils import required_env
 from shinkansen import jws
 from shinkansen.payouts import (
@@ -57,25 +60,114 @@ TAMAGOTCHI_ACCOUNTS = {
     ),
 }
 
-TAMAGOTCHI_API_KEY = required_env("TAMAGOTCHI_API_KEY")
-TAMAGOTCHI_CERTIFICATE = jws.certificate_from_pem_bytes(
-    required_env("TAMAGOTCHI_CERTIFICATE").encode("UTF-8")
-)
-TAMAGOTCHI_CERTIFICATE_PRIVATE_KEY = jws.private_key_from_pem_bytes(
-    required_env("TAMAGOTCHI_CERTIFICATE_PRIVATE_KEY").encode("UTF-8")
+
+class Credentials:
+    """Our API key, certificate and private key, read from the environment
+    (and parsed) on first use.
+
+    So commands that don't send messages neither pay for parsing the keys nor
+    need them to be set. Those that do can require() them upfront.
+    """
+
+    NAMES = ("api_key", "certificate", "private_key")
+
+    @cached_property
+    def api_key(self) -> str:
+        return required_env("TAMAGOTCHI_API_KEY")
+
+    @cached_property
+    def certificate(self) -> x509.Certificate:
+        return jws.certificate_from_pem_bytes(
+            required_env("TAMAGOTCHI_CERTIFICATE").encode("UTF-8")
+        )
+
+    @cached_property
+    def private_key(self) -> rsa.RSAPrivateKey:
+        return jws.private_key_from_pem_bytes(
+            required_env("TAMAGOTCHI_CERTIFICATE_PRIVATE_KEY").encode("UTF-8")
+        )
+
+    def require(self, *names: str):
+        """Loads the given credentials (all of them by default), raising a
+        RuntimeError that lists every one missing or invalid"""
+        errors = []
+        for name in names or self.NAMES:
+            try:
+                getattr(self, name)
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+        if errors:
+            raise RuntimeError("Invalid credentials. " + "; ".join(errors))
+
+
+credentials = Credentials()
+
+# Shinkansen's certificates are loaded (and reloaded) by keyring.py, from the
+# SHINKANSEN_CERTIFICATE_1 and _2 variables and/or a PEM bundle:
+SHINKANSEN_CERTIFICATES_FILE = os.getenv("SHINKANSEN_CERTIFICATES_FILE")
+SHINKANSEN_CERTIFICATES_RELOAD_INTERVAL = float(
+    os.getenv("SHINKANSEN_CERTIFICATES_RELOAD_INTERVAL", "10")
 )
-SHINKANSEN_CERTIFICATE_1 = required_env("SHINKANSEN_CERTIFICATE_1")
-SHINKANSEN_CERTIFICATE_2 = os.getenv("SHINKANSEN_CERTIFICATE_2")
-SHINKANSEN_CERTIFICATES = [
-    jws.certificate_from_pem_bytes(c.encode("UTF-8"))
-    for c in [SHINKANSEN_CERTIFICATE_1, SHINKANSEN_CERTIFICATE_2]
-    if c is not None
-]
 TAMAGOTCHI_MAX_AMOUNT = os.getenv("TAMAGOTCHI_MAX_AMOUNT")
+TAMAGOTCHI_PAGE_SIZE = int(os.getenv("TAMAGOTCHI_PAGE_SIZE", "50"))
+TAMAGOTCHI_MAX_PAGE_SIZE = int(os.getenv("TAMAGOTCHI_MAX_PAGE_SIZE", "500"))
+TAMAGOTCHI_BULK_CONCURRENCY = int(os.getenv("TAMAGOTCHI_BULK_CONCURRENCY", "4"))
+TAMAGOTCHI_PAYOUT_BATCH_SIZE = int(os.getenv("TAMAGOTCHI_PAYOUT_BATCH_SIZE", "1"))
+TAMAGOTCHI_PAYOUT_BATCH_WINDOW = float(
+    os.getenv("TAMAGOTCHI_PAYOUT_BATCH_WINDOW", "0.2")
+)
+TESTER_CONCURRENCY = int(os.getenv("TESTER_CONCURRENCY", "8"))
+TESTER_RATE = float(os.getenv("TESTER_RATE")) if os.getenv("TESTER_RATE") else None
+TESTER_WRITE_BATCH_SIZE = int(os.getenv("TESTER_WRITE_BATCH_SIZE", "200"))
+TESTER_WRITE_DELAY = float(os.getenv("TESTER_WRITE_DELAY", "0.5"))
+TESTER_METRICS_FLUSH_INTERVAL = float(os.getenv("TESTER_METRICS_FLUSH_INTERVAL", "5"))
+TAMAGOTCHI_DATABASE_URL = os.getenv("TAMAGOTCHI_DATABASE_URL")
+TAMAGOTCHI_SQLITE_MODE = os.getenv("TAMAGOTCHI_SQLITE_MODE", "wal")
+TAMAGOTCHI_SQLITE_BUSY_TIMEOUT = float(os.getenv("TAMAGOTCHI_SQLITE_BUSY_TIMEOUT", "5"))
+TAMAGOTCHI_SQLITE_CACHE_SIZE = int(os.getenv("TAMAGOTCHI_SQLITE_CACHE_SIZE", "65536"))
+TAMAGOTCHI_SQLITE_MMAP_SIZE = int(
+    os.getenv("TAMAGOTCHI_SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))
+)
+TAMAGOTCHI_DB_POOL_SIZE = int(os.getenv("TAMAGOTCHI_DB_POOL_SIZE", "10"))
+TAMAGOTCHI_DB_MAX_OVERFLOW = int(os.getenv("TAMAGOTCHI_DB_MAX_OVERFLOW", "20"))
+# Enough for a whole tester suite (about 1,000 messages plus their responses):
+TAMAGOTCHI_PARSE_CACHE_SIZE = int(os.getenv("TAMAGOTCHI_PARSE_CACHE_SIZE", "4096"))
+TAMAGOTCHI_HTTP_POOL_SIZE = int(os.getenv("TAMAGOTCHI_HTTP_POOL_SIZE", "16"))
+TAMAGOTCHI_HTTP_TIMEOUT = (
+    float(os.getenv("TAMAGOTCHI_HTTP_TIMEOUT"))
+    if os.getenv("TAMAGOTCHI_HTTP_TIMEOUT")
+    else None
+)
 
 SHINKANSEN_API_HOST = os.getenv("SHINKANSEN_API_HOST", "dev.shinkansen.finance")
-SHINKANSEN_BASE_URL = f"https://{SHINKANSEN_API_HOST}/v1"
+SHINKANSEN_BASE_URL = os.getenv(
+    "SHINKANSEN_BASE_URL", f"https://{SHINKANSEN_API_HOST}/v1"
+)
 SHINKANSEN_FORWARD_URL = os.getenv("SHINKANSEN_FORWARD_URL")
+TAMAGOTCHI_FORWARD_CONCURRENCY = int(os.getenv("TAMAGOTCHI_FORWARD_CONCURRENCY", "4"))
+TAMAGOTCHI_FORWARD_TIMEOUT = float(os.getenv("TAMAGOTCHI_FORWARD_TIMEOUT", "10"))
+TAMAGOTCHI_FORWARD_MAX_ATTEMPTS = int(os.getenv("TAMAGOTCHI_FORWARD_MAX_ATTEMPTS", "5"))
+TAMAGOTCHI_FORWARD_BACKOFF = float(os.getenv("TAMAGOTCHI_FORWARD_BACKOFF", "1"))
+
+TAMAGOTCHI_CALLBACK_INBOX = os.getenv("TAMAGOTCHI_CALLBACK_INBOX", "").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+TAMAGOTCHI_INBOX_BATCH_SIZE = int(os.getenv("TAMAGOTCHI_INBOX_BATCH_SIZE", "100"))
+TAMAGOTCHI_INBOX_LEASE = float(os.getenv("TAMAGOTCHI_INBOX_LEASE", "60"))
+TAMAGOTCHI_INBOX_MAX_ATTEMPTS = int(os.getenv("TAMAGOTCHI_INBOX_MAX_ATTEMPTS", "5"))
+TAMAGOTCHI_INBOX_POLL_INTERVAL = float(os.getenv("TAMAGOTCHI_INBOX_POLL_INTERVAL", "1"))
+TAMAGOTCHI_CALLBACK_DEDUP_SIZE = int(
+    os.getenv("TAMAGOTCHI_CALLBACK_DEDUP_SIZE", "10000")
+)
+TAMAGOTCHI_EVENTS_POLL_INTERVAL = float(
+    os.getenv("TAMAGOTCHI_EVENTS_POLL_INTERVAL", "0.5")
+)
+TAMAGOTCHI_EVENTS_MAX_CLIENTS = int(os.getenv("TAMAGOTCHI_EVENTS_MAX_CLIENTS", "4"))
+TAMAGOTCHI_EVENTS_STREAM_DURATION = float(
+    os.getenv("TAMAGOTCHI_EVENTS_STREAM_DURATION", "300")
+)
 
 TAMAGOTCHI_MANUAL_TEST_TARGETS = os.getenv(
     "TAMAGOTCHI_MANUAL_TEST_TARGETS",
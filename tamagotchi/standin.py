@@ -0,0 +1,249 @@
+"""A local stand-in for the Shinkansen API, to load test without a network.
+
+It accepts signed payout and payin messages like the real API does, replies
+with the same shape of JSON after a configurable latency (failing a given
+fraction of them), and later POSTs a signed callback with a response for each
+transaction to our /shinkansen/messages/ endpoint.
+
+Run it with `flask --app tamagotchi shinkansen-standin` and point
+SHINKANSEN_BASE_URL to it.
+"""
+
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+import requests
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from flask import Flask, jsonify, request
+from shinkansen import jws
+from shinkansen.common import SHINKANSEN, FinancialInstitution, MessageHeader
+from shinkansen.responses import PayinResponse, PayoutResponse, ResponseMessage
+
+logger = logging.getLogger(__name__)
+
+
+class StandinConfig:
+    """How the stand-in behaves:
+
+    - latency: Mean time (in ms) to reply to a message
+    - jitter: Maximum deviation (in ms) from the mean latency
+    - error_rate: Fraction of messages answered with an HTTP error
+    - rejection_rate: Fraction of transactions rejected in their callback
+    - callback_url: Where callbacks are POSTed (None to not send them)
+    - callback_delay: Seconds between a message and its callback
+    - certificate/private_key: Used to sign callbacks
+    - sender_certificates: Certificates accepted for incoming messages (any
+      certificate if empty)
+    """
+
+    def __init__(
+        self,
+        certificate: x509.Certificate,
+        private_key: rsa.RSAPrivateKey,
+        latency: float = 100,
+        jitter: float = 50,
+        error_rate: float = 0.0,
+        rejection_rate: float = 0.0,
+        callback_url: Optional[str] = None,
+        callback_delay: float = 1.0,
+        callback_workers: int = 4,
+        sender_certificates: list[x509.Certificate] = None,
+    ) -> None:
+        self.certificate = certificate
+        self.private_key = private_key
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rejection_rate = rejection_rate
+        self.callback_url = callback_url
+        self.callback_delay = callback_delay
+        self.callback_workers = callback_workers
+        self.sender_certificates = sender_certificates or []
+
+
+def self_signed_certificate() -> tuple[x509.Certificate, rsa.RSAPrivateKey]:
+    """A throwaway certificate (and its key) to sign callbacks"""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "Shinkansen stand-in")])
+    now = datetime.now(timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=365))
+        .sign(key, hashes.SHA256())
+    )
+    return certificate, key
+
+
+def certificate_pem(certificate: x509.Certificate) -> str:
+    return certificate.public_bytes(serialization.Encoding.PEM).decode("ascii")
+
+
+class CallbackScheduler:
+    """Sends callbacks when they are due, from a few worker threads"""
+
+    def __init__(self, config: StandinConfig) -> None:
+        self.config = config
+        self.n_sent = 0
+        self.n_failed = 0
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._session = requests.Session()
+        for i in range(config.callback_workers):
+            threading.Thread(
+                target=self._run, name=f"standin-callbacks-{i}", daemon=True
+            ).start()
+
+    def schedule(self, receiver: FinancialInstitution, responses: list):
+        due = time.monotonic() + self.config.callback_delay
+        with self._condition:
+            heapq.heappush(
+                self._queue, (due, next(self._sequence), receiver, responses)
+            )
+            self._condition.notify()
+
+    def _next(self) -> tuple:
+        with self._condition:
+            while True:
+                if self._queue:
+                    timeout = self._queue[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        return heapq.heappop(self._queue)
+                else:
+                    timeout = None
+                self._condition.wait(timeout)
+
+    def _run(self):
+        while True:
+            _, _, receiver, responses = self._next()
+            body = ResponseMessage(
+                header=MessageHeader(sender=SHINKANSEN, receiver=receiver),
+                responses=responses,
+            ).as_json()
+            signature = jws.sign(body, self.config.private_key, self.config.certificate)
+            try:
+                response = self._session.post(
+                    self.config.callback_url,
+                    data=body,
+                    headers={
+                        "Content-Type": "application/json",
+                        "Shinkansen-JWS-Signature": signature,
+                    },
+                    timeout=30,
+                )
+                response.raise_for_status()
+                self.n_sent += 1
+            except requests.RequestException as e:
+                self.n_failed += 1
+                logger.warning(
+                    f"Error sending callback to {self.config.callback_url}: {e}"
+                )
+
+
+def create_standin_app(config: StandinConfig) -> Flask:
+    standin = Flask("shinkansen_standin")
+    callbacks = CallbackScheduler(config) if config.callback_url else None
+    # Transactions of each message already received, so repeated messages get
+    # a 409 with the same ids (as the real API does):
+    seen_messages = {}
+    seen_messages_lock = threading.Lock()
+
+    def error(status: int, code: str, message: str):
+        return jsonify(errors=[dict(error_code=code, error_message=message)]), status
+
+    def receive(transaction_type: str):
+        time.sleep(
+            max(0, config.latency + random.uniform(-config.jitter, config.jitter))
+            / 1000
+        )
+        if not request.headers.get("Shinkansen-Api-Key"):
+            return error(401, "unauthorized", "Missing Shinkansen-Api-Key header")
+        body = request.get_data(as_text=True)
+        try:
+            jws.verify_detached(
+                body,
+                request.headers.get("Shinkansen-JWS-Signature", ""),
+                config.sender_certificates,
+            )
+        except jws.CertificateNotWhitelisted:
+            if config.sender_certificates:
+                return error(400, "invalid_signature", "Certificate not allowed")
+        except Exception as e:
+            return error(400, "invalid_signature", repr(e))
+        if random.random() < config.error_rate:
+            return error(500, "internal_error", "Simulated error")
+        document = request.get_json()["document"]
+        message_id = document["header"]["message_id"]
+        with seen_messages_lock:
+            known = seen_messages.get(message_id)
+            if known is None:
+                seen_messages[message_id] = [
+                    dict(
+                        transaction_id=tx["transaction_id"],
+                        shinkansen_transaction_id=str(uuid.uuid4()),
+                    )
+                    for tx in document["transactions"]
+                ]
+        if known is not None:
+            return jsonify(transactions=known), 409
+        transactions = seen_messages[message_id]
+        if transaction_type == "payin":
+            for tx in transactions:
+                tx[
+                    "interactive_payment_url"
+                ] = f"{request.host_url}pay/{tx['shinkansen_transaction_id']}"
+        if callbacks:
+            response_class = (
+                PayinResponse if transaction_type == "payin" else PayoutResponse
+            )
+            responses = []
+            for tx in transactions:
+                rejected = random.random() < config.rejection_rate
+                responses.append(
+                    response_class(
+                        transaction_id=tx["transaction_id"],
+                        shinkansen_transaction_id=tx["shinkansen_transaction_id"],
+                        shinkansen_transaction_status="completed",
+                        shinkansen_transaction_message="",
+                        response_status="rejected" if rejected else "ok",
+                        response_message="Simulated rejection" if rejected else "",
+                    )
+                )
+            sender = document["header"]["sender"]
+            callbacks.schedule(
+                FinancialInstitution(sender["fin_id"], sender["fin_id_schema"]),
+                responses,
+            )
+        return jsonify(transactions=transactions)
+
+    @standin.post("/v1/messages/payouts")
+    def post_payouts():
+        return receive("payout")
+
+    @standin.post("/v1/messages/payins")
+    def post_payins():
+        return receive("payin")
+
+    @standin.get("/stats")
+    def stats():
+        return jsonify(
+            messages=len(seen_messages),
+            callbacks_sent=callbacks.n_sent if callbacks else 0,
+            callbacks_failed=callbacks.n_failed if callbacks else 0,
+        )
+
+    return standin
@@ -25,5 +25,28 @@ document.addEventListener('DOMContentLoaded', function () {
         element.value = parseInt(Math.random() * 10000000)
         element.onblur()
     });    
+
+    // Patches the status of listed payouts/payins as their callbacks arrive
+    document.querySelectorAll("[data-status-events]").forEach(function(table) {
+        var connect = function() {
+            var source = new EventSource(table.dataset.statusEvents)
+            source.addEventListener("status", function(event) {
+                var change = JSON.parse(event.data)
+                var row = table.querySelector('tr[data-id="' + CSS.escape(change.id) + '"]')
+                if (!row) {
+                    return
+                }
+                row.querySelector(".status code").textContent = change.status
+                row.querySelector(".response-status code").textContent = change.response_status || ""
+            })
+            source.onerror = function() {
+                // Reconnects by itself, unless the server refused the stream
+                if (source.readyState === EventSource.CLOSED) {
+                    setTimeout(connect, 10000)
+                }
+            }
+        }
+        connect()
+    });
 }, false);
   
\ No newline at end of file
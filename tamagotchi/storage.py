@@ -0,0 +1,96 @@
+"""How we connect to the database.
+
+The database is the SQLite file at instance/db.sqlite unless
+TAMAGOTCHI_DATABASE_URL points somewhere else (any SQLAlchemy URL). SQLite
+connections are pooled (instead of opening the file on each checkout) and
+configured according to TAMAGOTCHI_SQLITE_MODE:
+
+- wal (the default): Write-ahead log, so readers don't block the writer (and
+  vice versa), synchronous=NORMAL (durable across crashes of the process, but
+  not necessarily of the OS), a bigger page cache, memory-mapped reads and a
+  busy timeout, so concurrent writers wait for each other instead of failing
+  with "database is locked".
+- rollback: SQLite's defaults (rollback journal, synchronous=FULL), to compare.
+"""
+
+import sqlalchemy
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import URL, Engine, make_url
+from sqlalchemy.pool import QueuePool, StaticPool
+from .settings import (
+    TAMAGOTCHI_SQLITE_MODE,
+    TAMAGOTCHI_SQLITE_BUSY_TIMEOUT,
+    TAMAGOTCHI_SQLITE_CACHE_SIZE,
+    TAMAGOTCHI_SQLITE_MMAP_SIZE,
+    TAMAGOTCHI_DB_POOL_SIZE,
+    TAMAGOTCHI_DB_MAX_OVERFLOW,
+)
+
+SQLITE_MODES = ("wal", "rollback")
+
+
+def sqlite_pragmas(mode: str) -> dict[str, object]:
+    if mode == "wal":
+        return {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": int(TAMAGOTCHI_SQLITE_BUSY_TIMEOUT * 1000),
+            "cache_size": -TAMAGOTCHI_SQLITE_CACHE_SIZE,  # Negative means KiB
+            "mmap_size": TAMAGOTCHI_SQLITE_MMAP_SIZE,
+            "temp_store": "MEMORY",
+        }
+    if mode == "rollback":
+        # journal_mode is stored in the file, so it must be set back:
+        return {
+            "journal_mode": "DELETE",
+            "synchronous": "FULL",
+            "busy_timeout": int(TAMAGOTCHI_SQLITE_BUSY_TIMEOUT * 1000),
+        }
+    raise ValueError(f"Unknown SQLite mode: {mode}")
+
+
+def engine_options(url: URL) -> dict:
+    """Options for create_engine(), on top of those given by Flask-SQLAlchemy"""
+    if url.get_backend_name() != "sqlite":
+        return {
+            "pool_size": TAMAGOTCHI_DB_POOL_SIZE,
+            "max_overflow": TAMAGOTCHI_DB_MAX_OVERFLOW,
+            "pool_pre_ping": True,
+        }
+    if url.database in (None, "", ":memory:"):
+        return {"poolclass": StaticPool, "connect_args": {"check_same_thread": False}}
+    return {
+        "poolclass": QueuePool,
+        "pool_size": TAMAGOTCHI_DB_POOL_SIZE,
+        "max_overflow": TAMAGOTCHI_DB_MAX_OVERFLOW,
+        # Pooled connections are used by whichever thread checks them out:
+        "connect_args": {
+            "check_same_thread": False,
+            "timeout": TAMAGOTCHI_SQLITE_BUSY_TIMEOUT,
+        },
+    }
+
+
+def create_engine(url, options: dict = None, mode: str = None) -> Engine:
+    """Creates an engine for url, configuring SQLite connections for mode
+    (TAMAGOTCHI_SQLITE_MODE by default)"""
+    url = make_url(url)
+    mode = mode or TAMAGOTCHI_SQLITE_MODE
+    engine = sqlalchemy.create_engine(url, **{**(options or {}), **engine_options(url)})
+    if url.get_backend_name() == "sqlite":
+        pragmas = sqlite_pragmas(mode)
+
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+            cursor.close()
+
+    return engine
+
+
+class Database(SQLAlchemy):
+    def create_engine(self, sa_url, engine_opts):
+        return create_engine(sa_url, engine_opts)
@@ -1,16 +1,24 @@
-from typing import Iterable, Optional, Iterator
+from typing import Iterable, Optional, Iterator, Tuple
 from .app import db, app
 from .utils import required_env
 from .settings import (
     TAMAGOTCHI,
     TAMAGOTCHI_ACCOUNT,
-    SHINKANSEN_BASE_URL,
-    TAMAGOTCHI_API_KEY,
-    TAMAGOTCHI_CERTIFICATE,
-    TAMAGOTCHI_CERTIFICATE_PRIVATE_KEY,
+    credentials,
+    TESTER_CONCURRENCY,
+    TESTER_RATE,
+    TESTER_WRITE_BATCH_SIZE,
+    TESTER_WRITE_DELAY,
+    TESTER_METRICS_FLUSH_INTERVAL,
 )
+import atexit
 import json
-from sqlalchemy.orm import relationship
+import math
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.orm import Session, relationship
 from sqlalchemy import func
 from shinkansen.payouts import (
     PayoutMessage,
@@ -21,6 +29,19 @@ from shinkansen.payouts import (
 )
 from shinkansen.common import PersonId, FinancialInstitution, CLP, SHINKANSEN
 from shinkansen.responses import Response
+from datetime import datetime
+from .buffering import WriteBehindBuffer
+from .histograms import Histogram, Timeline
+from .instrumentation import endpoint, phase
+from .models import ShinkansenTransactionOwner, utcnow
+from .parsing import parsed_payout_message, parsed_response
+from .transport import send
+
+
+# Tester messages and responses are group-committed, so a suite run isn't
+# dominated by one fsync per row. Flushed when a suite finishes and at exit.
+tester_writes = WriteBehindBuffer(TESTER_WRITE_BATCH_SIZE, TESTER_WRITE_DELAY)
+atexit.register(tester_writes.close)
 
 
 class TestMessage(db.Model):
@@ -32,19 +53,53 @@ class TestMessage(db.Model):
     http_response = db.Column(db.Text())
     error_message = db.Column(db.Text())
     transaction_id_mapping = db.Column(db.Text())
-    suite_id = db.Column(db.Integer, db.ForeignKey("test_suite.id"))
+    suite_id = db.Column(db.Integer, db.ForeignKey("test_suite.id"), index=True)
     suite = relationship("TestSuite", back_populates="messages")
 
 
 class TestResponse(db.Model):
     __tablename__ = "test_response"
+    __table_args__ = (
+        db.Index("ix_test_response_suite_transaction", "suite_id", "transaction_id"),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
     content = db.Column(db.Text())
+    # Our transaction id (not Shinkansen's), copied from content:
+    transaction_id = db.Column(db.String(64))
     suite_id = db.Column(db.Integer, db.ForeignKey("test_suite.id"))
     suite = relationship("TestSuite", back_populates="responses")
 
 
+def backfill_test_responses(batch_size: int = 500) -> int:
+    """Fills the transaction_id of responses stored before the column existed"""
+    n = 0
+    while True:
+        rows = (
+            TestResponse.query.filter(TestResponse.transaction_id.is_(None))
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            return n
+        for row in rows:
+            row.transaction_id = parsed_response(row.content).transaction_id or ""
+        db.session.commit()
+        n += len(rows)
+
+
+class TestSuiteMetric(db.Model):
+    """A latency histogram or a timeline of a suite, as recorded by one process
+    during a while. Reports merge all of them"""
+
+    __tablename__ = "test_suite_metric"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    suite_id = db.Column(db.Integer, db.ForeignKey("test_suite.id"), index=True)
+    name = db.Column(db.String(32))
+    content = db.Column(db.Text())
+
+
 class TestSuite(db.Model):
     __tablename__ = "test_suite"
 
@@ -53,12 +108,14 @@ class TestSuite(db.Model):
     messages = relationship("TestMessage", back_populates="suite")
     responses = relationship("TestResponse", back_populates="suite")
     status = db.Column(db.Text())
+    concurrency = db.Column(db.Integer)
+    rate = db.Column(db.Float)
 
     @classmethod
-    def start_new(cls) -> "TestSuite":
+    def start_new(cls, concurrency: int = None, rate: float = None) -> "TestSuite":
         if cls.current():
             raise RuntimeError("There is already a test suite in progress")
-        suite = cls(status="running")
+        suite = cls(status="running", concurrency=concurrency, rate=rate)
         db.session.add(suite)
         db.session.commit()
         return suite
@@ -68,16 +125,36 @@ class TestSuite(db.Model):
         return db.session.query(cls).filter(cls.status == "running").first()
 
     def finish(self):
+        suite_metrics(self.id).flush()
+        tester_writes.flush()
         self.status = "finished"
         db.session.commit()
 
-    def add_tester_response(self, response: Response):
+    def _save(self, *rows):
+        """Writes rows through the write-behind buffer, or right away (one
+        commit per call) if it is disabled"""
+        if TESTER_WRITE_BATCH_SIZE > 1:
+            tester_writes.add(*rows)
+        else:
+            db.session.add_all(rows)
+            db.session.commit()
+
+    def add_tester_response(self, response: Response, sent_at: datetime = None):
         if self.status != "running":
             raise RuntimeError("Test suite is not in progress")
-        self.responses.append(
-            TestResponse(content=json.dumps(response, default=lambda o: o.__dict__))
+        metrics = suite_metrics(self.id)
+        metrics.record_event("callbacks")
+        if sent_at:
+            latency = (utcnow() - sent_at).total_seconds() * 1000
+            metrics.record_latency("callback", latency)
+        # Not added to self.responses, to avoid loading every previous response
+        self._save(
+            TestResponse(
+                suite_id=self.id,
+                transaction_id=response.transaction_id,
+                content=json.dumps(response, default=lambda o: o.__dict__),
+            )
         )
-        db.session.commit()
 
     def add_tester_message(
         self,
@@ -85,22 +162,47 @@ class TestSuite(db.Model):
         message: PayoutMessage,
         http_response: PayoutHttpResponse,
         error_message: str,
+        sent_at: datetime = None,
     ):
         if self.status != "running":
             raise RuntimeError("Test suite is not in progress")
 
-        self.messages.append(
+        if http_response is not None:
+            self.add_transaction_owners(http_response, sent_at)
+        self._save(
             TestMessage(
+                suite_id=self.id,
                 content=message.as_json(),
                 http_response=json.dumps(http_response, default=lambda o: o.__dict__),
                 description=description,
                 error_message=error_message,
             )
         )
-        db.session.commit()
+
+    def add_transaction_owners(
+        self, http_response: PayoutHttpResponse, sent_at: datetime = None
+    ):
+        """Registers the suite as the owner of the transactions of a sent
+        message, so their callbacks find it (and when it was sent).
+
+        Committed right away (not buffered), so callbacks arriving soon after
+        find their suite. With a session of our own, as the caller's may be a
+        request's"""
+        owners = [
+            ShinkansenTransactionOwner(
+                shinkansen_transaction_id=shinkansen_transaction_id,
+                owner_type=ShinkansenTransactionOwner.TEST_SUITE,
+                owner_id=str(self.id),
+                sent_at=sent_at,
+            )
+            for shinkansen_transaction_id in http_response.transaction_ids.values()
+        ]
+        with Session(db.engine) as session:
+            session.add_all(owners)
+            session.commit()
 
     def shinkansen_messages(self) -> list[PayoutMessage]:
-        return [PayoutMessage.from_json(m.content) for m in self.messages]
+        return [parsed_payout_message(m.content) for m in self.messages]
 
     def transactions(self) -> list[PayoutTransaction]:
         return [
@@ -108,21 +210,196 @@ class TestSuite(db.Model):
         ]
 
     def shinkansen_responses(self) -> list[Response]:
-        return [Response.from_json_dict(json.loads(r.content)) for r in self.responses]
-
-    def transactions_with_responses(self) -> dict[PayoutTransaction, Response]:
-        # Inefficient, but shouldn't matter for small number of test transactions
+        return [parsed_response(r.content) for r in self.responses]
+
+    def transactions_with_responses(
+        self, transactions: list[PayoutTransaction] = None
+    ) -> dict[PayoutTransaction, Response]:
+        """Matches transactions (all of the suite's, unless already at hand)
+        and responses by transaction id with a dict, in linear time. If a
+        transaction got several responses, the last one wins"""
+        responses = {}
+        for transaction_id, content in (
+            db.session.query(TestResponse.transaction_id, TestResponse.content)
+            .filter(TestResponse.suite_id == self.id)
+            .order_by(TestResponse.id)
+        ):
+            response = parsed_response(content)
+            responses[transaction_id or response.transaction_id] = response
         return {
-            tx: r
-            for tx in self.transactions()
-            for r in self.shinkansen_responses()
-            if tx.transaction_id == r.transaction_id
+            tx: responses[tx.transaction_id]
+            for tx in (self.transactions() if transactions is None else transactions)
+            if tx.transaction_id in responses
         }
 
 
+LATENCIES = {
+    "sign": "Signing",
+    "http": "HTTP round-trip",
+    "callback": "Send to callback",
+}
+EVENTS = {"sent": "Sent", "callbacks": "Callbacks"}
+
+
+class SuiteMetrics:
+    """The latencies and events of a suite recorded by this process since they
+    were last flushed (as TestSuiteMetric rows)"""
+
+    def __init__(self, suite_id: int) -> None:
+        self.suite_id = suite_id
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.histograms = {name: Histogram() for name in LATENCIES}
+        self.timelines = {name: Timeline() for name in EVENTS}
+
+    def record_latency(self, name: str, milliseconds: float):
+        with self._lock:
+            self.histograms[name].record(milliseconds)
+
+    def record_event(self, name: str, at: float = None):
+        with self._lock:
+            self.timelines[name].record(at)
+
+    def flush(self):
+        with self._lock:
+            metrics = {**self.histograms, **self.timelines}
+            self._reset()
+        rows = [
+            TestSuiteMetric(suite_id=self.suite_id, name=name, content=m.as_json())
+            for name, m in metrics.items()
+            if m.count
+        ]
+        if rows:
+            tester_writes.add(*rows)
+
+
+_suite_metrics: dict[int, SuiteMetrics] = {}
+_suite_metrics_lock = threading.Lock()
+
+
+def suite_metrics(suite_id: int) -> SuiteMetrics:
+    with _suite_metrics_lock:
+        if not _suite_metrics:
+            threading.Thread(
+                target=_flush_suite_metrics_periodically,
+                name="suite-metrics",
+                daemon=True,
+            ).start()
+        if suite_id not in _suite_metrics:
+            _suite_metrics[suite_id] = SuiteMetrics(suite_id)
+        return _suite_metrics[suite_id]
+
+
+def flush_suite_metrics():
+    with _suite_metrics_lock:
+        metrics = list(_suite_metrics.values())
+    for m in metrics:
+        m.flush()
+
+
+def _flush_suite_metrics_periodically():
+    while True:
+        time.sleep(TESTER_METRICS_FLUSH_INTERVAL)
+        flush_suite_metrics()
+
+
+# Registered after tester_writes.close, so it runs before it
+atexit.register(flush_suite_metrics)
+
+
+def suite_report(suite_id: int, max_intervals: int = 60) -> dict:
+    """Latency percentiles (in ms) and throughput over time of a suite"""
+    histograms = {name: Histogram() for name in LATENCIES}
+    timelines = {name: Timeline() for name in EVENTS}
+    for metric in TestSuiteMetric.query.filter_by(suite_id=suite_id):
+        if metric.name in histograms:
+            histograms[metric.name].merge(Histogram.from_json(metric.content))
+        elif metric.name in timelines:
+            timelines[metric.name].merge(Timeline.from_json(metric.content))
+    seconds = [s for t in timelines.values() for s in t.counts]
+    throughput = []
+    if seconds:
+        start, end = min(seconds), max(seconds)
+        width = max(1, math.ceil((end - start + 1) / max_intervals))
+        for offset in range(0, end - start + 1, width):
+            throughput.append(
+                {
+                    "second": offset,
+                    **{
+                        name: sum(
+                            t.counts.get(start + offset + i, 0) for i in range(width)
+                        )
+                        / width
+                        for name, t in timelines.items()
+                    },
+                }
+            )
+    return {
+        "suite_id": suite_id,
+        "latencies": {name: h.summary() for name, h in histograms.items()},
+        "events": {name: t.count for name, t in timelines.items()},
+        "throughput": throughput,
+    }
+
+
+# Cancellation flags of the suites being run by this process
+_running_suites: dict[int, threading.Event] = {}
+
+
 def finish_suite():
     suite = TestSuite.current()
     suite.finish()
+    cancelled = _running_suites.get(suite.id)
+    if cancelled:
+        cancelled.set()
+
+
+def benchmark_tester_writes(n_rows: int, n_threads: int) -> dict[str, float]:
+    """Compares how many tester messages per second we can store committing
+    each one vs. through the write-behind buffer, on a scratch SQLite file"""
+    from .storage import create_engine
+
+    creditor = PayoutCreditor(
+        name="Benchmark",
+        identification=PersonId("CLID", "11111111-1"),
+        financial_institution=FinancialInstitution("SIMULATED_BANK"),
+        account="1",
+        account_type="current_account",
+        email="benchmark@example.org",
+    )
+    content = single_payout(creditor).as_json()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{directory}/benchmark.sqlite")
+        db.metadata.create_all(
+            engine, tables=[TestSuite.__table__, TestMessage.__table__]
+        )
+
+        def per_row_commit(i: int):
+            with Session(engine) as session:
+                session.add(TestMessage(content=content, description=str(i)))
+                session.commit()
+
+        buffer = WriteBehindBuffer(
+            TESTER_WRITE_BATCH_SIZE, TESTER_WRITE_DELAY, lambda: Session(engine)
+        )
+
+        def write_behind(i: int):
+            buffer.add(TestMessage(content=content, description=str(i)))
+
+        for name, write, done in (
+            ("per_row_commit", per_row_commit, lambda: None),
+            ("write_behind", write_behind, buffer.close),
+        ):
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                list(executor.map(write, range(n_rows)))
+            done()
+            results[name] = n_rows / (time.perf_counter() - start)
+        engine.dispose()
+    return results
 
 
 def creditor_from_colon_separated_string(string: str) -> PayoutCreditor:
@@ -144,20 +421,19 @@ def creditors() -> list[PayoutCreditor]:
     ]
 
 
-def run_new_suite():
-    suite = TestSuite.start_new()
-    messages = [
-        [
+def suite_messages() -> list[Tuple[str, PayoutMessage]]:
+    return [
+        (
             f"One peso single payout {i}-{j}",
             single_payout(creditor, str((i * 500) + (j + 1)), f"Test {i}-{j}"),
-        ]
+        )
         for i, creditor in enumerate(creditors())
         for j in range(500)
         # ] + [
         #     [f"Few pesos multi payout {i}", few_pesos_multiple_payouts(creditor)]
         #     for i, creditor in enumerate(creditors())
     ] + [
-        [f"Too many pesos single payout {i}", too_many_pesos_single_payout(creditor)]
+        (f"Too many pesos single payout {i}", too_many_pesos_single_payout(creditor))
         for i, creditor in enumerate(creditors())
         # ] + [
         #     [f"Mixed creditors", mixed_with_different_creditors(creditors())]
@@ -165,35 +441,141 @@ def run_new_suite():
         #     [f"Lots of payouts {i}", lots_of_one_peso_payouts(creditor)]
         #     for i, creditor in enumerate(creditors())
     ]
-    app.logger.warning(f"Running {len(messages)} messages")
-    for description, message in messages:
-        try:
-            error_message = None
-            signature, http_response = message.sign_and_send(
-                TAMAGOTCHI_CERTIFICATE_PRIVATE_KEY,
-                TAMAGOTCHI_CERTIFICATE,
-                TAMAGOTCHI_API_KEY,
-                base_url=SHINKANSEN_BASE_URL,
-            )
-        except Exception as e:
-            error_message = repr(e)
-        suite.add_tester_message(description, message, http_response, error_message)
-    app.logger.warning(f"{len(messages)} messages sent")
 
 
-def execute_tester_message(description: str, message: PayoutMessage):
+def run_new_suite(concurrency: int = None, rate: float = None) -> "TestSuite":
+    """Starts a new suite and sends its messages in a background thread.
+
+    At most `concurrency` messages are in flight at once and, if `rate` is set,
+    at most `rate` messages are sent per second. The run stops early if the
+    suite is finished (see finish_suite())
+    """
+    concurrency = concurrency or TESTER_CONCURRENCY
+    rate = rate or TESTER_RATE
+    with phase("build"):
+        messages = suite_messages()
+    suite = TestSuite.start_new(concurrency, rate)
+    cancelled = threading.Event()
+    _running_suites[suite.id] = cancelled
+    threading.Thread(
+        target=_run_suite,
+        args=(suite.id, messages, concurrency, rate, cancelled),
+        name=f"tester-suite-{suite.id}",
+        daemon=True,
+    ).start()
+    return suite
+
+
+class Pacer:
+    """Spaces out calls to wait() so they happen at most `rate` times per second"""
+
+    def __init__(self, rate: Optional[float]) -> None:
+        self.interval = 1 / rate if rate else 0
+        self.next_at = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self.next_at > now:
+            time.sleep(self.next_at - now)
+        self.next_at = max(self.next_at, now) + self.interval
+
+
+def _suite_is_running(suite_id: int) -> bool:
+    status = db.session.query(TestSuite.status).filter_by(id=suite_id).scalar()
+    db.session.commit()  # Don't keep a read transaction open while sending
+    return status == "running"
+
+
+def _run_suite(
+    suite_id: int,
+    messages: list[Tuple[str, PayoutMessage]],
+    concurrency: int,
+    rate: Optional[float],
+    cancelled: threading.Event,
+):
+    n_sent = 0
     try:
-        error_message = None
-        signature, http_response = message.sign_and_send(
-            TAMAGOTCHI_CERTIFICATE_PRIVATE_KEY,
-            TAMAGOTCHI_CERTIFICATE,
-            TAMAGOTCHI_API_KEY,
-            base_url=SHINKANSEN_BASE_URL,
-        )
+        with app.app_context():
+            app.logger.warning(
+                f"Running {len(messages)} messages "
+                f"(concurrency: {concurrency}, rate: {rate or 'unlimited'}/s)"
+            )
+            pacer = Pacer(rate)
+            in_flight = threading.BoundedSemaphore(concurrency)
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for description, message in messages:
+                    # The suite can also be finished from another process:
+                    if cancelled.is_set() or (
+                        n_sent % 50 == 0 and not _suite_is_running(suite_id)
+                    ):
+                        app.logger.warning(f"Suite {suite_id} cancelled")
+                        break
+                    pacer.wait()
+                    in_flight.acquire()
+                    executor.submit(
+                        _execute_suite_message, suite_id, description, message
+                    ).add_done_callback(lambda _: in_flight.release())
+                    n_sent += 1
+            app.logger.warning(f"{n_sent} messages sent")
+    except Exception:
+        app.logger.exception(f"Error running suite {suite_id}")
+    finally:
+        _running_suites.pop(suite_id, None)
+
+
+def sign_and_send_tester_message(
+    message: PayoutMessage, suite_id: int
+) -> Tuple[Optional[PayoutHttpResponse], Optional[str], datetime]:
+    """Returns the http response (if any), the error message (if any) and when
+    the message was sent. Also records timings in the suite metrics"""
+    metrics = suite_metrics(suite_id)
+    sent_at = utcnow()
+    try:
+        start = time.perf_counter()
+        with phase("sign"):
+            signature = message.signature(
+                credentials.private_key, credentials.certificate
+            )
+        signed = time.perf_counter()
+        metrics.record_latency("sign", (signed - start) * 1000)
+        sent_at = utcnow()
+        metrics.record_event("sent")
+        http_response = send(message, signature)
+        metrics.record_latency("http", (time.perf_counter() - signed) * 1000)
+        return http_response, None, sent_at
     except Exception as e:
-        error_message = repr(e)
+        return None, repr(e), sent_at
+
+
+def _execute_suite_message(suite_id: int, description: str, message: PayoutMessage):
+    with endpoint("tester"):
+        http_response, error_message, sent_at = sign_and_send_tester_message(
+            message, suite_id
+        )
+    with app.app_context(), endpoint("tester"):
+        suite = TestSuite.query.get(suite_id)
+        if suite.status != "running":
+            app.logger.warning(f"Suite {suite_id} finished before {description}")
+            if http_response is not None:
+                # Sent anyway, so its callbacks must still find the suite (and
+                # not be taken for unknown and forwarded):
+                suite.add_transaction_owners(http_response, sent_at)
+            return
+        suite.add_tester_message(
+            description, message, http_response, error_message, sent_at
+        )
+
+
+def execute_tester_message(description: str, message: PayoutMessage):
     suite = TestSuite.current()
-    suite.add_tester_message(description, message, http_response, error_message)
+    http_response, error_message, sent_at = sign_and_send_tester_message(
+        message, suite.id
+    )
+    suite.add_tester_message(
+        description, message, http_response, error_message, sent_at
+    )
 
 
 def single_payout(
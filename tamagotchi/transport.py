@@ -0,0 +1,112 @@
+import threading
+from typing import Tuple, Union
+import requests
+from requests.adapters import HTTPAdapter
+from shinkansen.payouts import PayoutMessage, PayoutHttpResponse
+from shinkansen.payins import PayinMessage, PayinHttpResponse
+from .instrumentation import phase
+from .settings import (
+    credentials,
+    SHINKANSEN_BASE_URL,
+    TAMAGOTCHI_HTTP_POOL_SIZE,
+    TAMAGOTCHI_HTTP_TIMEOUT,
+)
+
+
+class Transport:
+    """A process-wide HTTP session for everything we send to Shinkansen (or
+    forward to others).
+
+    Connections are kept alive and reused (along with their TLS sessions) from
+    a pool of up to pool_size connections per host, so a burst of messages
+    doesn't pay a TCP and TLS handshake for each of them. Requests beyond
+    pool_size in flight wait for a connection instead of opening throwaway
+    ones.
+    """
+
+    def __init__(self, pool_size: int, timeout: float = None) -> None:
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.n_requests = 0
+        self.n_errors = 0
+        self.session = requests.Session()
+        self._adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True
+        )
+        self.session.mount("https://", self._adapter)
+        self.session.mount("http://", self._adapter)
+        self._lock = threading.Lock()
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        try:
+            response = self.session.post(url, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self.n_errors += 1
+            raise
+        with self._lock:
+            self.n_requests += 1
+        return response
+
+    def stats(self) -> dict:
+        hosts = {}
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            # The pool queue has a slot for each connection not in use, which
+            # is None if the connection hasn't been opened (or was discarded):
+            available = list(pool.pool.queue)
+            hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "in_use": pool.pool.maxsize - len(available),
+                "idle": sum(1 for connection in available if connection),
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+            }
+        with self._lock:
+            n_requests, n_errors = self.n_requests, self.n_errors
+        return {
+            "pool_size": self.pool_size,
+            "requests": n_requests,
+            "errors": n_errors,
+            "connections_opened": sum(
+                host["connections_opened"] for host in hosts.values()
+            ),
+            "hosts": hosts,
+        }
+
+
+transport = Transport(TAMAGOTCHI_HTTP_POOL_SIZE, TAMAGOTCHI_HTTP_TIMEOUT)
+
+
+def send(
+    message: Union[PayoutMessage, PayinMessage], signature: str, base_url: str = None
+) -> Union[PayoutHttpResponse, PayinHttpResponse]:
+    """Sends a signed message to the Shinkansen API through the shared
+    transport (the same request as message.send(), on a pooled connection)"""
+    if isinstance(message, PayinMessage):
+        path, response_class = "payins", PayinHttpResponse
+    else:
+        path, response_class = "payouts", PayoutHttpResponse
+    with phase("http"):
+        response = transport.post(
+            f"{base_url or SHINKANSEN_BASE_URL}/messages/{path}",
+            data=message.as_json(),
+            headers={
+                "Content-Type": "application/json",
+                "Shinkansen-Api-Key": credentials.api_key,
+                "Shinkansen-JWS-Signature": signature,
+            },
+        )
+    return response_class.from_http_response(response)
+
+
+def sign_and_send(
+    message: Union[PayoutMessage, PayinMessage], base_url: str = None
+) -> Tuple[str, Union[PayoutHttpResponse, PayinHttpResponse]]:
+    """Signs a message with our certificate and sends it (see send())"""
+    with phase("sign"):
+        signature = message.signature(credentials.private_key, credentials.certificate)
+    return signature, send(message, signature, base_url)
@@ -1,41 +1,57 @@
-import re
-import requests
-from .constants import MX_BANKS_CODES
-from typing import Optional, Tuple
-from flask import render_template, redirect, request, flash, abort
-from shinkansen.responses import ResponseMessage
-from shinkansen.common import (
-    SHINKANSEN,
-    MAIN_BANKS,
-    ACCOUNT_TYPES,
-    CLP,
-    MessageHeader,
-    FinancialInstitution,
-    PersonId,
-)
-from shinkansen.payouts import PayoutMessage, PayoutTransaction, PayoutCreditor
-from shinkansen.payins import (
-    PayinMessage,
-    PayinTransaction,
-    PayinDebtor,
-    INTERACTIVE_PAYMENT,
+from datetime import datetime, timedelta
+from typing import Optional
+from flask import (
+    Response,
+    redirect,
+    request,
+    flash,
+    abort,
+    jsonify,
+    stream_with_context,
 )
+from shinkansen.responses import ResponseMessage
+from shinkansen.common import MAIN_BANKS, ACCOUNT_TYPES
+from sqlalchemy.exc import IntegrityError
 from .app import app, db
 from .models import (
     PersistedSingleTransactionPayoutMessage,
     PersistedSingleTransactionPayinMessage,
+    utcnow,
+)
+from .bulk import BulkPayoutJob, ingest, start_draining
+from .callbacks import apply_response_message
+from .changes import conditional
+from . import events
+from .export import FORMATS as EXPORT_FORMATS, MIMETYPES, export
+from .dedup import callback_dedup, callback_digest
+from .forwarder import forwarder
+from .instrumentation import count, phase, prometheus_text, render_template
+from .keyring import shinkansen_keyring
+from . import inbox
+from .forms import (
+    payout_transaction_from_form_input,
+    payin_transaction_from_form_input,
+)
+from .pagination import keyset_page
+from . import rollups
+from .parsing import parse_cache
+from .transport import transport
+from .sender import send_payout, send_single_payin
+from .tester import (
+    LATENCIES,
+    EVENTS,
+    TestSuite,
+    run_new_suite,
+    finish_suite,
+    suite_report,
 )
-from .tester import TestSuite, run_new_suite, finish_suite
 from .settings import (
-    TAMAGOTCHI,
-    TAMAGOTCHI_ACCOUNTS,
-    TAMAGOTCHI_API_KEY,
-    TAMAGOTCHI_CERTIFICATE,
-    TAMAGOTCHI_CERTIFICATE_PRIVATE_KEY,
-    SHINKANSEN_CERTIFICATES,
     TAMAGOTCHI_MAX_AMOUNT,
-    SHINKANSEN_BASE_URL,
-    SHINKANSEN_FORWARD_URL,
+    TAMAGOTCHI_PAGE_SIZE,
+    TAMAGOTCHI_MAX_PAGE_SIZE,
+    TAMAGOTCHI_CALLBACK_INBOX,
+    TESTER_CONCURRENCY,
+    TESTER_RATE,
 )
 from .utils import required_env
 
@@ -55,106 +71,116 @@ def verify_password(username, password):
         return True
 
 
-def force_rut_format(raw_rut: str) -> str:
-    rut = re.sub(r"[^\dkK]+", "", raw_rut)
-    return rut[:-1] + "-" + rut[-1]
+@app.get("/")
+@auth.login_required
+def index():
+    return redirect("/payouts/")
 
 
-def creditor_from_form_input(form: dict) -> PayoutCreditor:
-    name = form["name"]
-    id_schema = form["id_schema"]
-    if id_schema == "CLID":
-        id = force_rut_format(form["rut"])
-    else:
-        id = form["id"]
-    email = form["email"]
-    bank_id = form.get("bank_id")
-    financial_institution = FinancialInstitution(bank_id) if bank_id else None
-    account_number = form["account_number"]
-    account_type = form["account_type"]
-
-    if account_type == "clabe":
-        bank_code = account_number[:3]
-        fin_id = MX_BANKS_CODES.get(bank_code, None)
-        financial_institution = FinancialInstitution(fin_id) if fin_id else None
-
-    return PayoutCreditor(
-        name=name,
-        identification=PersonId(id_schema, id),
-        financial_institution=financial_institution,
-        account=account_number,
-        account_type=account_type,
-        email=email,
-    )
+def date_from_args(args: dict, key: str) -> Optional[datetime]:
+    if not args.get(key):
+        return None
+    try:
+        return datetime.strptime(args[key], "%Y-%m-%d")
+    except ValueError:
+        abort(400, f"Invalid {key} date (expected YYYY-MM-DD)")
+
+
+def filtered_query(model, args: dict):
+    """Applies the listing filters present in args to a query over model"""
+    query = model.query
+    for column in ("status", "currency", "creditor_id"):
+        if args.get(column) and hasattr(model, column):
+            query = query.filter(getattr(model, column) == args[column])
+    date_from = date_from_args(args, "from")
+    if date_from:
+        query = query.filter(model.created_at >= date_from)
+    date_to = date_from_args(args, "to")
+    if date_to:
+        query = query.filter(model.created_at < date_to + timedelta(days=1))
+    return query
+
+
+def listing_page(model, args: dict):
+    try:
+        per_page = int(args.get("per_page", TAMAGOTCHI_PAGE_SIZE))
+        return keyset_page(
+            filtered_query(model, args),
+            model,
+            args.get("cursor"),
+            max(1, min(per_page, TAMAGOTCHI_MAX_PAGE_SIZE)),
+        )
+    except ValueError as e:
+        abort(400, str(e))
 
 
-def payout_transaction_from_form_input(form: dict) -> PayoutTransaction:
-    amount = re.sub(r"[^\d.]+", "", form["amount"])
-    description = form["description"]
-    currency = form["currency"] or "CLP"
-    if TAMAGOTCHI_MAX_AMOUNT and int(amount) > int(TAMAGOTCHI_MAX_AMOUNT):
-        amount = TAMAGOTCHI_MAX_AMOUNT
-    return PayoutTransaction(
-        currency=currency,
-        amount=amount,
-        description=description,
-        debtor=TAMAGOTCHI_ACCOUNTS[currency],
-        creditor=creditor_from_form_input(form),
-    )
+def filter_args(args: dict) -> dict:
+    """The args to keep when moving between pages"""
+    return {k: v for k, v in args.items() if k != "cursor" and v}
 
 
-def payin_transaction_from_form_input(form: dict) -> PayinTransaction:
-    amount = re.sub(r"[^\d]+", "", form["amount"])
-    description = form["description"]
-    currency = form["currency"] or "CLP"
-    payin_transaction = PayinTransaction(
-        payin_type=INTERACTIVE_PAYMENT,
-        currency=currency,
-        amount=amount,
-        description=description,
-        creditor=TAMAGOTCHI_ACCOUNTS[currency],
+@app.get("/payouts/")
+@auth.login_required
+@conditional("payouts")
+def payouts():
+    page = listing_page(PersistedSingleTransactionPayoutMessage, request.args)
+    return render_template(
+        "payouts.html",
+        payouts=page.items,
+        page=page,
+        filters=filter_args(request.args),
     )
-    add_interactive_payment_urls_to_transaction(payin_transaction)
-    return payin_transaction
 
 
-def add_interactive_payment_urls_to_transaction(payin_transaction: PayinTransaction):
-    payin_transaction.interactive_payment_success_redirect_url = (
-        request.root_url
-        + "payins/interactive-success?transaction_id="
-        + payin_transaction.transaction_id
+@app.get("/payins/")
+@auth.login_required
+@conditional("payins")
+def payins():
+    page = listing_page(PersistedSingleTransactionPayinMessage, request.args)
+    return render_template(
+        "payins.html",
+        payins=page.items,
+        page=page,
+        filters=filter_args(request.args),
     )
-    payin_transaction.interactive_payment_failure_redirect_url = (
-        request.root_url
-        + "payins/interactive-failure?transaction_id="
-        + payin_transaction.transaction_id
+
+
+def export_response(model, name: str) -> Response:
+    format = request.args.get("format", "csv")
+    if format not in EXPORT_FORMATS:
+        abort(400, f"Invalid format (expected one of {', '.join(EXPORT_FORMATS)})")
+    query = filtered_query(model, request.args)
+    filename = f"{name}-{utcnow():%Y%m%d%H%M%S}.{format}"
+    return Response(
+        # The request context (and its session) lives until the export ends:
+        stream_with_context(export(query, model, format)),
+        mimetype=MIMETYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
 
 
-def new_header() -> MessageHeader:
-    return MessageHeader(sender=TAMAGOTCHI, receiver=SHINKANSEN)
+@app.get("/payouts/export")
+@auth.login_required
+def export_payouts():
+    return export_response(PersistedSingleTransactionPayoutMessage, "payouts")
 
 
-@app.get("/")
+@app.get("/payins/export")
 @auth.login_required
-def index():
-    return redirect("/payouts/")
+def export_payins():
+    return export_response(PersistedSingleTransactionPayinMessage, "payins")
 
 
-@app.get("/payouts/")
+@app.get("/payouts/events")
 @auth.login_required
-def payouts():
-    return render_template(
-        "payouts.html", payouts=PersistedSingleTransactionPayoutMessage.query.all()
-    )
+def payout_events():
+    return events.stream("payout", request.headers.get("Last-Event-ID"))
 
 
-@app.get("/payins/")
+@app.get("/payins/events")
 @auth.login_required
-def payins():
-    return render_template(
-        "payins.html", payins=PersistedSingleTransactionPayinMessage.query.all()
-    )
+def payin_events():
+    return events.stream("payin", request.headers.get("Last-Event-ID"))
 
 
 @app.get("/payins/interactive-success")
@@ -180,26 +206,10 @@ def payins_interactive_failure():
 @app.post("/payouts/")
 @auth.login_required
 def post_payout():
-    single_payout_message = PayoutMessage(
-        header=new_header(),
-        transactions=[payout_transaction_from_form_input(request.form)],
-    )
-    signature, response = single_payout_message.sign_and_send(
-        TAMAGOTCHI_CERTIFICATE_PRIVATE_KEY,
-        TAMAGOTCHI_CERTIFICATE,
-        TAMAGOTCHI_API_KEY,
-        base_url=SHINKANSEN_BASE_URL,
-    )
-    if response.http_status_code in (200, 409):
-        shinkansen_transaction_id = response.transaction_ids[
-            single_payout_message.transactions[0].transaction_id
-        ]
-        persisted_payout = PersistedSingleTransactionPayoutMessage(
-            message=single_payout_message,
-            signature=signature,
-            shinkansen_transaction_id=shinkansen_transaction_id,
-        )
-        db.session.add(persisted_payout)
+    with phase("build"):
+        transaction = payout_transaction_from_form_input(request.form)
+    persisted_payout, response = send_payout(transaction)
+    if persisted_payout:
         db.session.commit()
     else:
         flash(
@@ -214,33 +224,14 @@ def post_payout():
 @app.post("/payins/")
 @auth.login_required
 def post_payin():
-    single_payin_message = PayinMessage(
-        header=new_header(),
-        transactions=[payin_transaction_from_form_input(request.form)],
-    )
-    app.logger.info(f"Sending payin message: {single_payin_message.as_json()}")
-
-    signature, response = single_payin_message.sign_and_send(
-        TAMAGOTCHI_CERTIFICATE_PRIVATE_KEY,
-        TAMAGOTCHI_CERTIFICATE,
-        TAMAGOTCHI_API_KEY,
-        base_url=SHINKANSEN_BASE_URL,
-    )
-    if response.http_status_code in (200, 409):
-        shinkansen_transaction_id = response.transaction_ids[
-            single_payin_message.transactions[0].transaction_id
-        ]
-        interactive_payment_url = response.interactive_payment_urls[
-            single_payin_message.transactions[0].transaction_id
-        ]
-        persisted_payin = PersistedSingleTransactionPayinMessage(
-            message=single_payin_message,
-            signature=signature,
-            shinkansen_transaction_id=shinkansen_transaction_id,
-        )
-        db.session.add(persisted_payin)
+    with phase("build"):
+        payin_transaction = payin_transaction_from_form_input(request.form)
+    persisted_payin, response = send_single_payin(payin_transaction)
+    if persisted_payin:
         db.session.commit()
-        return redirect(interactive_payment_url)
+        return redirect(
+            response.interactive_payment_urls[payin_transaction.transaction_id]
+        )
     else:
         flash(
             "Error al enviar payin a Shinkansen: "
@@ -251,8 +242,52 @@ def post_payin():
         return redirect("/payins/")
 
 
+@app.get("/payouts/bulk/")
+@auth.login_required
+def bulk_payouts():
+    return render_template(
+        "bulk_payouts.html",
+        jobs=BulkPayoutJob.query.order_by(BulkPayoutJob.id.desc()).limit(50).all(),
+    )
+
+
+@app.post("/payouts/bulk/")
+@auth.login_required
+def post_bulk_payouts():
+    file = request.files.get("file")
+    if not file or not file.filename:
+        flash("Debe seleccionar un archivo CSV o NDJSON", "error")
+        return redirect("/payouts/bulk/")
+    job = ingest(file.stream, file.filename, request.form.get("format") or None)
+    start_draining(job.id)
+    return redirect(f"/payouts/bulk/{job.id}")
+
+
+@app.get("/payouts/bulk/<int:id>")
+@auth.login_required
+def bulk_payout_job(id: int):
+    job = BulkPayoutJob.query.get_or_404(id)
+    return render_template(
+        "bulk_payout_job.html",
+        job=job,
+        errors=job.errors(after_row=request.args.get("after_row", 0, type=int)),
+    )
+
+
+@app.get("/payouts/bulk/<int:id>/status")
+@auth.login_required
+def bulk_payout_job_status(id: int):
+    job = BulkPayoutJob.query.get_or_404(id)
+    errors = job.errors(
+        after_row=request.args.get("after_row", 0, type=int),
+        limit=min(request.args.get("limit", 100, type=int), 1000),
+    )
+    return jsonify(dict(job.as_json_dict(), errors=[e.as_json_dict() for e in errors]))
+
+
 @app.get("/payouts/<id>")
 @auth.login_required
+@conditional("payouts")
 def payin(id: str):
     return render_template(
         "payout.html", payout=PersistedSingleTransactionPayoutMessage.query.get(id)
@@ -261,6 +296,7 @@ def payin(id: str):
 
 @app.get("/payins/<id>")
 @auth.login_required
+@conditional("payins")
 def payout(id: str):
     return render_template(
         "payin.html", payin=PersistedSingleTransactionPayinMessage.query.get(id)
@@ -364,70 +400,121 @@ def signature_from_request(request) -> str:
 
 def verify_signature(message: ResponseMessage, signature: str):
     try:
-        message.verify(signature, SHINKANSEN_CERTIFICATES, SHINKANSEN, TAMAGOTCHI)
+        with phase("verify"):
+            shinkansen_keyring.verify_response_message(message, signature)
     except Exception as e:
         app.logger.error(f"Error verifying signature: {e}")
         abort(400, "Error verifying signature")
 
 
-def persisted_message_for_shinkansen_transaction_id(
-    shinkansen_transaction_id: str,
-) -> Optional[PersistedSingleTransactionPayoutMessage]:
-    return (
-        PersistedSingleTransactionPayoutMessage.query.filter_by(
-            shinkansen_transaction_id=shinkansen_transaction_id
-        ).first()
-        or PersistedSingleTransactionPayinMessage.query.filter_by(
-            shinkansen_transaction_id=shinkansen_transaction_id
-        ).first()
-    )
-
-
 @app.post("/shinkansen/messages/")
 def post_shinkansen_message():
+    content = request.get_data(as_text=True)
+    count("callbacks_received")
+    digest = callback_digest(content)
+    if callback_dedup.seen(digest):
+        app.logger.info("Acknowledging already processed message: %s", digest)
+        count("callbacks_duplicated")
+        return ("", 200)
+    if TAMAGOTCHI_CALLBACK_INBOX:
+        # Verified and applied later, by the inbox worker:
+        inbox.append(content, signature_from_request(request))
+        return ("", 200)
     message = response_message_from_request(request)
     signature = signature_from_request(request)
     verify_signature(message, signature)
-    for response in message.responses:
-        persisted_message = persisted_message_for_shinkansen_transaction_id(
-            response.shinkansen_transaction_id
-        )
-        if persisted_message:
-            persisted_message.response_content = message.original_json
-            persisted_message.response_signature = signature
-        else:
-            if TestSuite.current():
-                TestSuite.current().add_tester_response(response)
-            else:
-                if SHINKANSEN_FORWARD_URL:
-                    app.logger.info(f"Forwarding response to {SHINKANSEN_FORWARD_URL}")
-                    response = requests.post(
-                        url=SHINKANSEN_FORWARD_URL,
-                        data=request.get_data(),
-                        headers={
-                            "Content-Type": "application/json",
-                            "Shinkansen-JWS-Signature": signature,
-                        },
-                    )
-                    app.logger.info(f"Forwarding response: {response}")
-                else:
-                    app.logger.error(
-                        "Received response for unknown transaction: %s",
-                        response.shinkansen_transaction_id,
-                    )
-    db.session.commit()
+    routed = apply_response_message(message, content, signature)
+    callback_dedup.record(digest)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        if not callback_dedup.seen(digest, count=False):
+            raise
+        # Another copy of the message was applied (and committed) meanwhile:
+        app.logger.info("Acknowledging concurrently processed message: %s", digest)
+        count("callbacks_duplicated")
+        return ("", 200)
+    callback_dedup.remember(digest)
+    routed.after_commit()
     return ("", 200)
 
 
+@app.get("/inbox/")
+@auth.login_required
+def inbox_stats():
+    return jsonify(inbox.stats())
+
+
+@app.get("/keyring/")
+@auth.login_required
+def keyring_stats():
+    return jsonify(shinkansen_keyring.stats())
+
+
+@app.post("/keyring/reload")
+@auth.login_required
+def keyring_reload():
+    shinkansen_keyring.reload()
+    return jsonify(shinkansen_keyring.stats())
+
+
+@app.get("/forwarder/")
+@auth.login_required
+def forwarder_stats():
+    return jsonify(forwarder.stats() if forwarder else {"url": None})
+
+
+@app.get("/callback-dedup/")
+@auth.login_required
+def callback_dedup_stats():
+    return jsonify(callback_dedup.stats())
+
+
+@app.get("/parse-cache/")
+@auth.login_required
+def parse_cache_stats():
+    return jsonify(parse_cache.stats())
+
+
+@app.get("/metrics")
+@auth.login_required
+def metrics():
+    return Response(prometheus_text(), mimetype="text/plain; version=0.0.4")
+
+
+@app.get("/totals/")
+@auth.login_required
+def totals():
+    return jsonify(rollups.summary(date_from_args(request.args, "day")))
+
+
+@app.get("/status-events/")
+@auth.login_required
+def status_events_stats():
+    return jsonify(events.broadcaster.stats())
+
+
+@app.get("/http-pool/")
+@auth.login_required
+def http_pool_stats():
+    return jsonify(transport.stats())
+
+
 # Extra endpoints for testing purposes
 @app.get("/tester/")
 @auth.login_required
+@conditional("tester")
 def show_tester():
     current_suite = TestSuite.current()
     if current_suite:
-        transactions_with_responses = current_suite.transactions_with_responses()
-        n_transactions_sent = len(current_suite.transactions())
+        # Parsed once for the whole page:
         shinkansen_messages = current_suite.shinkansen_messages()
+        transactions = [tx for m in shinkansen_messages for tx in m.transactions]
+        transactions_with_responses = current_suite.transactions_with_responses(
+            transactions
+        )
+        n_transactions_sent = len(transactions)
         n_responses_received = len(transactions_with_responses)
     else:
         transactions_with_responses = {}
@@ -441,13 +528,38 @@ def show_tester():
         shinkansen_messages=shinkansen_messages,
         n_transactions_sent=n_transactions_sent,
         n_responses_received=n_responses_received,
+        tester_concurrency=TESTER_CONCURRENCY,
+        tester_rate=TESTER_RATE,
+    )
+
+
+@app.get("/tester/report")
+@auth.login_required
+def show_tester_report():
+    suites = TestSuite.query.order_by(TestSuite.id.desc()).limit(20).all()
+    suite_ids = request.args.getlist("suite_id", type=int) or [
+        suite.id for suite in suites[:1]
+    ]
+    reports = [suite_report(suite_id) for suite_id in suite_ids]
+    if request.args.get("format") == "json":
+        return jsonify(reports)
+    return render_template(
+        "tester_report.html",
+        suites=suites,
+        suite_ids=suite_ids,
+        reports=reports,
+        latencies=LATENCIES,
+        events=EVENTS,
     )
 
 
 @app.post("/tester/start")
 @auth.login_required
 def start_tester():
-    run_new_suite()
+    run_new_suite(
+        concurrency=request.form.get("concurrency", type=int),
+        rate=request.form.get("rate", type=float),
+    )
     return redirect("/tester/")
 
 
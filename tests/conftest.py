@@ -0,0 +1,24 @@
+import os
+import tempfile
+
+# Settings are read when tamagotchi is imported, so they're set before that:
+directory = tempfile.mkdtemp()
+os.environ["TAMAGOTCHI_DATABASE_URL"] = f"sqlite:///{directory}/tests.sqlite"
+os.environ["TAMAGOTCHI_CALLBACK_INBOX"] = ""
+os.environ.pop("SHINKANSEN_FORWARD_URL", None)
+
+import pytest
+from tamagotchi.app import app, db
+from tamagotchi.dedup import callback_dedup
+
+
+@pytest.fixture
+def database():
+    """An empty database (all tables created), within an app context"""
+    with app.app_context():
+        db.create_all()
+        yield db
+        db.session.remove()
+        db.drop_all()
+    with callback_dedup._lock:
+        callback_dedup._digests.clear()
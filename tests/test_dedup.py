@@ -0,0 +1,87 @@
+from sqlalchemy.orm import Session
+from tamagotchi import views
+from tamagotchi.app import app
+from tamagotchi.dedup import (
+    CallbackDeduplicator,
+    ProcessedCallback,
+    callback_dedup,
+    callback_digest,
+)
+from tamagotchi.instrumentation import recorder
+from tamagotchi.models import utcnow
+
+
+def test_remembers_the_most_recently_seen_digests(database):
+    dedup = CallbackDeduplicator(2)
+    dedup.remember("a")
+    dedup.remember("b")
+    assert dedup.seen("a")  # Now more recent than b
+    dedup.remember("c")
+    assert dedup.stats()["size"] == 2
+    assert not dedup.seen("b")  # Evicted, and not in the database
+    assert dedup.seen("a")
+    assert dedup.seen("c")
+    assert dedup.stats()["duplicates"] == 3
+    assert dedup.stats()["unique"] == 1
+
+
+def test_recognizes_committed_digests_not_in_memory(database):
+    dedup = CallbackDeduplicator(2)
+    dedup.record("a")
+    database.session.commit()
+    assert dedup.seen("a")
+    assert dedup.stats()["size"] == 1  # Remembered from now on
+
+
+class Routed:
+    """Stands in for a RoutedMessage, recording when it's forwarded"""
+
+    def __init__(self, content: str, forwarded: list) -> None:
+        self.content = content
+        self.forwarded = forwarded
+
+    def after_commit(self):
+        self.forwarded.append(self.content)
+
+
+def post_callback(content: str):
+    return app.test_client().post(
+        "/shinkansen/messages/",
+        data=content,
+        headers={"Shinkansen-JWS-Signature": "signature"},
+    )
+
+
+def test_acknowledges_copies_applied_concurrently(database, monkeypatch):
+    content = '{"a": "message"}'
+    digest = callback_digest(content)
+    forwarded = []
+
+    def apply_response_message(message, content, signature):
+        # Another copy of the message commits first, meanwhile:
+        with Session(database.engine) as session:
+            session.add(ProcessedCallback(digest=digest, processed_at=utcnow()))
+            session.commit()
+        return Routed(content, forwarded)
+
+    monkeypatch.setattr(views, "response_message_from_request", lambda r: content)
+    monkeypatch.setattr(views, "verify_signature", lambda m, s: None)
+    monkeypatch.setattr(views, "apply_response_message", apply_response_message)
+    duplicated = recorder.snapshot()[1].get("callbacks_duplicated", 0)
+    response = post_callback(content)
+    assert response.status_code == 200
+    assert forwarded == []  # Left to the copy that committed
+    assert recorder.snapshot()[1]["callbacks_duplicated"] == duplicated + 1
+    assert callback_dedup.seen(digest, count=False)
+
+
+def test_applies_and_forwards_new_callbacks_once(database, monkeypatch):
+    forwarded = []
+    monkeypatch.setattr(views, "response_message_from_request", lambda r: None)
+    monkeypatch.setattr(views, "verify_signature", lambda m, s: None)
+    monkeypatch.setattr(
+        views, "apply_response_message", lambda m, c, s: Routed(c, forwarded)
+    )
+    assert post_callback('{"a": "message"}').status_code == 200
+    assert post_callback('{"a": "message"}').status_code == 200
+    assert forwarded == ['{"a": "message"}']
@@ -0,0 +1,107 @@
+from datetime import timedelta
+from tamagotchi import inbox
+from tamagotchi.inbox import DONE, FAILED, PROCESSING, QUEUED, InboxMessage
+from tamagotchi.models import utcnow
+
+
+def queued(db, *contents: str) -> list[int]:
+    messages = [
+        InboxMessage(
+            received_at=utcnow(),
+            content=content,
+            signature="signature",
+            status=QUEUED,
+            attempts=0,
+        )
+        for content in contents
+    ]
+    db.session.add_all(messages)
+    db.session.commit()
+    return [message.id for message in messages]
+
+
+def expire_leases(db):
+    stale = utcnow() - timedelta(seconds=inbox.TAMAGOTCHI_INBOX_LEASE + 1)
+    for message in InboxMessage.query.filter(InboxMessage.status == PROCESSING):
+        message.claimed_at = stale
+    db.session.commit()
+
+
+def test_claims_oldest_first_up_to_limit(database):
+    ids = queued(database, "a", "b", "c")
+    claimed = inbox.claim_batch(2)
+    assert [message.id for message in claimed] == ids[:2]
+    assert all(message.status == PROCESSING for message in claimed)
+    assert all(message.attempts == 1 for message in claimed)
+    assert len({message.claim for message in claimed}) == 1
+    assert [message.id for message in inbox.claim_batch(10)] == ids[2:]
+    assert inbox.claim_batch(10) == []
+
+
+def test_claims_again_once_the_lease_expires(database):
+    [id] = queued(database, "a")
+    [first] = inbox.claim_batch(10)
+    first_claim = first.claim
+    assert inbox.claim_batch(10) == []  # Still leased
+    expire_leases(database)
+    [again] = inbox.claim_batch(10)
+    assert again.id == id
+    assert again.attempts == 2
+    assert again.claim != first_claim
+
+
+def test_fails_messages_out_of_attempts(database, monkeypatch):
+    monkeypatch.setattr(inbox, "TAMAGOTCHI_INBOX_MAX_ATTEMPTS", 2)
+    [id] = queued(database, "a")
+    assert len(inbox.claim_batch(10)) == 1
+    expire_leases(database)
+    assert len(inbox.claim_batch(10)) == 1
+    expire_leases(database)
+    assert inbox.claim_batch(10) == []
+    message = InboxMessage.query.get(id)
+    assert message.status == FAILED
+    assert message.error == "Not processed after 2 attempts"
+
+
+class Routed:
+    """Stands in for a RoutedMessage, recording when it's forwarded"""
+
+    def __init__(self, content: str, forwarded: list) -> None:
+        self.content = content
+        self.forwarded = forwarded
+
+    def after_commit(self):
+        self.forwarded.append(self.content)
+
+
+def apply_all_but_bad(forwarded: list):
+    def apply_response_message(message, content, signature):
+        if content == "bad":
+            raise ValueError("Bad message")
+        return Routed(content, forwarded)
+
+    return apply_response_message
+
+
+def test_forwards_batches_once_committed(database, monkeypatch):
+    forwarded = []
+    monkeypatch.setattr(inbox, "verified_response_message", lambda c, s: c)
+    monkeypatch.setattr(inbox, "apply_response_message", apply_all_but_bad(forwarded))
+    ids = queued(database, "a", "b")
+    assert inbox.process_batch() == 2
+    assert forwarded == ["a", "b"]
+    assert all(InboxMessage.query.get(id).status == DONE for id in ids)
+
+
+def test_fallback_forwards_messages_of_the_failed_batch_once(database, monkeypatch):
+    forwarded = []
+    monkeypatch.setattr(inbox, "verified_response_message", lambda c, s: c)
+    monkeypatch.setattr(inbox, "apply_response_message", apply_all_but_bad(forwarded))
+    good, bad = queued(database, "good", "bad")
+    assert inbox.process_batch() == 2
+    # Applied twice (in the batch and then on its own), but only committed once:
+    assert forwarded == ["good"]
+    assert InboxMessage.query.get(good).status == DONE
+    bad_message = InboxMessage.query.get(bad)
+    assert bad_message.status == PROCESSING  # Retried once its lease expires
+    assert bad_message.error == "ValueError: Bad message"